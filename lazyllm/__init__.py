@@ -11,7 +11,7 @@ from .components import (LazyLLMDataprocBase, LazyLLMFinetuneBase, LazyLLMDeploy
 
 from .module import (ModuleBase, UrlModule, TrainableModule, ActionModule,
                      ServerModule, TrialModule, register as module_register,
-                     OnlineChatModule, OnlineEmbeddingModule, AutoModel)
+                     OnlineChatModule, OnlineChatRouter, OnlineEmbeddingModule, AutoModel)
 from .client import redis_client
 from .tools import (Document, Reranker, Retriever, WebModule, ToolManager, FunctionCall,
                     FunctionCallAgent, fc_register, ReactAgent, PlanAndSolveAgent, ReWOOAgent, SentenceSplitter,
@@ -54,6 +54,7 @@ __all__ = [
     'TrialModule',
     'module_register',
     'OnlineChatModule',
+    'OnlineChatRouter',
     'OnlineEmbeddingModule',
     'AutoModel',
 
@@ -0,0 +1,181 @@
+import time
+import random
+import hashlib
+import threading
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from .logger import LOG
+
+
+class TokenBucket(object):
+    """Thread-safe token bucket, refilled continuously with ``rate`` tokens every ``period`` seconds.
+
+    ``acquire`` blocks until enough tokens are available, while ``consume`` takes tokens without waiting and may
+    leave the bucket in debt, which is useful to charge costs only known after a request (e.g. output tokens).
+    """
+
+    def __init__(self, rate: float, period: float = 60.0, capacity: Optional[float] = None):
+        assert rate > 0 and period > 0, 'rate and period of TokenBucket should be positive'
+        self._rate = rate / period
+        self._capacity = capacity or rate
+        self._tokens = self._capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self._capacity, self._tokens + (now - self._last) * self._rate)
+        self._last = now
+
+    def acquire(self, n: float = 1, timeout: Optional[float] = None) -> bool:
+        # requests larger than the bucket are allowed once the bucket is full, otherwise they would wait forever
+        n = min(n, self._capacity)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= n:
+                    self._tokens -= n
+                    return True
+                wait = (n - self._tokens) / self._rate
+            if deadline is not None:
+                if time.monotonic() + wait > deadline: return False
+            time.sleep(wait)
+
+    def consume(self, n: float) -> None:
+        with self._lock:
+            self._refill()
+            self._tokens -= n
+
+    @property
+    def available(self) -> float:
+        with self._lock:
+            self._refill()
+            return self._tokens
+
+
+def backoff_delay(attempt: int, retry_after: Optional[str] = None, base: float = 1.0, cap: float = 60.0) -> float:
+    # honour the Retry-After header (seconds or http date) when the server sends one, otherwise use full jitter
+    if retry_after:
+        try:
+            delay = float(retry_after)
+        except ValueError:
+            try:
+                delay = parsedate_to_datetime(retry_after).timestamp() - time.time()
+            except (TypeError, ValueError):
+                delay = None
+        if delay is not None: return min(cap, max(0.0, delay)) + random.uniform(0, base)
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class RateLimiter(object):
+    """Client side limits of one provider endpoint and api key, shared by every thread sending requests to it.
+
+    Requests are admitted by the ``rpm`` / ``tpm`` token buckets and by a concurrency limit adjusted like TCP
+    congestion control: it is halved when the provider throttles (at most once per ``cooldown`` seconds) and grows
+    by about one slot per limit-many successful requests, up to ``max_concurrency``. Without ``max_concurrency`` the
+    concurrency is unlimited until the first throttled request.
+    """
+
+    def __init__(self, rpm: Optional[float] = None, tpm: Optional[float] = None,
+                 max_concurrency: Optional[int] = None, cooldown: float = 1.0):
+        self._cond = threading.Condition()
+        self._in_flight, self._cooldown, self._last_throttle = 0, cooldown, 0.0
+        self._rpm = self._tpm = self._max_concurrency = self._limit = None
+        self.throttled = 0
+        self.update(rpm, tpm, max_concurrency)
+
+    def update(self, rpm: Optional[float] = None, tpm: Optional[float] = None,
+               max_concurrency: Optional[int] = None) -> 'RateLimiter':
+        with self._cond:
+            if rpm: self._rpm = TokenBucket(rpm)
+            if tpm: self._tpm = TokenBucket(tpm)
+            if max_concurrency:
+                self._max_concurrency = max_concurrency
+                self._limit = min(self._limit or max_concurrency, max_concurrency)
+                self._cond.notify_all()
+        return self
+
+    @property
+    def concurrency_limit(self) -> Optional[int]:
+        return None if self._limit is None else max(1, int(self._limit))
+
+    @contextmanager
+    def slot(self, tokens: float = 0):
+        if self._rpm: self._rpm.acquire()
+        if self._tpm and tokens: self._tpm.acquire(tokens)
+        with self._cond:
+            while self._limit is not None and self._in_flight >= max(1, int(self._limit)):
+                self._cond.wait()
+            self._in_flight += 1
+        try:
+            yield self
+        finally:
+            with self._cond:
+                self._in_flight -= 1
+                self._cond.notify()
+
+    def consume(self, tokens: float) -> None:
+        # charge the tokens only known after the request, e.g. the generated tokens
+        if self._tpm and tokens: self._tpm.consume(tokens)
+
+    def on_success(self) -> None:
+        with self._cond:
+            if self._limit is None: return
+            self._limit += 1 / self._limit
+            if self._max_concurrency: self._limit = min(self._limit, self._max_concurrency)
+            self._cond.notify()
+
+    def on_throttled(self) -> None:
+        with self._cond:
+            self.throttled += 1
+            now = time.monotonic()
+            if now - self._last_throttle < self._cooldown: return
+            self._last_throttle = now
+            self._limit = max(1.0, (self._limit if self._limit is not None else self._in_flight) / 2)
+            LOG.warning(f'Requests are throttled by the provider, reduce concurrency to {self.concurrency_limit}')
+
+
+_limiters: Dict[str, RateLimiter] = {}
+_limiters_lock = threading.Lock()
+
+def get_rate_limiter(*keys: str) -> RateLimiter:
+    # limiters are shared by provider and api key, the key itself is not kept in memory
+    key = hashlib.sha256('\0'.join(str(k) for k in keys).encode()).hexdigest()
+    with _limiters_lock:
+        if key not in _limiters: _limiters[key] = RateLimiter()
+        return _limiters[key]
+
+
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+@contextmanager
+def limited_request(limiter: RateLimiter, send: Callable[[], Any], *, tokens: float = 0, max_retries: int = 3,
+                    retry_status: Tuple[int, ...] = RETRY_STATUS, retry_exceptions: Tuple[type, ...] = (),
+                    base_delay: float = 1.0, max_delay: float = 60.0):
+    """Send a request through ``limiter`` and yield the response, retrying throttled or failed requests with
+    backoff. ``send`` returns a response with ``status_code``, ``headers`` and ``close``; the concurrency slot is
+    held until the caller has consumed the response."""
+    for attempt in range(max_retries + 1):
+        with limiter.slot(tokens if attempt == 0 else 0):
+            try:
+                response = send()
+            except retry_exceptions as e:
+                if attempt >= max_retries: raise
+                delay, reason = backoff_delay(attempt, None, base_delay, max_delay), f'{type(e).__name__}: {e}'
+            else:
+                if response.status_code not in retry_status or attempt >= max_retries:
+                    if response.status_code < 400: limiter.on_success()
+                    try:
+                        yield response
+                    finally:
+                        response.close()
+                    return
+                if response.status_code == 429: limiter.on_throttled()
+                delay = backoff_delay(attempt, response.headers.get('Retry-After'), base_delay, max_delay)
+                reason = f'status code {response.status_code}'
+                response.close()
+        LOG.warning(f'Request failed with {reason}, retry {attempt + 1}/{max_retries} in {delay:.2f}s')
+        time.sleep(delay)
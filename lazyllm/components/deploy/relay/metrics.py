@@ -0,0 +1,133 @@
+import time
+import bisect
+import threading
+from collections import defaultdict, deque
+
+
+class RelayMetrics(object):
+    """In-process request metrics of a relay server, rendered in prometheus text format."""
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, float('inf'))
+    quantiles = (0.5, 0.9, 0.99)
+    excluded_paths = ('/metrics', '/health')
+
+    def __init__(self, window: int = 1024):
+        self._lock = threading.Lock()
+        self._start_time = time.time()
+        self._in_flight = 0
+        self._requests = defaultdict(int)
+        self._errors = defaultdict(int)
+        self._latency_buckets = defaultdict(lambda: [0] * len(self.buckets))
+        self._latency_sum = defaultdict(float)
+        self._latency_recent = defaultdict(lambda: deque(maxlen=window))
+        self._queue_sum, self._queue_count = 0.0, 0
+        self._stream_chunks, self._stream_seconds = 0, 0.0
+
+    def request_started(self) -> float:
+        with self._lock: self._in_flight += 1
+        return time.perf_counter()
+
+    def request_finished(self, path: str, status: int, start: float) -> None:
+        cost = time.perf_counter() - start
+        idx = bisect.bisect_left(self.buckets, cost)
+        with self._lock:
+            self._in_flight -= 1
+            self._requests[path, status] += 1
+            if status >= 500: self._errors[path] += 1
+            self._latency_buckets[path][idx] += 1
+            self._latency_sum[path] += cost
+            self._latency_recent[path].append(cost)
+
+    def observe_queue(self, seconds: float) -> None:
+        with self._lock:
+            self._queue_sum += seconds
+            self._queue_count += 1
+
+    def observe_stream(self, chunks: int, seconds: float) -> None:
+        with self._lock:
+            self._stream_chunks += chunks
+            self._stream_seconds += seconds
+
+    def health(self) -> dict:
+        return dict(status='ok', uptime=round(time.time() - self._start_time, 3), in_flight=self._in_flight)
+
+    @staticmethod
+    def _percentile(values, q):
+        values = sorted(values)
+        return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+    def _render_latency(self, lines, latency_buckets, latency_sum, latency_recent):
+        lines += ['# HELP lazyllm_request_duration_seconds Request latency in seconds.',
+                  '# TYPE lazyllm_request_duration_seconds histogram']
+        for path, counts in latency_buckets.items():
+            total = 0
+            for bound, count in zip(self.buckets, counts):
+                total += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'lazyllm_request_duration_seconds_bucket{{path="{path}",le="{le}"}} {total}')
+            lines.append(f'lazyllm_request_duration_seconds_sum{{path="{path}"}} {latency_sum[path]}')
+            lines.append(f'lazyllm_request_duration_seconds_count{{path="{path}"}} {total}')
+        lines += ['# HELP lazyllm_request_latency_seconds Latency quantiles over the most recent requests.',
+                  '# TYPE lazyllm_request_latency_seconds summary']
+        for path, recent in latency_recent.items():
+            for q in self.quantiles:
+                lines.append(f'lazyllm_request_latency_seconds{{path="{path}",quantile="{q}"}} '
+                             f'{self._percentile(recent, q)}')
+
+    def render(self) -> str:
+        with self._lock:
+            requests, errors = dict(self._requests), dict(self._errors)
+            latency_buckets = {k: list(v) for k, v in self._latency_buckets.items()}
+            latency_sum = dict(self._latency_sum)
+            latency_recent = {k: list(v) for k, v in self._latency_recent.items()}
+            in_flight, queue_sum, queue_count = self._in_flight, self._queue_sum, self._queue_count
+            stream_chunks, stream_seconds = self._stream_chunks, self._stream_seconds
+
+        lines = ['# HELP lazyllm_uptime_seconds Seconds since the server started.',
+                 '# TYPE lazyllm_uptime_seconds gauge',
+                 f'lazyllm_uptime_seconds {time.time() - self._start_time}',
+                 '# HELP lazyllm_requests_in_flight Requests currently being handled.',
+                 '# TYPE lazyllm_requests_in_flight gauge',
+                 f'lazyllm_requests_in_flight {in_flight}',
+                 '# HELP lazyllm_requests_total Total number of handled requests.',
+                 '# TYPE lazyllm_requests_total counter']
+        lines += [f'lazyllm_requests_total{{path="{path}",status="{status}"}} {count}'
+                  for (path, status), count in requests.items()]
+        lines += ['# HELP lazyllm_request_errors_total Total number of requests answered with a 5xx status.',
+                  '# TYPE lazyllm_request_errors_total counter']
+        lines += [f'lazyllm_request_errors_total{{path="{path}"}} {count}' for path, count in errors.items()]
+        self._render_latency(lines, latency_buckets, latency_sum, latency_recent)
+        lines += ['# HELP lazyllm_request_queue_seconds Time requests wait for a worker thread.',
+                  '# TYPE lazyllm_request_queue_seconds summary',
+                  f'lazyllm_request_queue_seconds_sum {queue_sum}',
+                  f'lazyllm_request_queue_seconds_count {queue_count}',
+                  '# HELP lazyllm_stream_chunks_total Total number of chunks sent by streaming responses.',
+                  '# TYPE lazyllm_stream_chunks_total counter',
+                  f'lazyllm_stream_chunks_total {stream_chunks}',
+                  '# HELP lazyllm_stream_seconds_total Total time spent sending streaming responses.',
+                  '# TYPE lazyllm_stream_seconds_total counter',
+                  f'lazyllm_stream_seconds_total {stream_seconds}']
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsMiddleware(object):
+    """Pure ASGI middleware, so that streaming responses are measured until their last chunk is sent."""
+
+    def __init__(self, app, metrics: RelayMetrics):
+        self.app = app
+        self.metrics = metrics
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['path'] in RelayMetrics.excluded_paths:
+            return await self.app(scope, receive, send)
+        status, start = 500, self.metrics.request_started()
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message['type'] == 'http.response.start': status = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get('route')
+            self.metrics.request_finished(route.path if route else '<unmatched>', status, start)
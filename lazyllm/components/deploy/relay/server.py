@@ -12,11 +12,13 @@ from lazyllm import FastapiApp, globals, decode_request
 import pickle
 import codecs
 import asyncio
+import time
 from functools import partial
 
 from fastapi import FastAPI, Request
-from fastapi.responses import Response, StreamingResponse
+from fastapi.responses import Response, StreamingResponse, PlainTextResponse, JSONResponse
 import requests
+from lazyllm.components.deploy.relay.metrics import RelayMetrics, MetricsMiddleware
 
 # TODO(sunxiaoye): delete in the future
 lazyllm_module_dir = os.path.abspath(__file__)
@@ -46,11 +48,15 @@ if args.after_function:
 
 app = FastAPI()
 FastapiApp.update()
+metrics = RelayMetrics()
+app.add_middleware(MetricsMiddleware, metrics=metrics)
 
 async def async_wrapper(func, *args, **kwargs):
     loop = asyncio.get_running_loop()
+    submit_time = time.perf_counter()
 
     def impl(func, sid, global_data, *args, **kw):
+        metrics.observe_queue(time.perf_counter() - submit_time)
         globals._init_sid(sid)
         globals._update(global_data)
         return func(*args, **kw)
@@ -91,8 +97,13 @@ async def generate(request: Request): # noqa C901
 
         if isinstance(output, GeneratorType):
             def generate_stream():
-                for o in output:
-                    yield impl(o)
+                chunks, start = 0, time.perf_counter()
+                try:
+                    for o in output:
+                        chunks += 1
+                        yield impl(o)
+                finally:
+                    metrics.observe_stream(chunks, time.perf_counter() - start)
             return StreamingResponse(generate_stream(), media_type='text_plain')
         elif args.after_function:
             assert (callable(after_func)), 'after_func must be callable'
@@ -118,5 +129,14 @@ if '__relay_services__' in dir(func.__class__):
     for (method, path), (name, kw) in func.__class__.__relay_services__.items():
         getattr(app, method)(path, **kw)(getattr(func, name))
 
+# Registered after the services of func, so that func can provide its own health check.
+@app.get("/health")
+async def health():
+    return JSONResponse(content=metrics.health())
+
+@app.get("/metrics")
+async def get_metrics():
+    return PlainTextResponse(content=metrics.render(), media_type='text/plain; version=0.0.4')
+
 if __name__ == "__main__":
     uvicorn.run(app, host=args.open_ip, port=args.open_port)
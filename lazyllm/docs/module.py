@@ -142,6 +142,39 @@ INFO: (lazyllm.launcher) PID: dummy finetune!, and init-args is {}
 ["reply for 1, and parameters is {'do_sample': False, 'temperature': 0.1}", "reply for 2, and parameters is {'do_sample': False, 'temperature': 0.1}", "reply for 3, and parameters is {'do_sample': False, 'temperature': 0.1}"]
 ''')
 
+add_chinese_doc('ModuleBase.batch', '''\
+以流式的方式将一批输入送入模块进行推理，输出顺序与输入顺序一致。执行的统计信息（吞吐、延迟分位数、失败与重试次数等）会存在batch_stats变量中。评测集的推理也是基于本函数实现的，``evalset`` 的额外参数会透传给本函数。
+
+Args:
+    inputs (Iterable): 输入集合，可以是任意可迭代对象，字典类型的输入会以关键字参数的形式传给模块
+    concurrency (int): 最大并发数，默认为16
+    rpm (int): 每分钟最大请求数，默认不限制
+    tpm (int): 每分钟最大token数（按输入和输出估算），默认不限制
+    retries (int): 每个输入失败后的最大重试次数，默认为0
+    checkpoint (str): 断点文件路径。已完成的输入会追加写入该文件，使用同一文件再次执行时只会推理未完成的输入
+    on_error (str): 输入重试后仍失败时的处理方式，``raise`` 抛出异常，``skip`` 记录日志并以None作为输出
+''')
+
+add_english_doc('ModuleBase.batch', '''\
+Stream a set of inputs through the module and return the outputs in input order. Statistics of the run (throughput, latency percentiles, failures and retries) are stored in the batch_stats variable. Inference on the evaluation set is built on this function, and extra arguments of ``evalset`` are passed to it.
+
+Args:
+    inputs (Iterable): Any iterable of inputs. Dict inputs are passed to the module as keyword arguments.
+    concurrency (int): Maximum number of concurrent calls. Defaults to 16.
+    rpm (int): Maximum requests per minute. Unlimited by default.
+    tpm (int): Maximum tokens per minute, estimated from inputs and outputs. Unlimited by default.
+    retries (int): Maximum retries for each failed input. Defaults to 0.
+    checkpoint (str): Path of the checkpoint file. Finished inputs are appended to it, and a run with the same file only infers the unfinished inputs.
+    on_error (str): What to do when an input still fails after retries: ``raise`` the error, or ``skip`` it with None as output.
+''')
+
+add_example('ModuleBase.batch', '''\
+>>> import lazyllm
+>>> m = lazyllm.ActionModule(lambda x: x * 2)
+>>> m.batch(range(5), concurrency=2, retries=1, checkpoint='/tmp/batch.jsonl')
+[0, 2, 4, 6, 8]
+''')
+
 add_chinese_doc('ModuleBase.eval', '''\
 对模块（及所有的子模块）进行评测。当模块通过 ``evalset`` 设置了评测集之后，本函数生效。
 
@@ -542,6 +575,31 @@ add_example('UrlModule.forward', '''\
 2
 ''')
 
+add_chinese_doc('UrlModule.on_tool_call', '''\
+注册一个回调函数，在模型输出的过程中，每当一个工具调用的参数完整时立即以 ``{"name": ..., "arguments": ...}`` 的形式调用它，而不必等待模型生成结束。
+
+Args:
+    callback (Callable): 接收一个工具调用的回调函数，传入 ``None`` 则取消回调。
+
+**Returns:**\n
+- UrlModule: 模块自身。
+''')
+
+add_english_doc('UrlModule.on_tool_call', '''\
+Register a callback which is invoked with ``{"name": ..., "arguments": ...}`` as soon as the arguments of a tool call in the model output are complete, without waiting for the generation to finish.
+
+Args:
+    callback (Callable): The callback receiving one tool call; pass ``None`` to remove it.
+
+**Returns:**\n
+- UrlModule: The module itself.
+''')
+
+add_example('UrlModule.on_tool_call', '''\
+>>> import lazyllm
+>>> m = lazyllm.TrainableModule('internlm2-chat-7b').on_tool_call(lambda call: print('dispatch', call['name']))
+''')
+
 add_chinese_doc('ServerModule', '''\
 借助 fastapi，将任意可调用对象包装成 api 服务，可同时启动一个主服务和多个卫星服务。
 
@@ -689,17 +747,33 @@ m(1)
 # ''')
 
 add_chinese_doc('TrialModule', '''\
-参数网格搜索模块，会遍历其所有的submodule，收集所有的可被搜索的参数，遍历这些参数进行微调、部署和评测
+参数网格搜索模块，会遍历其所有的submodule，收集所有的可被搜索的参数，遍历这些参数进行微调、部署和评测。每组参数在一个独立的进程中执行，同时运行的进程数受 ``max_workers`` 限制，结果按参数组的顺序收集在results变量中。
 
 Args:
     m (Callable): 被网格搜索参数的子模块，微调、部署和评测都会基于这个模块进行
+    max_workers (int): 同时运行的最大进程数，默认为CPU核数
+    sampler (str): 参数组的采样方式。``grid`` 遍历全部组合；``random`` 随机采样 ``n_trials`` 组不重复的参数；``adaptive`` 先随机采样，再基于得分最高的参数组变异产生新的参数组
+    n_trials (int): ``random`` 和 ``adaptive`` 采样时尝试的参数组数量
+    score_f (Callable): 将评测结果映射为得分（越大越好）的函数，``adaptive`` 采样和提前停止时必须提供
+    early_stop (str): 提前停止策略，目前支持 ``halving`` （successive halving）：先在评测集的前 ``min_eval`` 条数据上评测所有参数组，只保留得分最高的 ``1/eta`` 继续在 ``eta`` 倍的数据上评测，直到使用完整的评测集
+    min_eval (int): 提前停止时第一轮使用的评测数据条数，默认根据参数组数量和 ``eta`` 计算
+    eta (int): 提前停止时每轮的淘汰比例，默认为2
+    seed (int): 随机采样的种子
 ''')
 
 add_english_doc('TrialModule', '''\
-Parameter grid search module will traverse all its submodules, collect all searchable parameters, and iterate over these parameters for fine-tuning, deployment, and evaluation.
+Parameter grid search module will traverse all its submodules, collect all searchable parameters, and iterate over these parameters for fine-tuning, deployment, and evaluation. Each configuration runs in its own process, at most ``max_workers`` of them at the same time, and the results are collected in configuration order in the results variable.
 
 Args:
     m (Callable): The submodule whose parameters will be grid-searched. Fine-tuning, deployment, and evaluation will be based on this module.
+    max_workers (int): Maximum number of concurrent processes. Defaults to the number of CPUs.
+    sampler (str): How configurations are chosen. ``grid`` tries the full cartesian product; ``random`` draws ``n_trials`` distinct configurations; ``adaptive`` starts with random configurations and then mutates the best scored ones.
+    n_trials (int): Number of configurations tried by the ``random`` and ``adaptive`` samplers.
+    score_f (Callable): Maps an evaluation result to a score (higher is better). Required by the ``adaptive`` sampler and early stopping.
+    early_stop (str): Early stopping strategy. ``halving`` (successive halving) evaluates all configurations on the first ``min_eval`` samples of the evalset, and only the best ``1/eta`` of them continue on ``eta`` times more samples, until the full evalset is used.
+    min_eval (int): Number of samples used in the first round of early stopping. Derived from the number of configurations and ``eta`` by default.
+    eta (int): Reduction factor of each early stopping round. Defaults to 2.
+    seed (int): Seed of random sampling.
 ''')
 
 add_example('TrialModule', '''\
@@ -784,6 +858,44 @@ deployment c5aaf3bf-ef9b-4797-8c15-12ff04ed5372 status: RUNNING
 deployment c5aaf3bf-ef9b-4797-8c15-12ff04ed5372 finished
 ''')
 
+add_chinese_doc('OnlineChatRouter', '''\
+在多个在线大模型模块（不同平台、地域或 api key）之间路由请求。每个请求会在健康的后端中按 ``weights`` 除以该后端平均首包时延的比例随机选择；连续失败 ``max_failures`` 次的后端会被跳过 ``cooldown`` 秒，失败的请求会在其他后端上重试。
+设置 ``hedge_delay`` 后，若请求在该时间内仍未收到首包，会向另一个后端发出备份请求，最先响应的后端胜出并将其流式输出转发给用户，其余请求被取消。
+
+Args:
+    backends (List[ModuleBase]): 后端模块列表，通常为 ``OnlineChatModule``。
+    weights (List[float]): 各后端的静态权重，默认均为1。
+    hedge_delay (float): 发出备份请求前等待首包的秒数，默认为 ``None`` 即不发出备份请求。
+    max_attempts (int): 每个请求最多尝试的后端数量（包括备份和失败重试），默认为后端数量。
+    max_failures (int): 后端连续失败多少次后被暂时跳过，默认为3。
+    cooldown (float): 后端被跳过的秒数，默认为30。
+    ewma_alpha (float): 首包时延指数滑动平均的系数，默认为0.3。
+    return_trace (bool): 是否将结果记录在trace中，默认为False。
+''')
+
+add_english_doc('OnlineChatRouter', '''\
+Route requests over several online chat modules (different platforms, regions or api keys). Every request goes to a healthy backend chosen at random with a probability proportional to ``weights`` divided by the backend's average time to first chunk. A backend failing ``max_failures`` times in a row is skipped for ``cooldown`` seconds, and a failed request is retried on another backend.
+With ``hedge_delay`` set, if no chunk arrived within that many seconds a backup request is sent to another backend; the first backend to respond wins, its stream is forwarded to the user and the other requests are cancelled.
+
+Args:
+    backends (List[ModuleBase]): The backend modules, usually ``OnlineChatModule``.
+    weights (List[float]): Static weights of the backends, 1 for every backend by default.
+    hedge_delay (float): Seconds to wait for the first chunk before sending a backup request, default is ``None`` which disables hedging.
+    max_attempts (int): The maximum number of backends tried by one request, including backups and retries, default is the number of backends.
+    max_failures (int): Consecutive failures after which a backend is skipped for a while, default is 3.
+    cooldown (float): Seconds a failing backend is skipped, default is 30.
+    ewma_alpha (float): Smoothing factor of the moving average of the time to first chunk, default is 0.3.
+    return_trace (bool): Whether to record the results in trace, default is False.
+''')
+
+add_example('OnlineChatRouter', '''\
+>>> import lazyllm
+>>> m = lazyllm.OnlineChatRouter([lazyllm.OnlineChatModule(source="openai"), lazyllm.OnlineChatModule(source="qwen")],
+...                              hedge_delay=2.0)
+>>> m("Hello!")
+>>> m.status()
+''')
+
 add_chinese_doc('OnlineEmbeddingModule', '''\
 用来管理创建目前市面上的在线Embedding服务模块，目前支持openai、sensenova、glm、qwen
 
@@ -791,6 +903,10 @@ Args:
     source (str): 指定要创建的模块类型，可选为 ``openai`` /  ``sensenova`` /  ``glm`` /  ``qwen``
     embed_url (str): 指定要访问的平台的基础链接，默认是官方链接
     embed_mode_name (str): 指定要访问的模型，默认为 ``text-embedding-ada-002(openai)`` / ``nova-embedding-stable(sensenova)`` / ``embedding-2(glm)`` / ``text-embedding-v1(qwen)`` 
+    batch_size (int): 输入为文本列表时每个请求包含的文本数，默认且最大为平台允许的数量。
+    num_workers (int): 输入为文本列表时并发发送请求的数量，默认为8。
+
+输入可以是单个文本，也可以是文本列表；输入列表时会按 ``batch_size`` 分批并发请求，并按输入顺序返回向量列表。
 ''')
 
 add_english_doc('OnlineEmbeddingModule', '''\
@@ -800,6 +916,10 @@ Args:
     source (str): Specify the type of module to create. Options are  ``openai`` /  ``sensenova`` /  ``glm`` /  ``qwen``.
     embed_url (str): Specify the base link of the platform to be accessed. The default is the official link.
     embed_mode_name (str): Specify the model to access, default is ``text-embedding-ada-002(openai)`` / ``nova-embedding-stable(sensenova)`` / ``embedding-2(glm)`` / ``text-embedding-v1(qwen)`` 
+    batch_size (int): The number of texts in one request when a list of texts is given, the default and maximum is what the platform accepts.
+    num_workers (int): The number of concurrent requests when a list of texts is given, default is 8.
+
+The input can be a text or a list of texts; a list is split into batches of ``batch_size`` which are requested concurrently, and the vectors are returned in input order.
 ''')
 
 add_example('OnlineEmbeddingModule', '''\
@@ -808,6 +928,9 @@ add_example('OnlineEmbeddingModule', '''\
 >>> emb = m("hello world")
 >>> print(f"emb: {emb}")
 emb: [0.0010528564, 0.0063285828, 0.0049476624, -0.012008667, ..., -0.009124756, 0.0032043457, -0.051696777]
+>>> embs = m(["hello", "world"])
+>>> len(embs)
+2
 ''')
 
 add_chinese_doc('OnlineChatModuleBase', '''\
@@ -934,3 +1057,43 @@ add_example('OnlineEmbeddingModuleBase', '''\
 ...         pass
 ...         return embedding
 ''')
+
+add_chinese_doc('OnlineChatModuleBase.rate_limit', '''\
+设置客户端限流。同一平台、同一 api key 的所有模块和线程共享这些限制：每分钟请求数和每分钟 token 数由令牌桶控制，并发数在平台限流（HTTP 429）时减半，请求成功后逐步恢复。
+被限流、返回5xx或连接失败的请求会按带随机抖动的指数退避重试，若平台返回了 ``Retry-After`` 则按其等待。
+
+Args:
+    rpm (int): 每分钟最多请求数，默认为 ``None`` 即不限制。
+    tpm (int): 每分钟最多 token 数（按字符数估算），默认为 ``None`` 即不限制。
+    max_concurrency (int): 最大并发请求数，默认为 ``None`` 即在首次被限流前不限制。
+    max_retries (int): 最多重试次数，默认为3。
+''')
+
+add_english_doc('OnlineChatModuleBase.rate_limit', '''\
+Set client side rate limits, shared by every module and thread using the same platform and api key: requests per minute and tokens per minute are enforced by token buckets, and the concurrency is halved when the platform throttles (HTTP 429) and recovers gradually with successful requests.
+Throttled requests, 5xx responses and connection errors are retried with jittered exponential backoff, or after ``Retry-After`` when the platform sends it.
+
+Args:
+    rpm (int): Maximum requests per minute, default is ``None`` (unlimited).
+    tpm (int): Maximum tokens per minute (estimated from the number of characters), default is ``None`` (unlimited).
+    max_concurrency (int): Maximum concurrent requests, default is ``None`` (unlimited until the first throttled request).
+    max_retries (int): Maximum number of retries, default is 3.
+''')
+
+add_example('OnlineChatModuleBase.rate_limit', '''\
+>>> import lazyllm
+>>> m = lazyllm.OnlineChatModule(source="openai").rate_limit(rpm=500, tpm=200000, max_concurrency=16)
+''')
+
+add_chinese_doc('OnlineEmbeddingModuleBase.rate_limit', '''\
+设置客户端限流，参数与行为同 ``OnlineChatModuleBase.rate_limit`` 。
+''')
+
+add_english_doc('OnlineEmbeddingModuleBase.rate_limit', '''\
+Set client side rate limits, the arguments and behavior are the same as ``OnlineChatModuleBase.rate_limit`` .
+''')
+
+add_example('OnlineEmbeddingModuleBase.rate_limit', '''\
+>>> import lazyllm
+>>> m = lazyllm.OnlineEmbeddingModule(source="openai").rate_limit(rpm=3000, max_concurrency=32)
+''')
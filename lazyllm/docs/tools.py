@@ -26,6 +26,7 @@ Args:
     embed: The object used to generate document embeddings.
     manager (bool, optional): A flag indicating whether to create a user interface for the document module. Defaults to False.
     launcher (optional): An object or function responsible for launching the server module. If not provided, the default asynchronous launcher from `lazyllm.launchers` is used (`sync=False`).
+    result_cache_size (int, optional): The number of retrieval results to cache, keyed by the query and the retrieval parameters. The cache is emptied whenever files are added or deleted, so cached results are never stale. Defaults to ``config['rag_result_cache_size']``, 0 disables the cache.
 ''')
 
 add_chinese_doc('Document', '''\
@@ -38,6 +39,7 @@ Args:
     embed: 用于生成文档embedding的对象。
     manager (bool, optional): 指示是否为文档模块创建用户界面的标志。默认为 False
     launcher (optional): 负责启动服务器模块的对象或函数。如果未提供，则使用 `lazyllm.launchers` 中的默认异步启动器 (`sync=False`)。
+    result_cache_size (int, optional): 缓存的检索结果数量，以查询和检索参数为键。每次添加或删除文件时缓存都会被清空，因此不会返回过期的结果。默认为 ``config['rag_result_cache_size']``，0 表示不使用缓存。
 ''')
 
 add_example('Document', '''\
@@ -47,6 +49,24 @@ add_example('Document', '''\
 >>> documents = Document(dataset_path='your_doc_path', embed=m, manager=False)
 ''')
 
+add_english_doc('Document.result_cache_stats', '''
+Return the statistics of the retrieval result cache: ``hits``, ``misses``, ``hit_rate``, ``size`` and the ``version`` of the document, which is increased whenever files are added or deleted.
+''')
+
+add_chinese_doc('Document.result_cache_stats', '''
+返回检索结果缓存的统计信息：``hits``、``misses``、``hit_rate``、``size`` 以及文档的 ``version``，每次添加或删除文件时版本号都会增加。
+''')
+
+add_example('Document.result_cache_stats', '''
+>>> import lazyllm
+>>> from lazyllm.tools import Document, Retriever
+>>> documents = Document(dataset_path='your_doc_path', embed=lazyllm.OnlineEmbeddingModule(), result_cache_size=1024)
+>>> retriever = Retriever(documents, group_name='CoarseChunk', similarity='cosine', topk=3)
+>>> retriever("query"), retriever("query")
+>>> documents.result_cache_stats()['hit_rate']
+0.5
+''')
+
 add_english_doc('Document.create_node_group', '''
 Generate a node group produced by the specified rule.
 
@@ -255,6 +275,42 @@ add_example('rag.readers.ReaderBase', '''
 
 # ---------------------------------------------------------------------------- #
 
+# rag/embed_cache.py
+
+add_english_doc('rag.EmbeddingCache', '''\
+A content-addressed cache in front of an embedding model. Document wraps its embed model with it automatically.
+
+Vectors are keyed by a hash of the text and the identity of the embedder. Queries are cached in an in-memory LRU cache, and the chunks of the knowledge base are also stored in an sqlite file (``config['rag_embed_cache_path']``, an empty path disables it; the oldest vectors are evicted beyond ``config['rag_embed_cache_max_entries']``), so re-ingesting a mostly unchanged knowledge base only embeds the chunks which changed.
+
+Args:
+    embed (Callable): The embedding model.
+    identity (str, optional): The identity of the embedder. Taken from the model name and url of online embedding modules, and from ``base_model`` of TrainableModule together with its fine-tuned model path and deployed url, by default. For other callables the on-disk store is only used when it is given.
+    path (str, optional): The sqlite file of the on-disk store. Defaults to ``config['rag_embed_cache_path']``.
+    max_size (int, optional): The number of vectors kept in the LRU cache. Defaults to ``config['rag_embed_cache_size']``.
+''')
+
+add_chinese_doc('rag.EmbeddingCache', '''\
+按内容寻址的embedding缓存，Document 会自动用它包装传入的embed模型。
+
+向量以文本和embedding模型标识的哈希为键。查询缓存在内存中的LRU缓存里，知识库的切片还会保存到sqlite文件中（``config['rag_embed_cache_path']``，设为空则关闭；超过 ``config['rag_embed_cache_max_entries']`` 条时淘汰最早写入的向量），因此重新导入基本未变的知识库时只需要对变化的切片计算embedding。
+
+Args:
+    embed (Callable): embedding模型。
+    identity (str, optional): embedding模型的标识。默认取在线embedding模块的模型名和url，或 TrainableModule 的 ``base_model`` 及其微调模型路径和部署url，其他可调用对象只有指定该参数时才会使用磁盘缓存。
+    path (str, optional): 磁盘缓存的sqlite文件，默认为 ``config['rag_embed_cache_path']``。
+    max_size (int, optional): LRU缓存保存的向量个数，默认为 ``config['rag_embed_cache_size']``。
+''')
+
+add_example('rag.EmbeddingCache', '''\
+>>> from lazyllm.tools.rag import Document, EmbeddingCache
+>>> embed = EmbeddingCache(lambda text: [float(len(text)), 1.0], identity='len-embed-v1')
+>>> embed('hello')
+[5.0, 1.0]
+>>> documents = Document('your_doc_name', embed=embed)
+''')
+
+# ---------------------------------------------------------------------------- #
+
 # rag/rerank.py
 
 add_english_doc('Reranker', '''\
@@ -308,8 +364,10 @@ Args:
     group_name: The name of the node group on which to perform the retrieval.
     similarity: The similarity function to use for setting up document retrieval. Defaults to 'dummy'. Candidates include ["bm25", "bm25_chinese", "cosine"].
     similarity_cut_off: Discard the document when the similarity is below the specified value.
-    index: The type of index to use for document retrieval. Currently, only 'default' is supported.
-    topk: The number of documents to retrieve with the highest similarity.
+    index: The type of index to use for document retrieval. 'default' scans every node. 'ivf' (an inverted-file index built with numpy, or with faiss k-means when faiss is installed) and 'hnsw' (requires hnswlib) are approximate indices for the 'cosine' similarity. They are updated incrementally and persisted next to a chroma store. The recall/latency trade-off is set by passing ``nprobe`` (ivf) or ``ef`` (hnsw) as keyword arguments. 'store' delegates the 'cosine' search to the vector search of the store (the collections of a chroma store), and scores in memory for stores without one.
+    topk: The number of documents to retrieve with the highest similarity. When ``doc`` is a list of documents, they are searched concurrently and their results are merged into a single global top-k by score.
+    timeout: Seconds to wait for each document when ``doc`` is a list of documents. The results of the documents which are slower are dropped instead of delaying the answer. Defaults to ``config['rag_retriever_timeout']``, where 0 means waiting for all of them.
+    filters: Metadata filters, mapping a metadata key (e.g. ``file_name``) to the accepted value or a list of accepted values. Only the nodes whose metadata matches all keys are scored. They are looked up in an inverted index over the node metadata that the store maintains. Filters can also be passed per call, as in ``retriever(query, filters={...})``.
     similarity_kw: Additional parameters to pass to the similarity calculation function.
 
 The `group_name` has three built-in splitting strategies, all of which use `SentenceSplitter` for splitting, with the difference being in the chunk size:
@@ -327,8 +385,10 @@ Args:
     group_name: 在哪个 node group 上进行检索。
     similarity: 用于设置文档检索的相似度函数。默认为 'dummy'。候选集包括 ["bm25", "bm25_chinese", "cosine"]。
     similarity_cut_off: 当相似度低于指定值时丢弃该文档。
-    index: 用于文档检索的索引类型。目前仅支持 'default'。
-    topk: 表示取相似度最高的多少篇文档。
+    index: 用于文档检索的索引类型。'default' 会遍历所有节点。'ivf'（基于numpy实现的倒排索引，安装了faiss时用faiss做k-means）和 'hnsw'（需要安装hnswlib）是用于 'cosine' 相似度的近似索引，支持增量更新，并在使用chroma存储时持久化到存储旁边。可以通过关键字参数 ``nprobe``（ivf）或 ``ef``（hnsw）调节召回率与延迟的权衡。'store' 将 'cosine' 检索下推给存储自身的向量检索（chroma存储的collection），不支持向量检索的存储则在内存中打分。
+    topk: 表示取相似度最高的多少篇文档。当 ``doc`` 是多个文档时，各文档并发检索，结果按分数合并为全局的 top-k。
+    timeout: 当 ``doc`` 是多个文档时，等待每个文档的秒数，超时的文档的结果会被丢弃，而不会拖慢整个回答。默认为 ``config['rag_retriever_timeout']``，0 表示等待所有文档。
+    filters: 元数据过滤条件，将元数据的键（如 ``file_name``）映射为接受的值或值的列表。只有元数据满足所有条件的节点才会参与打分，匹配通过存储维护的节点元数据倒排索引完成。也可以在每次调用时传入，例如 ``retriever(query, filters={...})``。
     similarity_kw: 传递给 similarity 计算函数的其它参数。
 
 其中 `group_name` 有三个内置的切分策略，都是使用 `SentenceSplitter` 做切分，区别在于块大小不同：
@@ -349,6 +409,35 @@ add_example('Retriever', '''
 >>> print(rm("query"))
 ''')
 
+add_english_doc('Retriever.batch_forward', '''
+Retrieve the documents of several queries at once, e.g. for evaluation or query expansion. For the 'cosine' similarity, the queries are embedded in a single call of the embedding model and scored against the node group with one matrix-matrix product. Other similarities are retrieved query by query.
+
+Args:
+    queries (List[str]): The queries to retrieve.
+
+**Returns:**\n
+- List: One result per query, in the order of ``queries``, each of them the same as what calling the retriever with that query returns.
+''')
+
+add_chinese_doc('Retriever.batch_forward', '''
+一次检索多个查询的文档，例如用于评测或查询扩展。对于 'cosine' 相似度，所有查询只调用一次嵌入模型，并通过一次矩阵乘法与 node group 计算相似度；其它相似度逐个查询检索。
+
+Args:
+    queries (List[str]): 需要检索的查询列表。
+
+**Returns:**\n
+- List: 按 ``queries`` 的顺序返回每个查询的结果，与用该查询调用检索器的返回值相同。
+''')
+
+add_example('Retriever.batch_forward', '''
+>>> import lazyllm
+>>> from lazyllm.tools import Retriever, Document
+>>> m = lazyllm.OnlineEmbeddingModule()
+>>> documents = Document(dataset_path='your_doc_path', embed=m, manager=False)
+>>> rm = Retriever(documents, group_name='CoarseChunk', similarity='cosine', topk=3)
+>>> results = rm.batch_forward(["query 1", "query 2"])
+''')
+
 # ---------------------------------------------------------------------------- #
 
 # rag/transform.py
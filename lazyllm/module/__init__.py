@@ -1,7 +1,7 @@
 from .module import (ModuleBase, TrainableModule, ActionModule,
                      ServerModule, UrlModule, register)
 from .trialmodule import TrialModule
-from .onlineChatModule import OnlineChatModule, OnlineChatModuleBase
+from .onlineChatModule import OnlineChatModule, OnlineChatModuleBase, OnlineChatRouter
 from .onlineEmbedding import OnlineEmbeddingModule, OnlineEmbeddingModuleBase
 from .automodel import AutoModel
 
@@ -30,6 +30,7 @@ __all__ = [
     'TrialModule',
     "OnlineChatModule",
     "OnlineChatModuleBase",
+    "OnlineChatRouter",
     "OnlineEmbeddingModule",
     "OnlineEmbeddingModuleBase",
     "AutoModel",
@@ -0,0 +1,153 @@
+import os
+import json
+import time
+import threading
+from collections import deque
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+
+from lazyllm import LOG, ThreadPoolExecutor, encode_request, decode_request
+from lazyllm.common.ratelimit import TokenBucket
+
+
+def _estimate_tokens(x: Any) -> int:
+    # about four characters per token for english text, which is good enough for rate limiting
+    return max(1, len(str(x)) // 4)
+
+
+class BatchStats(object):
+    def __init__(self):
+        self.total = self.succeeded = self.failed = self.retried = self.resumed = 0
+        self.latencies: List[float] = []
+        self.start_time = time.time()
+        self.end_time = None
+
+    @property
+    def elapsed(self) -> float:
+        return (self.end_time or time.time()) - self.start_time
+
+    @property
+    def throughput(self) -> float:
+        return (self.succeeded + self.failed) / self.elapsed if self.elapsed > 0 else 0.0
+
+    def percentile(self, q: float) -> float:
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))] if latencies else 0.0
+
+    def to_dict(self) -> Dict[str, float]:
+        return dict(total=self.total, succeeded=self.succeeded, failed=self.failed, retried=self.retried,
+                    resumed=self.resumed, elapsed=round(self.elapsed, 3), throughput=round(self.throughput, 3),
+                    latency_mean=round(sum(self.latencies) / len(self.latencies), 3) if self.latencies else 0.0,
+                    latency_p50=round(self.percentile(0.5), 3), latency_p90=round(self.percentile(0.9), 3),
+                    latency_p99=round(self.percentile(0.99), 3))
+
+    def __repr__(self):
+        return f'BatchStats({", ".join(f"{k}={v}" for k, v in self.to_dict().items())})'
+
+
+class BatchRunner(object):
+    """Stream a (possibly huge) input set through ``func`` with bounded concurrency, request / token rate limits,
+    per-item retries and an append-only checkpoint file. Outputs are yielded in input order.
+
+    The checkpoint stores the outputs of finished items keyed by their position, so a run resumed with the same
+    checkpoint only calls ``func`` for the items that did not finish before.
+    """
+
+    def __init__(self, func: Callable, *, concurrency: int = 16, rpm: Optional[int] = None,
+                 tpm: Optional[int] = None, retries: int = 0, retry_delay: float = 1.0,
+                 checkpoint: Optional[str] = None, token_counter: Callable[[Any], int] = _estimate_tokens,
+                 on_error: str = 'raise', progress_interval: float = 10.0):
+        assert concurrency > 0, 'concurrency should be positive'
+        assert on_error in ('raise', 'skip'), 'on_error should be `raise` or `skip`'
+        self._func = func
+        self._concurrency = concurrency
+        self._rpm = TokenBucket(rpm) if rpm else None
+        self._tpm = TokenBucket(tpm) if tpm else None
+        self._retries, self._retry_delay = retries, retry_delay
+        self._checkpoint = checkpoint
+        self._token_counter = token_counter
+        self._on_error = on_error
+        self._progress_interval = progress_interval
+        self._lock = threading.Lock()
+        self.stats = BatchStats()
+        self._last_report = self.stats.start_time
+
+    def _load_checkpoint(self) -> Dict[int, Any]:
+        finished = {}
+        if self._checkpoint and os.path.exists(self._checkpoint):
+            with open(self._checkpoint) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                        finished[record['index']] = decode_request(record['output'])
+                    except Exception:
+                        LOG.warning(f'Skip broken checkpoint record in {self._checkpoint}')
+            LOG.info(f'Resume {len(finished)} finished items from checkpoint {self._checkpoint}')
+        return finished
+
+    def _save_checkpoint(self, index: int, output: Any) -> None:
+        if not self._checkpoint: return
+        line = json.dumps(dict(index=index, output=encode_request(output)))
+        with self._lock, open(self._checkpoint, 'a') as f:
+            f.write(line + '\n')
+
+    def _report(self, force: bool = False) -> None:
+        now = time.time()
+        if not force and now - self._last_report < self._progress_interval: return
+        self._last_report = now
+        s = self.stats
+        LOG.info(f'Batch progress: {s.succeeded + s.failed + s.resumed}/{s.total or "?"} done, {s.failed} failed, '
+                 f'{s.throughput:.2f} items/s, p50 latency {s.percentile(0.5):.3f}s')
+
+    def _call(self, index: int, item: Any) -> Any:
+        if self._tpm: self._tpm.acquire(self._token_counter(item))
+        for attempt in range(self._retries + 1):
+            if self._rpm: self._rpm.acquire()
+            start = time.perf_counter()
+            try:
+                output = self._func(item)
+            except Exception as e:
+                if attempt < self._retries:
+                    with self._lock: self.stats.retried += 1
+                    LOG.warning(f'Batch item {index} failed ({e}), retry {attempt + 1}/{self._retries}')
+                    time.sleep(self._retry_delay * 2 ** attempt)
+                    continue
+                with self._lock: self.stats.failed += 1
+                if self._on_error == 'raise': raise
+                LOG.error(f'Batch item {index} failed after {self._retries + 1} attempts: {e}')
+                return None
+            with self._lock:
+                self.stats.latencies.append(time.perf_counter() - start)
+                self.stats.succeeded += 1
+            if self._tpm: self._tpm.consume(self._token_counter(output))
+            self._save_checkpoint(index, output)
+            return output
+
+    def iter(self, inputs: Iterable) -> Iterator:
+        self.stats = BatchStats()
+        self._last_report = self.stats.start_time
+        if hasattr(inputs, '__len__'): self.stats.total = len(inputs)
+        finished, pending = self._load_checkpoint(), deque()
+        window = self._concurrency * 2
+        with ThreadPoolExecutor(max_workers=self._concurrency) as executor:
+            try:
+                for index, item in enumerate(inputs):
+                    if index in finished:
+                        f = Future()
+                        f.set_result(finished.pop(index))
+                        self.stats.resumed += 1
+                    else:
+                        f = executor.submit(self._call, index, item)
+                    pending.append(f)
+                    while pending and (len(pending) >= window or pending[0].done()):
+                        yield pending.popleft().result()
+                    self._report()
+                while pending:
+                    yield pending.popleft().result()
+            finally:
+                for f in pending: f.cancel()
+                self.stats.end_time = time.time()
+                self._report(force=True)
+
+    def run(self, inputs: Iterable) -> List:
+        return list(self.iter(inputs))
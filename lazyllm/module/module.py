@@ -9,8 +9,8 @@ import codecs
 import inspect
 import functools
 from datetime import datetime
-from lazyllm import ThreadPoolExecutor, FileSystemQueue
-from typing import Dict, List, Any, Union
+from lazyllm import FileSystemQueue
+from typing import Dict, List
 
 import lazyllm
 from lazyllm import FlatList, Option, launchers, LOG, package, kwargs, encode_request, globals
@@ -20,6 +20,8 @@ from ..components.utils import ModelManager
 from ..flow import FlowBase, Pipeline, Parallel
 import uuid
 from ..client import get_redis, redis_client
+from .batch import BatchRunner
+from .toolcall import ToolCallParser
 
 
 class ModuleBase(object):
@@ -50,6 +52,7 @@ class ModuleBase(object):
         self._module_name = None
         self._options = []
         self.eval_result = None
+        self.batch_stats = None
 
     def __setattr__(self, name: str, value):
         if isinstance(value, ModuleBase):
@@ -114,7 +117,7 @@ class ModuleBase(object):
     @property
     def submodules(self): return self._submodules
 
-    def evalset(self, evalset, load_f=None, collect_f=lambda x: x):
+    def evalset(self, evalset, load_f=None, collect_f=lambda x: x, **batch_kw):
         if isinstance(evalset, str) and os.path.exists(evalset):
             with open(evalset) as f:
                 assert callable(load_f)
@@ -122,16 +125,24 @@ class ModuleBase(object):
         else:
             self._evalset = evalset
         self.eval_result_collet_f = collect_f
+        self._evalset_batch_kw = dict(dict(concurrency=100), **batch_kw)
+
+    def batch(self, inputs, *, concurrency: int = 16, rpm: int = None, tpm: int = None, retries: int = 0,
+              checkpoint: str = None, on_error: str = 'raise', **kw):
+        runner = BatchRunner(lambda item: self(**item) if isinstance(item, dict) else self(item),
+                             concurrency=concurrency, rpm=rpm, tpm=tpm, retries=retries,
+                             checkpoint=checkpoint, on_error=on_error, **kw)
+        try:
+            return runner.run(inputs)
+        finally:
+            self.batch_stats = runner.stats
 
     # TODO: add lazyllm.eval
     def _get_eval_tasks(self):
         def set_result(x): self.eval_result = x
 
         def parallel_infer():
-            with ThreadPoolExecutor(max_workers=100) as executor:
-                results = list(executor.map(lambda item: self(**item)
-                                            if isinstance(item, dict) else self(item), self._evalset))
-            return results
+            return self.batch(self._evalset, **self._evalset_batch_kw)
         if self._evalset:
             return Pipeline(parallel_infer,
                             lambda x: self.eval_result_collet_f(x),
@@ -232,6 +243,7 @@ class UrlModule(ModuleBase, UrlTemplate):
         self._extract_result_func = lambda x: x
         self._stream_parse_parameters = {}
         self._stream_url_suffix = ''
+        self._tool_call_callback = None
         __class__.prompt(self)
         __class__.formatter(self)
 
@@ -292,8 +304,7 @@ class UrlModule(ModuleBase, UrlTemplate):
             if "stream" in data: data['stream'] = stream_output
         parse_parameters = self._stream_parse_parameters if stream_output else {"delimiter": b"<|lazyllm_delimiter|>"}
 
-        token = getattr(self, "_tool_start_token", '')
-        cache = ""
+        parser = self._tool_call_parser(self._tool_call_callback) if stream_output or self._tool_call_callback else None
 
         # context bug with httpx, so we use requests
         with requests.post(url, json=data, stream=True, headers=headers) as r:
@@ -312,20 +323,14 @@ class UrlModule(ModuleBase, UrlTemplate):
                     else:
                         messages = chunk
 
-                    if not stream_output: continue
-                    if not cache:
-                        if token.startswith(chunk.lstrip('\n') if not token.startswith('\n') else chunk) \
-                           or token in chunk: cache = chunk
-                        else: FileSystemQueue().enqueue(chunk)
-                    elif token in cache:
-                        stream_output = False
-                        if not cache.startswith(token): FileSystemQueue().enqueue(cache.split(token)[0])
-                    else:
-                        cache += chunk
-                        if not (token.startswith(cache.lstrip('\n') if not token.startswith('\n') else cache)
-                                or token in cache):
-                            FileSystemQueue().enqueue(cache)
-                            cache = ""
+                    if not parser or not isinstance(chunk, str): continue
+                    # content is streamed as soon as it cannot be part of a tool call; tool calls are reported
+                    # to the callback once their arguments are complete
+                    text, _ = parser.feed(chunk)
+                    if stream_output and text: FileSystemQueue().enqueue(text)
+                if parser:
+                    text, _ = parser.close()
+                    if stream_output and text: FileSystemQueue().enqueue(text)
             else:
                 raise requests.RequestException('\n'.join([c.decode('utf-8') for c in r.iter_content(None)]))
             return self._formatter.format(self._extract_and_format(messages))
@@ -342,6 +347,13 @@ class UrlModule(ModuleBase, UrlTemplate):
     def _extract_and_format(self, output: str) -> str:
         return output
 
+    def _tool_call_parser(self, on_tool_call=None) -> ToolCallParser:
+        return ToolCallParser(on_tool_call=on_tool_call)
+
+    def on_tool_call(self, callback):
+        self._tool_call_callback = callback
+        return self
+
     def formatter(self, format: FormatterBase = None):
         if isinstance(format, FormatterBase):
             self._formatter = format
@@ -653,106 +665,13 @@ class TrainableModule(UrlModule):
                 if key in keys: setattr(self, f"_{key}", keys[key])
         return self
 
-    def _loads_str(self, text: str) -> Union[str, Dict]:
-        try:
-            ret = json.loads(text)
-            return self._loads_str(ret) if isinstance(ret, str) else ret
-        except Exception:
-            LOG.error(f"{text} is not a valid json string.")
-            return text
-
-    def _parse_arguments_with_args_token(self, output: str) -> tuple[str, dict]:
-        items = output.split(self._tool_args_token)
-        func_name = items[0].strip()
-        if len(items) == 1:
-            return func_name.split(self._tool_end_token)[0].strip() if getattr(self, "_tool_end_token", None)\
-                else func_name, {}
-        args = (items[1].split(self._tool_end_token)[0].strip() if getattr(self, "_tool_end_token", None)
-                else items[1].strip())
-        return func_name, self._loads_str(args) if isinstance(args, str) else args
-
-    def _parse_arguments_without_args_token(self, output: str) -> tuple[str, dict]:
-        items = output.split(self._tool_end_token)[0] if getattr(self, "_tool_end_token", None) else output
-        func_name = ""
-        args = {}
-        try:
-            items = json.loads(items.strip())
-            func_name = items.get('name', '')
-            args = items.get("parameters", items.get("arguments", {}))
-        except Exception:
-            LOG.error(f"tool calls info {items} parse error")
-
-        return func_name, self._loads_str(args) if isinstance(args, str) else args
-
-    def _parse_arguments_with_tools(self, output: Dict[str, Any], tools: List[str]) -> bool:
-        func_name = ''
-        args = {}
-        is_tc = False
-        tc = {}
-        if output.get('name', '') in tools:
-            is_tc = True
-            func_name = output.get('name', '')
-            args = output.get("parameters", output.get("arguments", {}))
-            tc = {'name': func_name, 'arguments': self._loads_str(args) if isinstance(args, str) else args}
-            return is_tc, tc
-        return is_tc, tc
-
-    def _parse_tool_start_token(self, output: str) -> tuple[str, List[Dict]]:
-        tool_calls = []
-        segs = output.split(self._tool_start_token)
-        content = segs[0]
-        for seg in segs[1:]:
-            func_name, arguments = self._parse_arguments_with_args_token(seg.strip())\
-                if getattr(self, "_tool_args_token", None)\
-                else self._parse_arguments_without_args_token(seg.strip())
-            if func_name:
-                tool_calls.append({"name": func_name, "arguments": arguments})
-
-        return content, tool_calls
-
-    def _parse_tools(self, output: str) -> tuple[str, List[Dict]]:
-        tool_calls = []
-        tools = {tool['function']['name'] for tool in self._tools}
-        lines = output.strip().split("\n")
-        content = []
-        is_tool_call = False
-        for idx, line in enumerate(lines):
-            if line.startswith("{") and idx > 0:
-                func_name = lines[idx - 1].strip()
-                if func_name in tools:
-                    is_tool_call = True
-                    if func_name == content[-1].strip():
-                        content.pop()
-                    arguments = "\n".join(lines[idx:]).strip()
-                    tool_calls.append({'name': func_name, "arguments": arguments})
-                    continue
-            if "{" in line and 'name' in line:
-                try:
-                    items = json.loads(line.strip())
-                    items = [items] if isinstance(items, dict) else items
-                    if isinstance(items, list):
-                        for item in items:
-                            is_tool_call, tc = self._parse_arguments_with_tools(item, tools)
-                            if is_tool_call:
-                                tool_calls.append(tc)
-                except Exception:
-                    LOG.error(f"tool calls info {line} parse error")
-            if not is_tool_call:
-                content.append(line)
-        content = "\n".join(content) if len(content) > 0 else ''
-        return content, tool_calls
+    def _tool_call_parser(self, on_tool_call=None) -> ToolCallParser:
+        return ToolCallParser(getattr(self, '_tool_start_token', None), getattr(self, '_tool_args_token', None),
+                              getattr(self, '_tool_end_token', None),
+                              [tool['function']['name'] for tool in self._tools or []], on_tool_call)
 
     def _extract_tool_calls(self, output: str) -> tuple[str, List[Dict]]:
-        tool_calls = []
-        content = ''
-        if getattr(self, "_tool_start_token", None) and self._tool_start_token in output:
-            content, tool_calls = self._parse_tool_start_token(output)
-        elif self._tools:
-            content, tool_calls = self._parse_tools(output)
-        else:
-            content = output
-
-        return content, tool_calls
+        return self._tool_call_parser().parse(output)
 
     def _build_response(self, content: str, tool_calls: List[Dict[str, str]]) -> str:
         tc = [{'id': str(uuid.uuid4().hex), 'type': 'function', 'function': tool_call} for tool_call in tool_calls]
@@ -772,6 +691,7 @@ class TrainableModule(UrlModule):
             b. If 'tool_start_token' does not exist, the text is segmented using '\n' according to the incoming tools
                information, and then processed according to the rules.
         """
+        if not isinstance(output, str): return output  # e.g. the numpy arrays returned by embedding models
         content, tool_calls = self._extract_tool_calls(output)
         return self._build_response(content, tool_calls)
 
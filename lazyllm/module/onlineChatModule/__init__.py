@@ -1,7 +1,9 @@
 from .onlineChatModule import OnlineChatModule
 from .onlineChatModuleBase import OnlineChatModuleBase
+from .onlineChatRouter import OnlineChatRouter
 
 __all__ = [
     "OnlineChatModule",
-    "OnlineChatModuleBase"
+    "OnlineChatModuleBase",
+    "OnlineChatRouter"
 ]
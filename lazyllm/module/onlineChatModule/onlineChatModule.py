@@ -7,11 +7,12 @@ from .sensenovaModule import SenseNovaModule
 from .qwenModule import QwenModule
 from .doubaoModule import DoubaoModule
 from .onlineChatModuleBase import OnlineChatModuleBase
+from .onlineChatRouter import OnlineChatRouter
 
 class _ChatModuleMeta(type):
 
     def __instancecheck__(self, __instance: Any) -> bool:
-        if isinstance(__instance, OnlineChatModuleBase):
+        if isinstance(__instance, (OnlineChatModuleBase, OnlineChatRouter)):
             return True
         return super().__instancecheck__(__instance)
 
@@ -1,6 +1,6 @@
 import copy
-from itertools import groupby
 import json
+import contextvars
 import os
 import requests
 import re
@@ -8,9 +8,15 @@ from typing import Tuple, List, Dict, Union, Any
 import time
 import lazyllm
 from lazyllm import globals, FileSystemQueue
+from lazyllm.common.ratelimit import get_rate_limiter, limited_request
 from lazyllm.components.prompter import PrompterBase, ChatPrompter
 from lazyllm.components.formatter import FormatterBase, EmptyFormatter
 from ..module import ModuleBase, Pipeline
+from .streamAccumulator import StreamAccumulator
+
+# Set by OnlineChatRouter around the requests it issues, so that it can observe the first chunk of every stream,
+# decide which stream reaches the user and cancel the others.
+_stream_observer = contextvars.ContextVar('lazyllm_online_chat_stream_observer', default=None)
 
 class OnlineChatModuleBase(ModuleBase):
 
@@ -39,6 +45,8 @@ class OnlineChatModuleBase(ModuleBase):
         self.formatter()
         self._field_extractor()
         self._model_optional_params = {}
+        self._limiter = get_rate_limiter(*self._rate_limit_key())
+        self._max_retries = 3
 
     @property
     def series(self):
@@ -70,6 +78,15 @@ class OnlineChatModuleBase(ModuleBase):
     def _get_system_prompt(self):
         raise NotImplementedError("_get_system_prompt is not implemented.")
 
+    def _rate_limit_key(self):
+        return self._model_series, self._api_key
+
+    def rate_limit(self, rpm: int = None, tpm: int = None, max_concurrency: int = None, max_retries: int = None):
+        # the limits are shared by all modules using the same provider and api key
+        self._limiter.update(rpm=rpm, tpm=tpm, max_concurrency=max_concurrency)
+        if max_retries is not None: self._max_retries = max_retries
+        return self
+
     def _set_headers(self):
         self._headers = {
             'Content-Type': 'application/json',
@@ -124,16 +141,20 @@ class OnlineChatModuleBase(ModuleBase):
 
     def _str_to_json(self, msg: str):
         if isinstance(msg, bytes):
-            pattern = re.compile(r"^data:\s*")
-            msg = re.sub(pattern, "", msg.decode('utf-8'))
+            if msg.startswith(b'data:'): msg = msg[5:].lstrip()
+            if not msg or msg == b'[DONE]': return ""
         try:
             chunk = json.loads(msg)
             message = self._convert_msg_format(chunk)
             if self._stream:
+                observer = _stream_observer.get()
                 for item in message.get("choices", []):
                     delta = item.get("delta", {})
                     content = delta.get("content", '')
-                    if content and "tool_calls" not in delta: FileSystemQueue().enqueue(content)
+                    if content and "tool_calls" not in delta:
+                        if observer: observer.on_content(content)
+                        else: FileSystemQueue().enqueue(content)
+                if observer: observer.on_chunk()
             lazyllm.LOG.debug(f"message: {message}")
             return message
         except Exception:
@@ -207,33 +228,15 @@ class OnlineChatModuleBase(ModuleBase):
         else:
             return json.dumps(self._parse_output_by_key(".", response), ensure_ascii=False)
 
+    def _stream_accumulator(self):
+        return StreamAccumulator(cumulative=bool(self._model_optional_params)
+                                 and not self._model_optional_params.get("incremental_output", True))
+
     def _merge_stream_result(self, src: List[str | int | list | dict]):
-        types = set(type(ele) for ele in src if ele is not None)
-        assert len(src) > 0 and len(types) <= 1, f"The elements in the list: {src} are of inconsistent types"
-        if len(src) == 1:
-            return src[0]
-        if all(isinstance(ele, str) or ele is None for ele in src):
-            if all(ele == src[-1] or ele is None for ele in src) or (self._model_optional_params
-               and not self._model_optional_params.get("incremental_output", True)):
-                return src[-1]
-            else:
-                return "".join(ele for ele in src if ele is not None)
-        elif all(isinstance(ele, list) for ele in src):
-            assert all(len(src[-1]) == len(ele) for ele in src), f"The lists of elements: {src} have different lengths."
-            ret = [self._merge_stream_result([ele[idx] for ele in src]) for idx in range(len(src[-1]))]
-            return ret[0] if isinstance(ret[0], list) else ret
-        elif all(isinstance(ele, dict) for ele in src):
-            if "index" in src[-1]:  # If there are multiple index values that need to be appended.
-                data_sorted = sorted(src, key=lambda x: x['index'])
-                grouped_data = [list(g) for k, g in groupby(data_sorted, key=lambda x: x['index'])]
-                if len(grouped_data) > 1:
-                    return [self._merge_stream_result(src) for src in grouped_data]
-            return {k: "tool_calls" if k == "finish_reason" and "tool_calls" in [d[k] for d in src if k in d]
-                    else self._merge_stream_result([d[k] for d in src if k in d]) for k in set().union(*src)}
-        elif all(isinstance(ele, int) for ele in src):
-            return src[-1] if all(ele == src[-1] for ele in src) else src[-1]
-        else:
-            raise TypeError(f"The elements in list {src} are of inconsistent types.")
+        assert len(src) > 0, "The stream result to merge is empty"
+        accumulator = self._stream_accumulator()
+        for chunk in src: accumulator.add(chunk)
+        return accumulator.message
 
     def forward(self, __input: Union[Dict, str] = None, *, llm_chat_history: List[List[str]] = None, tools: List[Dict[str, Any]] = None, **kw):  # noqa C901
         """LLM inference interface"""
@@ -251,14 +254,24 @@ class OnlineChatModuleBase(ModuleBase):
         if len(self._model_optional_params) > 0:
             data.update(self._model_optional_params)
 
-        with requests.post(self._url, json=data, headers=self._headers, stream=self._stream) as r:
+        tokens = len(json.dumps(data.get("messages", data), ensure_ascii=False)) // 4
+        with limited_request(self._limiter, lambda: requests.post(self._url, json=data, headers=self._headers,
+                                                                  stream=self._stream),
+                             tokens=tokens, max_retries=self._max_retries,
+                             retry_exceptions=(requests.ConnectionError, requests.Timeout)) as r:
             if r.status_code != 200:  # request error
                 raise requests.RequestException('\n'.join([c.decode('utf-8') for c in r.iter_content(None)])) \
                     if self._stream else requests.RequestException(r.text)
 
-            msg_json = list(filter(lambda x: x, [self._str_to_json(line) for line in r.iter_lines()
-                                                 if len(line)] if self._stream else [self._str_to_json(r.text)]))
-            extractor = self._extract_specified_key_fields(self._merge_stream_result(msg_json))
+            accumulator, observer = self._stream_accumulator(), _stream_observer.get()
+            for line in (r.iter_lines() if self._stream else [r.text]):
+                if observer and observer.cancelled: return ""
+                if len(line) and (chunk := self._str_to_json(line)): accumulator.add(chunk)
+            assert accumulator.count > 0, "The response of the chat service is empty"
+            message = accumulator.message
+            extractor = self._extract_specified_key_fields(message)
+            usage = message.get("usage") if isinstance(message, dict) else None
+            self._limiter.consume((usage or {}).get("completion_tokens") or len(str(extractor)) // 4)
 
             return self._formatter.format(extractor) if extractor else ""
 
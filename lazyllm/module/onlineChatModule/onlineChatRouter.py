@@ -0,0 +1,205 @@
+import random
+import threading
+import time
+from typing import List, Optional
+
+import lazyllm
+from lazyllm import globals, FileSystemQueue, LOG
+from lazyllm.components.prompter import PrompterBase
+from lazyllm.components.formatter import FormatterBase
+from ..module import ModuleBase
+from .onlineChatModuleBase import _stream_observer
+
+
+class _BackendHealth(object):
+    def __init__(self):
+        self.latency = None  # ewma of the time to the first chunk (or to the response for non-stream backends)
+        self.failures = 0
+        self.down_until = 0.0
+        self.requests = self.errors = self.hedged = 0
+
+
+class _Attempt(object):
+    # one request to one backend; on_chunk / on_content are called by the backend from the request thread
+    def __init__(self, idx: int, cond: threading.Condition):
+        self.idx, self._cond = idx, cond
+        self.start = time.monotonic()
+        self.first_chunk = None
+        self.done = self.winner = self.cancelled = False
+        self.result, self.error = None, None
+        self._buffer: List[str] = []
+
+    def on_chunk(self):
+        if self.first_chunk is not None: return
+        with self._cond:
+            self.first_chunk = time.monotonic()
+            self._cond.notify_all()
+
+    def on_content(self, content: str):
+        with self._cond:
+            if self.winner: FileSystemQueue().enqueue(content)
+            elif not self.cancelled: self._buffer.append(content)
+
+    def win(self):
+        # called with the condition held, so no content can be enqueued in between
+        self.winner = True
+        for content in self._buffer: FileSystemQueue().enqueue(content)
+        self._buffer = []
+
+    @property
+    def responded(self) -> bool:
+        return self.first_chunk is not None or (self.done and self.error is None)
+
+
+class OnlineChatRouter(ModuleBase):
+    """Route requests over several online chat modules (providers, regions or api keys).
+
+    Every request goes to a healthy backend chosen at random with a probability proportional to ``weights`` divided
+    by the backend's average time to first chunk. A backend which fails ``max_failures`` times in a row is skipped
+    for ``cooldown`` seconds, and a failed request is retried on another backend. If ``hedge_delay`` is set and no
+    chunk arrived within that many seconds, a backup request is sent to another backend; the first backend to
+    respond wins, its stream is forwarded to the user and the other requests are cancelled.
+    """
+
+    def __init__(self, backends: List[ModuleBase], *, weights: Optional[List[float]] = None,
+                 hedge_delay: Optional[float] = None, max_attempts: Optional[int] = None, max_failures: int = 3,
+                 cooldown: float = 30.0, ewma_alpha: float = 0.3, return_trace: bool = False):
+        super().__init__(return_trace=return_trace)
+        assert len(backends) > 0, 'At least one backend is required'
+        assert weights is None or len(weights) == len(backends), 'weights should match backends'
+        self._backends = list(backends)
+        self._submodules.extend(self._backends)
+        self._weights = list(weights) if weights else [1.0] * len(backends)
+        self._hedge_delay = hedge_delay
+        self._max_attempts = min(max_attempts or len(backends), len(backends))
+        self._max_failures, self._cooldown, self._alpha = max_failures, cooldown, ewma_alpha
+        self._health = [_BackendHealth() for _ in backends]
+        self._lock = threading.Lock()
+
+    @property
+    def series(self):
+        return self._backends[0].series
+
+    @property
+    def type(self):
+        return "LLM"
+
+    @property
+    def _stream(self):
+        return any(getattr(b, '_stream', False) for b in self._backends)
+
+    @property
+    def backends(self):
+        return self._backends
+
+    def prompt(self, prompt: PrompterBase = None):
+        for b in self._backends: b.prompt(prompt)
+        return self
+
+    def formatter(self, format: FormatterBase = None):
+        for b in self._backends: b.formatter(format)
+        return self
+
+    def share(self, prompt: PrompterBase = None, format: FormatterBase = None):
+        # shared routers send requests to the same endpoints, so they share the health of the backends as well
+        new = OnlineChatRouter([b.share(prompt=prompt, format=format) for b in self._backends],
+                               weights=self._weights, hedge_delay=self._hedge_delay,
+                               max_attempts=self._max_attempts, max_failures=self._max_failures,
+                               cooldown=self._cooldown, ewma_alpha=self._alpha, return_trace=self._return_trace)
+        new._health, new._lock = self._health, self._lock
+        return new
+
+    def _select(self, exclude) -> Optional[int]:
+        with self._lock:
+            now = time.monotonic()
+            candidates = [i for i in range(len(self._backends)) if i not in exclude]
+            if not candidates: return None
+            healthy = [i for i in candidates if self._health[i].down_until <= now]
+            # every backend is cooling down: probe the one which recovers first rather than failing the request
+            if not healthy: return min(candidates, key=lambda i: self._health[i].down_until)
+            known = [h.latency for h in self._health if h.latency is not None]
+            prior = sum(known) / len(known) if known else 1.0
+            weights = [self._weights[i] / max(self._health[i].latency or prior, 1e-3) for i in healthy]
+            return random.choices(healthy, weights=weights)[0]
+
+    def _record(self, attempt: _Attempt) -> None:
+        with self._lock:
+            h = self._health[attempt.idx]
+            h.requests += 1
+            if attempt.first_chunk is not None or (attempt.done and attempt.error is None):
+                latency = (attempt.first_chunk or time.monotonic()) - attempt.start
+            elif attempt.cancelled:
+                # lost the race before responding: its latency is at least the time it has waited so far
+                latency = time.monotonic() - attempt.start
+            else:
+                latency = None
+            if latency is not None:
+                h.latency = latency if h.latency is None else self._alpha * latency + (1 - self._alpha) * h.latency
+            if attempt.error is not None and not attempt.cancelled:
+                h.errors += 1
+                h.failures += 1
+                if h.failures >= self._max_failures:
+                    h.down_until = time.monotonic() + self._cooldown
+                    LOG.warning(f'Backend {attempt.idx} of {self.name or "OnlineChatRouter"} failed {h.failures} '
+                                f'times in a row, skip it for {self._cooldown}s')
+            elif attempt.error is None and not attempt.cancelled:
+                h.failures, h.down_until = 0, 0.0
+
+    def _launch(self, attempts, tried, cond, args, kw) -> bool:
+        idx = self._select(tried)
+        if idx is None: return False
+        tried.add(idx)
+        attempt, sid = _Attempt(idx, cond), globals._sid
+        attempts.append(attempt)
+
+        def impl():
+            globals._init_sid(sid)
+            _stream_observer.set(attempt)
+            try:
+                attempt.result = self._backends[idx](*args, **kw)
+            except Exception as e:
+                attempt.error = e
+            with cond:
+                attempt.done = True
+                cond.notify_all()
+            self._record(attempt)
+
+        threading.Thread(target=impl, daemon=True).start()
+        return True
+
+    def forward(self, *args, **kw):
+        cond, attempts, tried = threading.Condition(), [], set()
+        with cond:
+            if not self._launch(attempts, tried, cond, args, kw): raise RuntimeError('No backend is available')
+            while not (winner := next((a for a in attempts if a.responded), None)):
+                if all(a.done for a in attempts):
+                    LOG.warning(f'Backend {attempts[-1].idx} failed: {attempts[-1].error}')
+                    if len(tried) >= self._max_attempts or not self._launch(attempts, tried, cond, args, kw):
+                        raise attempts[-1].error
+                    continue
+                timeout = None
+                if self._hedge_delay is not None and len(tried) < self._max_attempts:
+                    timeout = attempts[-1].start + self._hedge_delay - time.monotonic()
+                    if timeout <= 0:
+                        if self._launch(attempts, tried, cond, args, kw):
+                            with self._lock: self._health[attempts[-2].idx].hedged += 1
+                            continue
+                        timeout = None
+                cond.wait(timeout)
+            winner.win()
+            for a in attempts:
+                if a is not winner: a.cancelled = True
+            while not winner.done: cond.wait()
+        if winner.error is not None: raise winner.error
+        return winner.result
+
+    def status(self) -> List[dict]:
+        with self._lock:
+            now = time.monotonic()
+            return [dict(backend=repr(b).split('\n')[0], latency=h.latency, healthy=h.down_until <= now,
+                         requests=h.requests, errors=h.errors, hedged=h.hedged)
+                    for b, h in zip(self._backends, self._health)]
+
+    def __repr__(self):
+        return lazyllm.make_repr('Module', 'OnlineChatRouter', name=self._module_name, subs=[repr(b) for b in
+                                 self._backends], hedge_delay=self._hedge_delay, return_trace=self._return_trace)
@@ -32,6 +32,10 @@ class SenseNovaModule(OnlineChatModuleBase, FileHandlerBase):
     def _get_system_prompt(self):
         return "You are an AI assistant, developed by SenseTime."
 
+    def _rate_limit_key(self):
+        # the jwt token is regenerated for every module, limits belong to the access key
+        return self._model_series, lazyllm.config['sensenova_api_key']
+
     @staticmethod
     def encode_jwt_token(ak: str, sk: str) -> str:
         headers = {
@@ -0,0 +1,113 @@
+from typing import Any, Dict, List, Optional
+
+
+class _Node(object):
+    def __init__(self, cumulative: bool):
+        self._cumulative = cumulative
+
+    @staticmethod
+    def create(value: Any, cumulative: bool) -> '_Node':
+        cls = _DictNode if isinstance(value, dict) else _ListNode if isinstance(value, list) \
+            else _StrNode if isinstance(value, str) else _ValueNode
+        node = cls(cumulative)
+        node.add(value)
+        return node
+
+    def accepts(self, value: Any) -> bool: raise NotImplementedError
+    def add(self, value: Any) -> None: raise NotImplementedError
+    def value(self) -> Any: raise NotImplementedError
+
+
+class _ValueNode(_Node):
+    def accepts(self, value): return not isinstance(value, (dict, list, str))
+    def add(self, value): self._value = value
+    def value(self): return self._value
+
+
+class _StrNode(_Node):
+    # deltas are concatenated, except for fields repeated verbatim in every chunk (e.g. id, role, model)
+    def __init__(self, cumulative):
+        super().__init__(cumulative)
+        self._first, self._count = '', 0  # while every part is the same: the part and how often it came
+        self._parts: Optional[List[str]] = None  # the parts, once they differ
+
+    def accepts(self, value): return isinstance(value, str)
+
+    def add(self, value):
+        if self._cumulative: self._first, self._count = value, 1
+        elif self._parts is not None: self._parts.append(value)
+        elif self._count == 0 or value == self._first: self._first, self._count = value, self._count + 1
+        else: self._parts = [self._first * self._count, value]
+
+    def value(self):
+        if self._parts is None: return self._first
+        # joining the parts does not change the value, so later reads and deltas only pay for the new parts
+        if len(self._parts) > 1: self._parts = [''.join(self._parts)]
+        return self._parts[0]
+
+
+class _DictNode(_Node):
+    def __init__(self, cumulative):
+        super().__init__(cumulative)
+        self._items: Dict[str, _Node] = {}
+        self._tool_calls_finished = False
+
+    def accepts(self, value): return isinstance(value, dict)
+
+    def add(self, value):
+        for k, v in value.items():
+            if k == 'finish_reason' and v == 'tool_calls': self._tool_calls_finished = True
+            node = self._items.get(k)
+            if v is None:
+                if node is None: self._items[k] = _Node.create(None, self._cumulative)
+            elif node is None or not node.accepts(v) or (isinstance(node, _ValueNode) and node.value() is None):
+                self._items[k] = _Node.create(v, self._cumulative)
+            else:
+                node.add(v)
+
+    def value(self):
+        ret = {k: n.value() for k, n in self._items.items()}
+        if self._tool_calls_finished: ret['finish_reason'] = 'tool_calls'
+        return ret
+
+
+class _ListNode(_Node):
+    # items carrying an ``index`` (choices, tool calls) are merged by index, other items by position
+    def __init__(self, cumulative):
+        super().__init__(cumulative)
+        self._items: Dict[tuple, _Node] = {}
+
+    def accepts(self, value): return isinstance(value, list)
+
+    def add(self, value):
+        for pos, v in enumerate(value):
+            key = (0, v['index']) if isinstance(v, dict) and isinstance(v.get('index'), int) else (1, pos)
+            node = self._items.get(key)
+            if node is None or not node.accepts(v): self._items[key] = _Node.create(v, self._cumulative)
+            else: node.add(v)
+
+    def value(self):
+        return [self._items[k].value() for k in sorted(self._items)]
+
+
+class StreamAccumulator(object):
+    """Merges the chunks of a streamed chat completion into one message as they arrive.
+
+    Every chunk is merged in time proportional to its own size, so the cost of the whole stream is linear in the
+    length of the output, and ``message`` returns the message merged so far at any point of the stream. With
+    ``cumulative=True`` each chunk carries the full text generated so far instead of a delta.
+    """
+
+    def __init__(self, cumulative: bool = False):
+        self._cumulative = cumulative
+        self._root: Optional[_Node] = None
+        self.count = 0
+
+    def add(self, chunk: Any) -> None:
+        if self._root is None or not self._root.accepts(chunk): self._root = _Node.create(chunk, self._cumulative)
+        else: self._root.add(chunk)
+        self.count += 1
+
+    @property
+    def message(self) -> Any:
+        return self._root.value() if self._root else None
@@ -34,8 +34,10 @@ class OnlineEmbeddingModule(metaclass=__EmbedModuleMeta):
     def __new__(self,
                 source: str = None,
                 embed_url: str = None,
-                embed_model_name: str = None):
+                embed_model_name: str = None,
+                **kwargs):
         params = OnlineEmbeddingModule._encapsulate_parameters(embed_url, embed_model_name)
+        params.update(kwargs)
 
         if source is None:
             for source in OnlineEmbeddingModule.MODELS.keys():
@@ -1,21 +1,31 @@
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Union
 import requests
+from lazyllm import ThreadPoolExecutor
+from lazyllm.common.ratelimit import get_rate_limiter, limited_request
 from ..module import ModuleBase
 
 class OnlineEmbeddingModuleBase(ModuleBase):
+    # the maximum number of texts the platform accepts in one request
+    MAX_BATCH_SIZE = 16
 
     def __init__(self,
                  model_series: str,
                  embed_url: str,
                  api_key: str,
                  embed_model_name: str,
-                 return_trace: bool = False):
+                 return_trace: bool = False,
+                 batch_size: int = None,
+                 num_workers: int = 8):
         super().__init__(return_trace=return_trace)
         self._model_series = model_series
         self._embed_url = embed_url
         self._api_key = api_key
         self._embed_model_name = embed_model_name
+        self._batch_size = min(batch_size or self.MAX_BATCH_SIZE, self.MAX_BATCH_SIZE)
+        self._num_workers = num_workers
         self._set_headers()
+        self._limiter = get_rate_limiter(*self._rate_limit_key())
+        self._max_retries = 3
 
     @property
     def series(self):
@@ -31,14 +41,42 @@ class OnlineEmbeddingModuleBase(ModuleBase):
             "Authorization": f"Bearer {self._api_key}"
         }
 
-    def forward(self, text: str, **kwargs) -> List[float]:
+    def _rate_limit_key(self):
+        return self._model_series, self._api_key
+
+    def rate_limit(self, rpm: int = None, tpm: int = None, max_concurrency: int = None, max_retries: int = None):
+        # the limits are shared by all modules using the same provider and api key
+        self._limiter.update(rpm=rpm, tpm=tpm, max_concurrency=max_concurrency)
+        if max_retries is not None: self._max_retries = max_retries
+        return self
+
+    def _request(self, text: Union[str, List[str]], **kwargs) -> Dict[str, Any]:
         data = self._encapsulated_data(text, **kwargs)
-        with requests.post(self._embed_url, json=data, headers=self._headers) as r:
+        tokens = sum(len(t) for t in text) // 4 + 1 if isinstance(text, list) else len(str(text)) // 4 + 1
+        with limited_request(self._limiter, lambda: requests.post(self._embed_url, json=data, headers=self._headers),
+                             tokens=tokens, max_retries=self._max_retries,
+                             retry_exceptions=(requests.ConnectionError, requests.Timeout)) as r:
             if r.status_code == 200:
-                return self._parse_response(r.json())
+                return r.json()
             else:
                 raise requests.RequestException('\n'.join([c.decode('utf-8') for c in r.iter_content(None)]))
 
+    def _embed_batch(self, texts: List[str], **kwargs) -> List[List[float]]:
+        embeddings = self._parse_batch_response(self._request(texts, **kwargs))
+        assert len(embeddings) == len(texts), f'Expect {len(texts)} embeddings, but got {len(embeddings)}'
+        return embeddings
+
+    def forward(self, text: Union[str, List[str]], **kwargs) -> Union[List[float], List[List[float]]]:
+        if not isinstance(text, list):
+            return self._parse_response(self._request(text, **kwargs))
+        batches = [text[i:i + self._batch_size] for i in range(0, len(text), self._batch_size)]
+        if len(batches) <= 1:
+            return self._embed_batch(batches[0], **kwargs) if batches else []
+        # batches are sent concurrently, each of them still goes through the rate limiter of the api key
+        with ThreadPoolExecutor(max_workers=min(self._num_workers, len(batches))) as executor:
+            futures = [executor.submit(self._embed_batch, batch, **kwargs) for batch in batches]
+            return [embedding for future in futures for embedding in future.result()]
+
     def _encapsulated_data(self, text: str, **kwargs) -> Dict[str, str]:
         json_data = {
             "input": text,
@@ -51,3 +89,6 @@ class OnlineEmbeddingModuleBase(ModuleBase):
 
     def _parse_response(self, response: Dict[str, Any]) -> List[float]:
         return response['data'][0]['embedding']
+
+    def _parse_batch_response(self, response: Dict[str, Any]) -> List[List[float]]:
+        return [item['embedding'] for item in sorted(response['data'], key=lambda item: item.get('index', 0))]
@@ -1,19 +1,21 @@
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Union
 import lazyllm
 from .onlineEmbeddingModuleBase import OnlineEmbeddingModuleBase
 
 class QwenEmbedding(OnlineEmbeddingModuleBase):
+    MAX_BATCH_SIZE = 25
 
     def __init__(self,
                  embed_url: str = ("https://dashscope.aliyuncs.com/api/v1/services/"
                                    "embeddings/text-embedding/text-embedding"),
-                 embed_model_name: str = "text-embedding-v1"):
-        super().__init__("QWEN", embed_url, lazyllm.config['qwen_api_key'], embed_model_name)
+                 embed_model_name: str = "text-embedding-v1",
+                 **kwargs):
+        super().__init__("QWEN", embed_url, lazyllm.config['qwen_api_key'], embed_model_name, **kwargs)
 
-    def _encapsulated_data(self, text: str, **kwargs) -> Dict[str, str]:
+    def _encapsulated_data(self, text: Union[str, List[str]], **kwargs) -> Dict[str, str]:
         json_data = {
             "input": {
-                "texts": [text]
+                "texts": text if isinstance(text, list) else [text]
             },
             "model": self._embed_model_name
         }
@@ -24,3 +26,7 @@ class QwenEmbedding(OnlineEmbeddingModuleBase):
 
     def _parse_response(self, response: Dict[str, Any]) -> List[float]:
         return response['output']['embeddings'][0]['embedding']
+
+    def _parse_batch_response(self, response: Dict[str, Any]) -> List[List[float]]:
+        return [item['embedding'] for item in sorted(response['output']['embeddings'],
+                                                     key=lambda item: item.get('text_index', 0))]
@@ -1,17 +1,24 @@
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Union
 import lazyllm
 from .onlineEmbeddingModuleBase import OnlineEmbeddingModuleBase
 
 class SenseNovaEmbedding(OnlineEmbeddingModuleBase):
+    MAX_BATCH_SIZE = 32
 
     def __init__(self,
                  embed_url: str = "https://api.sensenova.cn/v1/llm/embeddings",
-                 embed_model_name: str = "nova-embedding-stable"):
+                 embed_model_name: str = "nova-embedding-stable",
+                 **kwargs):
         super().__init__("SENSENOVA",
                          embed_url,
                          SenseNovaEmbedding.encode_jwt_token(lazyllm.config['sensenova_api_key'],
                                                              lazyllm.config['sensenova_secret_key']),
-                         embed_model_name)
+                         embed_model_name,
+                         **kwargs)
+
+    def _rate_limit_key(self):
+        # the jwt token is regenerated for every module, limits belong to the access key
+        return self._model_series, lazyllm.config['sensenova_api_key']
 
     @staticmethod
     def encode_jwt_token(ak: str, sk: str) -> str:
@@ -31,9 +38,9 @@ class SenseNovaEmbedding(OnlineEmbeddingModuleBase):
         token = jwt.encode(payload, sk, headers=headers)
         return token
 
-    def _encapsulated_data(self, text: str, **kwargs) -> Dict[str, str]:
+    def _encapsulated_data(self, text: Union[str, List[str]], **kwargs) -> Dict[str, str]:
         json_data = {
-            "input": [text],
+            "input": text if isinstance(text, list) else [text],
             "model": self._embed_model_name
         }
         if len(kwargs) > 0:
@@ -43,3 +50,6 @@ class SenseNovaEmbedding(OnlineEmbeddingModuleBase):
 
     def _parse_response(self, response: Dict[str, Any]) -> List[float]:
         return response['embeddings'][0]['embedding']
+
+    def _parse_batch_response(self, response: Dict[str, Any]) -> List[List[float]]:
+        return [item['embedding'] for item in sorted(response['embeddings'], key=lambda item: item.get('index', 0))]
@@ -0,0 +1,258 @@
+import json
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+from lazyllm import LOG
+
+
+def _loads_str(text: str) -> Union[str, Dict]:
+    try:
+        ret = json.loads(text)
+        return _loads_str(ret) if isinstance(ret, str) else ret
+    except Exception:
+        LOG.error(f"{text} is not a valid json string.")
+        return text
+
+def _partial_suffix(text: str, token: str) -> int:
+    # length of the longest suffix of text which is a proper prefix of token
+    for n in range(min(len(text), len(token) - 1), 0, -1):
+        if token.startswith(text[-n:]): return n
+    return 0
+
+
+class _JsonScanner(object):
+    """Incrementally finds the end of the json object / array at the head of a buffer. Only brackets, strings and
+    escapes are tracked, so every character is visited once no matter how the buffer is chunked."""
+
+    def __init__(self):
+        self.depth, self.in_str, self.escape, self.pos = 0, False, False, 0
+
+    def scan(self, buf: str) -> int:
+        for i in range(self.pos, len(buf)):
+            c = buf[i]
+            if self.in_str:
+                if self.escape: self.escape = False
+                elif c == '\\': self.escape = True
+                elif c == '"': self.in_str = False
+            elif c == '"': self.in_str = True
+            elif c in '{[': self.depth += 1
+            elif c in '}]':
+                self.depth -= 1
+                if self.depth == 0:
+                    self.pos = i + 1
+                    return i + 1
+        self.pos = len(buf)
+        return -1
+
+
+class ToolCallParser(object):
+    """Incremental parser for the tool calls in the output of a local llm.
+
+    Chunks of the output are fed in as they are generated. ``feed`` returns the content which can be shown to the
+    user right now together with the tool calls completed by the chunk, so a tool call is available as soon as its
+    arguments are closed instead of after the whole output is generated. Two formats are supported:
+
+    1. ``start_token`` is given: content ends at the first ``start_token``; every ``start_token`` is followed by
+       ``name<args_token>{arguments}`` or by a json object with ``name`` and ``arguments`` (or ``parameters``),
+       optionally closed by ``end_token``.
+    2. Only ``tools`` are given: the output is split into lines, a tool call is either a line with the tool name
+       followed by lines with the json arguments, or a line with a json object (or list of objects) whose ``name``
+       is one of the tools. Content stops at the first tool call.
+
+    If ``start_token`` never shows up but ``tools`` are given, the second format is tried when the parser is closed.
+    """
+
+    _TEXT, _NAME, _ARGS = range(3)
+
+    def __init__(self, start_token: Optional[str] = None, args_token: Optional[str] = None,
+                 end_token: Optional[str] = None, tools: Optional[Iterable[str]] = None,
+                 on_tool_call: Optional[Callable[[Dict[str, Any]], None]] = None):
+        self._start, self._args, self._end = start_token or None, args_token or None, end_token or None
+        self._tools = set(tools or [])
+        self._on_tool_call = on_tool_call
+        self._buf, self._seen, self._name = '', 0, None
+        self._state, self._in_calls, self._closed = self._TEXT, False, False
+        self._scanner = None
+        self._content: List[str] = []
+        self.tool_calls: List[Dict[str, Any]] = []
+        # line mode
+        self._line_emitted, self._held_lines, self._pending_name = 0, [], None
+
+    @property
+    def content(self) -> str:
+        return ''.join(self._content)
+
+    def _add_call(self, name: str, arguments: Any, new_calls: List[Dict]) -> None:
+        if not name: return
+        call = {'name': name, 'arguments': arguments}
+        self.tool_calls.append(call)
+        new_calls.append(call)
+        if self._on_tool_call: self._on_tool_call(call)
+
+    def _add_json_call(self, raw: str, new_calls: List[Dict]) -> None:
+        try:
+            item = json.loads(raw)
+            args = item.get('parameters', item.get('arguments', {}))
+            self._add_call(item.get('name', ''), _loads_str(args) if isinstance(args, str) else args, new_calls)
+        except Exception:
+            LOG.error(f"tool calls info {raw} parse error")
+
+    def _find(self, token: str) -> int:
+        # only the part of the buffer which was not searched before (and the overlap with the token) is scanned
+        return self._buf.find(token, max(0, self._seen - len(token) + 1))
+
+    def _consume(self, n: int) -> str:
+        head, self._buf, self._seen = self._buf[:n], self._buf[n:], 0
+        return head
+
+    def _feed_tokens(self, new_calls: List[Dict], final: bool) -> str:  # noqa C901
+        text = []
+        while True:
+            if self._state == self._TEXT:
+                i = self._find(self._start)
+                if i < 0:
+                    keep = 0 if final else _partial_suffix(self._buf, self._start)
+                    head = self._consume(len(self._buf) - keep)
+                    self._seen = len(self._buf)
+                    if not self._in_calls: text.append(head)
+                    return ''.join(text)
+                if not self._in_calls: text.append(self._buf[:i])
+                self._consume(i + len(self._start))
+                self._in_calls, self._name, self._scanner = True, None, None
+                self._state = self._NAME if self._args else self._ARGS
+            elif self._state == self._NAME:
+                i, j = self._find(self._args), self._find(self._end) if self._end else -1
+                k = self._find(self._start)
+                stops = [x for x in (j, k) if x >= 0 and (i < 0 or x < i)]
+                if stops:
+                    # a tool call without arguments
+                    self._add_call(self._buf[:min(stops)].strip(), {}, new_calls)
+                    self._consume(min(stops) + (len(self._end) if min(stops) == j else 0))
+                    self._state = self._TEXT
+                elif i >= 0:
+                    self._name = self._consume(i).strip()
+                    self._consume(len(self._args))
+                    self._state = self._ARGS
+                else:
+                    if final: self._add_call(self._consume(len(self._buf)).strip(), {}, new_calls)
+                    self._seen = len(self._buf)
+                    return ''.join(text)
+            else:
+                stripped = self._buf.lstrip()
+                if stripped[:1] in ('{', '['):
+                    self._consume(len(self._buf) - len(stripped))
+                    self._scanner = self._scanner or _JsonScanner()
+                    i = self._scanner.scan(self._buf)
+                    if i < 0 and not final: return ''.join(text)
+                    raw = self._consume(len(self._buf) if i < 0 else i).strip()
+                else:
+                    stops = [x for x in (self._find(self._end) if self._end else -1, self._find(self._start)) if x >= 0]
+                    if not stops and not final:
+                        if stripped: self._seen = len(self._buf)
+                        return ''.join(text)
+                    raw = self._consume(min(stops) if stops else len(self._buf)).strip()
+                if self._args: self._add_call(self._name, _loads_str(raw) if raw else {}, new_calls)
+                elif raw: self._add_json_call(raw, new_calls)
+                self._state, self._scanner = self._TEXT, None
+                if final and not self._buf: return ''.join(text)
+
+    def _start_line(self, text: List[str]) -> None:
+        # blank lines are only emitted once they are followed by more content
+        if self._content or text: text.append('\n'.join([''] + self._held_lines + ['']))
+        self._held_lines = []
+
+    def _emit_line_text(self, text: List[str], line: str) -> None:
+        if not line.strip(): return self._held_lines.append(line)
+        self._start_line(text)
+        text.append(line)
+
+    def _is_partial_content(self, line: str) -> bool:
+        # whether a line which is not finished yet can be shown, i.e. can never become a tool call
+        s = line.strip()
+        return bool(s) and s[0] not in '{[' and not any(t.startswith(s) for t in self._tools)
+
+    def _feed_lines(self, new_calls: List[Dict], final: bool) -> str:  # noqa C901
+        text = []
+        while True:
+            if self._scanner:
+                i = self._scanner.scan(self._buf)
+                if i < 0 and not final: return ''.join(text)
+                raw = self._consume(len(self._buf) if i < 0 else i).strip()
+                self._add_call(self._pending_name, raw, new_calls)
+                self._scanner, self._pending_name = None, None
+                continue
+            i = self._buf.find('\n', self._seen)
+            if i < 0 and not final:
+                self._seen = len(self._buf)
+                if self._pending_name is None and not self._in_calls and self._is_partial_content(self._buf):
+                    if self._line_emitted == 0: self._start_line(text)
+                    text.append(self._buf[self._line_emitted:])
+                    self._line_emitted = len(self._buf)
+                return ''.join(text)
+            if i < 0 and not self._buf: break
+            line = self._consume(len(self._buf) if i < 0 else i + 1).rstrip('\n')
+            if line.startswith('{') and self._pending_name is not None:
+                # the arguments of the tool named by the previous line, which may span several lines
+                self._in_calls, self._scanner = True, _JsonScanner()
+                self._buf = line + ('\n' if i >= 0 else '') + self._buf
+                self._line_emitted = 0
+                continue
+            if self._pending_name is not None:
+                if not self._in_calls: self._emit_line_text(text, self._pending_name)
+                self._pending_name = None
+            if line.strip() in self._tools and self._line_emitted == 0:
+                self._pending_name = line.strip()
+            elif line.strip()[:1] in ('{', '[') and 'name' in line and self._parse_json_line(line, new_calls):
+                self._in_calls = True
+            elif not self._in_calls:
+                if self._line_emitted: text.append(line[self._line_emitted:])
+                else: self._emit_line_text(text, line)
+            self._line_emitted = 0
+            if i < 0: break
+        if self._pending_name is not None and not self._in_calls: self._emit_line_text(text, self._pending_name)
+        self._pending_name = None
+        return ''.join(text)
+
+    def _parse_json_line(self, line: str, new_calls: List[Dict]) -> bool:
+        try:
+            items = json.loads(line.strip())
+        except Exception:
+            LOG.error(f"tool calls info {line} parse error")
+            return False
+        found = False
+        for item in ([items] if isinstance(items, dict) else items if isinstance(items, list) else []):
+            if isinstance(item, dict) and item.get('name', '') in self._tools:
+                args = item.get('parameters', item.get('arguments', {}))
+                self._add_call(item['name'], _loads_str(args) if isinstance(args, str) else args, new_calls)
+                found = True
+        return found
+
+    def _process(self, final: bool) -> Tuple[str, List[Dict]]:
+        new_calls = []
+        if self._start: text = self._feed_tokens(new_calls, final)
+        elif self._tools: text = self._feed_lines(new_calls, final)
+        else: text, self._buf = self._buf, ''
+        if text: self._content.append(text)
+        return text, new_calls
+
+    def feed(self, chunk: str) -> Tuple[str, List[Dict[str, Any]]]:
+        assert not self._closed, 'Cannot feed a closed ToolCallParser'
+        self._buf += chunk
+        return self._process(final=False)
+
+    def close(self) -> Tuple[str, List[Dict[str, Any]]]:
+        if self._closed: return '', []
+        self._closed = True
+        text, new_calls = self._process(final=True)
+        if self._start and not self._in_calls and self._tools:
+            # the start token never appeared, fall back to the line format of the tools
+            parser = ToolCallParser(tools=self._tools, on_tool_call=self._on_tool_call)
+            parser.feed(self.content)
+            parser.close()
+            self._content, self.tool_calls = [parser.content], parser.tool_calls
+            new_calls.extend(parser.tool_calls)
+        return text, new_calls
+
+    def parse(self, output: str) -> Tuple[str, List[Dict[str, Any]]]:
+        self.feed(output)
+        self.close()
+        return self.content, self.tool_calls
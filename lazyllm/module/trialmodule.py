@@ -1,35 +1,187 @@
 from .module import ModuleBase
 from lazyllm import OptionIter, ForkProcess, LOG
-import time
+import os
+import math
 import copy
+import queue
+import random
 import multiprocessing
+from typing import Callable, List, Optional, Tuple
 
 def get_options(x):
     if isinstance(x, ModuleBase):
         return x.options
     return []
 
-# TODO(wangzhihong): add process pool to control parallel-number and collect result
+def _snapshot(options) -> List[Tuple]:
+    # current choice of every active option, including options nested in the chosen values
+    config = []
+    for o in options:
+        config.append((o, o._idx))
+        config.extend(_snapshot(get_options(o._obj)))
+    return config
+
+def _apply(config):
+    for o, idx in config: o._idx = idx
+
+def _reset(options):
+    for o in options:
+        o._idx = 0
+        for obj in o._objs: _reset(get_options(obj))
+
+
 class TrialModule(object):
-    def __init__(self, m):
+    """Search the options of ``m`` on a bounded pool of forked processes.
+
+    ``sampler`` chooses the configurations to try: ``grid`` walks the full cartesian product, ``random`` draws
+    ``n_trials`` distinct configurations and ``adaptive`` starts randomly, then keeps mutating the best scored
+    configurations. With ``early_stop='halving'`` the configurations are first evaluated on a prefix of the evalset,
+    and only the best ``1 / eta`` of them go on to an ``eta`` times larger prefix, until the full evalset is used.
+    """
+
+    def __init__(self, m, *, max_workers: Optional[int] = None, sampler: str = 'grid',
+                 n_trials: Optional[int] = None, score_f: Optional[Callable] = None, early_stop: Optional[str] = None,
+                 min_eval: Optional[int] = None, eta: int = 2, seed: Optional[int] = None):
+        assert sampler in ('grid', 'random', 'adaptive'), f'Invalid sampler {sampler}'
+        assert early_stop in (None, 'halving'), f'Invalid early stop strategy {early_stop}'
+        assert sampler == 'grid' or n_trials, f'n_trials is required by {sampler} sampler'
+        assert (sampler != 'adaptive' and not early_stop) or callable(score_f), \
+            'score_f is required to rank trials for adaptive sampler and early stop'
+        assert not (sampler == 'adaptive' and early_stop), 'Adaptive sampler cannot be used with early stop'
+        assert eta > 1, 'eta should be greater than 1'
         self.m = m
+        self._max_workers = max_workers or os.cpu_count() or 1
+        self._sampler, self._n_trials, self._score_f = sampler, n_trials, score_f
+        self._early_stop, self._min_eval, self._eta = early_stop, min_eval, eta
+        self._rng = random.Random(seed)
+        self.results = []
 
     @staticmethod
-    def work(m, q):
+    def work(m, q, tid, n_eval=None):
         # update option at module.update()
         m = copy.deepcopy(m)
-        m.update()
-        q.put(m.eval_result)
+        if n_eval is not None: m._evalset = m._evalset[:n_eval]
+        try:
+            m.update()
+            q.put((tid, m.eval_result, None))
+        except Exception as e:
+            q.put((tid, None, f'{type(e).__name__}: {e}'))
+
+    def _run(self, configs, n_eval=None) -> List:
+        q, results, running = multiprocessing.Queue(), [None] * len(configs), {}
+        todo = iter(enumerate(configs))
+        while True:
+            while len(running) < self._max_workers and (item := next(todo, None)):
+                tid, config = item
+                _apply(config)
+                running[tid] = ForkProcess(target=TrialModule.work, args=(self.m, q, tid, n_eval), sync=True)
+                running[tid].start()
+            if not running: break
+            try:
+                tid, result, error = q.get(timeout=1)
+            except queue.Empty:
+                for tid, p in list(running.items()):
+                    if not p.is_alive() and q.empty():
+                        LOG.error(f'Trial {tid} exited with code {p.exitcode} before reporting')
+                        running.pop(tid)
+                continue
+            if error: LOG.error(f'Trial {tid} with {self._describe(configs[tid])} failed: {error}')
+            results[tid] = result
+            running.pop(tid).join()
+        return results
+
+    def _score(self, result) -> float:
+        if result is None or not self._score_f: return float('-inf')
+        return self._score_f(result)
+
+    @staticmethod
+    def _describe(config) -> List:
+        return [o._objs[idx] for o, idx in config]
+
+    @staticmethod
+    def _key(config) -> Tuple:
+        return tuple((id(o), idx) for o, idx in config)
+
+    def _random_config(self, options) -> List[Tuple]:
+        config = []
+        for o in options:
+            idx = self._rng.randrange(len(o._objs))
+            config.append((o, idx))
+            config.extend(self._random_config(get_options(o._objs[idx])))
+        return config
+
+    def _mutate(self, config, options) -> List[Tuple]:
+        # options with a single value cannot change, a config made of them only is returned as it is
+        mutable = [(o, idx) for o, idx in config if len(o._objs) > 1]
+        if not mutable: return config
+        _apply(config)
+        o, idx = mutable[self._rng.randrange(len(mutable))]
+        o._idx = self._rng.choice([i for i in range(len(o._objs)) if i != idx])
+        return _snapshot(options)
+
+    def _sample(self, options, n, exists=(), parents=None) -> List[List[Tuple]]:
+        configs, keys = [], set(exists)
+        for _ in range(n * 10):
+            if len(configs) == n: break
+            config = self._mutate(self._rng.choice(parents), options) if parents else self._random_config(options)
+            if (key := self._key(config)) not in keys:
+                keys.add(key)
+                configs.append(config)
+        return configs
+
+    def _adaptive(self, options) -> List:
+        n_initial = max(1, min(self._max_workers, self._n_trials // 2))
+        configs = self._sample(options, n_initial)
+        scores = [self._score(r) for r in self._record(configs, self._run(configs))]
+        while len(configs) < self._n_trials:
+            top = [c for _, c in sorted(zip(scores, configs), key=lambda x: -x[0])][:max(1, self._max_workers)]
+            new = self._sample(options, min(self._max_workers, self._n_trials - len(configs)),
+                               [self._key(c) for c in configs], top)
+            if not new: break
+            configs += new
+            scores += [self._score(r) for r in self._record(new, self._run(new))]
+        return configs
+
+    def _successive_halving(self, configs) -> None:
+        n_full = len(self.m._evalset)
+        rungs = max(0, math.ceil(math.log(len(configs), self._eta)))
+        budget = self._min_eval or max(1, n_full // self._eta ** rungs)
+        alive = list(range(len(configs)))
+        while True:
+            n_eval = None if budget >= n_full else budget
+            results = self._run([configs[i] for i in alive], n_eval)
+            scores = {i: self._score(r) for i, r in zip(alive, results)}
+            LOG.info(f'Successive halving: {len(alive)} trials evaluated on {n_eval or n_full} samples')
+            if n_eval is None:
+                self._record([configs[i] for i in alive], results)
+                break
+            alive = sorted(alive, key=lambda i: -scores[i])[:max(1, math.ceil(len(alive) / self._eta))]
+            budget = n_full if len(alive) == 1 else budget * self._eta
+
+    def _record(self, configs, results) -> List:
+        for config, result in zip(configs, results):
+            self.results.append(dict(options=self._describe(config), eval_result=result,
+                                     score=self._score(result) if self._score_f else None))
+        return results
+
+    @property
+    def best(self):
+        assert self._score_f, 'score_f is required to find the best trial'
+        return max(self.results, key=lambda r: r['score']) if self.results else None
 
     def update(self):
-        options = get_options(self.m)
-        q = multiprocessing.Queue()
-        ps = []
-        for _ in OptionIter(options, get_options):
-            p = ForkProcess(target=TrialModule.work, args=(self.m, q), sync=True)
-            ps.append(p)
-            p.start()
-            time.sleep(1)
-        [p.join() for p in ps]
-        result = [q.get() for p in ps]
-        LOG.info(f'{result}')
+        options, self.results = get_options(self.m), []
+        try:
+            if not options:
+                self._record([[]], self._run([[]]))
+            elif self._sampler == 'adaptive':
+                self._adaptive(options)
+            else:
+                configs = ([_snapshot(options) for _ in OptionIter(options, get_options)]
+                           if self._sampler == 'grid' else self._sample(options, self._n_trials))
+                if self._early_stop == 'halving': self._successive_halving(configs)
+                else: self._record(configs, self._run(configs))
+        finally:
+            _reset(options)
+        LOG.info(f'{[r["eval_result"] for r in self.results]}')
+        return self
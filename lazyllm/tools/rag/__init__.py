@@ -4,6 +4,7 @@ from .rerank import Reranker, register_reranker
 from .transform import SentenceSplitter, LLMParser, NodeTransform, TransformArgs, AdaptiveTransform
 from .index import register_similarity
 from .store import DocNode
+from .embed_cache import EmbeddingCache
 from .readers import (PDFReader, DocxReader, HWPReader, PPTXReader, ImageReader, IPYNBReader, EpubReader,
                       MarkdownReader, MboxReader, PandasCSVReader, PandasExcelReader, VideoAudioReader)
 from .dataReader import SimpleDirectoryReader
@@ -25,6 +26,7 @@ __all__ = [
     "register_similarity",
     "register_reranker",
     "DocNode",
+    "EmbeddingCache",
     "PDFReader",
     "DocxReader",
     "HWPReader",
@@ -0,0 +1,468 @@
+import importlib.util
+import itertools
+import os
+import threading
+from operator import attrgetter
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from lazyllm import LOG, config
+from lazyllm.thirdparty import faiss, hnswlib
+from .index import DefaultIndex, _EmbeddingMatrix, _top_rows
+from .store import BaseStore, DocNode, _LazyGroupNodes
+
+config.add("rag_ivf_nlist", int, 0, "RAG_IVF_NLIST")  # 0: sqrt of the number of nodes
+config.add("rag_ivf_nprobe", int, 8, "RAG_IVF_NPROBE")
+config.add("rag_hnsw_m", int, 16, "RAG_HNSW_M")
+config.add("rag_hnsw_ef_construction", int, 200, "RAG_HNSW_EF_CONSTRUCTION")
+config.add("rag_hnsw_ef", int, 64, "RAG_HNSW_EF")
+
+
+def _spherical_kmeans(x: np.ndarray, k: int, niter: int = 10, seed: int = 0) -> np.ndarray:
+    if importlib.util.find_spec("faiss") is not None:
+        km = faiss.Kmeans(x.shape[1], k, niter=niter, spherical=True, seed=seed)
+        km.train(np.ascontiguousarray(x))
+        return km.centroids
+    rng = np.random.default_rng(seed)
+    centroids = x[rng.choice(len(x), k, replace=False)].copy()
+    for _ in range(niter):
+        assign = _assign(x, centroids)
+        order = np.argsort(assign, kind="stable")
+        labels, starts = np.unique(assign[order], return_index=True)
+        sums = np.add.reduceat(x[order], starts, axis=0)
+        empty = np.setdiff1d(np.arange(k), labels)
+        centroids[labels] = sums
+        if len(empty): centroids[empty] = x[rng.choice(len(x), len(empty), replace=False)]
+        centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+    return centroids
+
+
+def _assign(x: np.ndarray, centroids: np.ndarray, chunk: int = 65536) -> np.ndarray:
+    return np.concatenate([np.argmax(x[i:i + chunk] @ centroids.T, axis=1) for i in range(0, len(x), chunk)]
+                          ).astype(np.int32) if len(x) else np.zeros(0, dtype=np.int32)
+
+
+class _IVFMatrix(_EmbeddingMatrix):
+    """Inverted-file index over the embedding matrix of a node group.
+
+    The normalized embeddings are clustered into ``nlist`` cells with spherical k-means, and every cell keeps the
+    list of its rows. A query only scores the rows of the ``nprobe`` cells closest to it. The cells are trained in
+    a background thread once the group holds ``min_train_size`` nodes and again each time it grows fourfold; until
+    the first training is done every query is an exact scan. New rows are assigned to their nearest cell, so
+    inserts and deletes are incremental.
+    """
+
+    def __init__(self, nlist: int = 0, min_train_size: int = 1024):
+        super().__init__()
+        self._nlist, self._min_train_size = nlist, min_train_size
+        self._centroids: Optional[np.ndarray] = None
+        self._assign = np.zeros(0, dtype=np.int32)
+        self._cells: List[List[int]] = []
+        self._pos = np.zeros(0, dtype=np.int64)  # position of each row in the list of its cell
+        self._trained_size = 0
+        self._version = 0  # changes of the rows, a training only installs its cells if there were none meanwhile
+        self._training: Optional[threading.Thread] = None
+        self.loaded = False
+
+    def _on_add(self, start, vecs):
+        if len(self._assign) < len(self._nodes):
+            size = max(len(self._nodes), 2 * len(self._assign))
+            assign, pos = np.zeros(size, dtype=np.int32), np.zeros(size, dtype=np.int64)
+            assign[:start], pos[:start] = self._assign[:start], self._pos[:start]
+            self._assign, self._pos = assign, pos
+        if self._centroids is not None:
+            cells = _assign(vecs, self._centroids)
+            self._assign[start:start + len(vecs)] = cells
+            for row, cell in enumerate(cells.tolist(), start):
+                self._pos[row] = len(self._cells[cell])
+                self._cells[cell].append(row)
+        self._version += 1
+
+    def _on_remove(self, row):
+        if self._centroids is not None:
+            cell, pos = self._cells[self._assign[row]], self._pos[row]
+            cell[pos] = cell[-1]
+            self._pos[cell[pos]] = pos
+            cell.pop()
+        self._version += 1
+
+    def _on_move(self, src, dst):
+        self._assign[dst] = self._assign[src]
+        if self._centroids is not None:
+            self._cells[self._assign[src]][self._pos[src]] = dst
+            self._pos[dst] = self._pos[src]
+        self._version += 1
+
+    def _set_cells(self, centroids: np.ndarray, assign: np.ndarray) -> None:
+        n = len(self._nodes)
+        order = np.argsort(assign, kind="stable")
+        starts = np.searchsorted(assign[order], np.arange(len(centroids)))
+        self._centroids, self._assign[:n] = centroids, assign
+        self._cells = [rows.tolist() for rows in np.split(order, starts[1:])]
+        self._pos[order] = np.arange(n) - starts[assign[order]]
+
+    def maybe_train(self, path: Optional[str] = None) -> None:
+        # called with the lock held; the cells are trained in the background, not inside the query
+        n = len(self._nodes)
+        if self._training is not None or n < self._min_train_size: return
+        if self._centroids is not None and n <= 4 * self._trained_size: return
+        self._training = threading.Thread(target=self._train, args=(path,), daemon=True)
+        self._training.start()
+
+    def _train(self, path: Optional[str]) -> None:
+        try:
+            for _ in range(3):
+                with self.lock:
+                    mat, version = self.matrix, self._version
+                centroids, assign = self._fit(mat)
+                with self.lock:
+                    if version != self._version: continue  # the rows changed meanwhile, fit them again
+                    self._set_cells(centroids, assign)
+                    self._trained_size = len(mat)
+                    if path: self.save(path)
+                    return
+            with self.lock:  # the group keeps changing, assign the current rows while queries wait
+                self._set_cells(centroids, _assign(self.matrix, centroids))
+                self._trained_size = len(self._nodes)
+                if path: self.save(path)
+        except Exception as e:
+            LOG.error(f"Failed to train the ivf index: {e}")
+        finally:
+            self._training = None
+
+    def _fit(self, mat: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        n = len(mat)
+        nlist = min(self._nlist or int(np.sqrt(n)), n)
+        sample = mat if n <= 256 * nlist else mat[np.random.default_rng(0).choice(n, 256 * nlist, replace=False)]
+        LOG.info(f"Training ivf index with {nlist} cells on {len(sample)} of {n} nodes")
+        centroids = np.asarray(_spherical_kmeans(sample, nlist), dtype=np.float32)
+        return centroids, _assign(mat, centroids)
+
+    def wait_trained(self) -> None:
+        if (training := self._training) is not None: training.join()
+
+    def search(self, query: np.ndarray, topk: Optional[int], nprobe: int) -> List[Tuple[DocNode, float]]:
+        if self._centroids is None or nprobe >= len(self._centroids):
+            rows = np.arange(len(self._nodes))
+        else:
+            cells = np.argpartition(-(self._centroids @ query), nprobe - 1)[:nprobe]
+            rows = np.fromiter(itertools.chain.from_iterable(self._cells[c] for c in cells.tolist()), dtype=np.int64)
+        scores = self._mat[rows] @ query if len(rows) else np.zeros(0, dtype=np.float32)
+        return [(self._nodes[rows[i]], float(scores[i])) for i in _top_rows(-scores, topk)]
+
+    def save(self, path: str) -> None:
+        if self._centroids is None: return
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp = f"{path}.tmp.npz"
+        np.savez(tmp, centroids=self._centroids, uids=np.asarray([n.uid for n in self._nodes]),
+                 assign=self._assign[:len(self._nodes)], trained_size=self._trained_size)
+        os.replace(tmp, path)
+
+    def load(self, path: str) -> None:
+        if not os.path.exists(path): return
+        data = np.load(path)
+        centroids = data["centroids"]
+        if len(self._nodes) and centroids.shape[1] != self._mat.shape[1]: return
+        known = dict(zip(data["uids"].tolist(), data["assign"].tolist()))
+        assign = np.fromiter((known.get(node.uid, -1) for node in self._nodes), dtype=np.int32, count=len(self._nodes))
+        if (missing := np.flatnonzero(assign < 0)).size: assign[missing] = _assign(self._mat[missing], centroids)
+        self._set_cells(centroids, assign)
+        self._trained_size = int(data["trained_size"])
+
+
+class _HNSWGraph(object):
+    """HNSW graph of a node group built with hnswlib; removed nodes are marked as deleted.
+
+    Like ``_EmbeddingMatrix``, the graph is built from the nodes of the group on its first query only, then the
+    store tells it about the nodes added and removed since, so a query only embeds and inserts the new nodes. The
+    graph is saved in a background thread after the queries which changed it.
+    """
+
+    def __init__(self, m: int, ef_construction: int):
+        self._m, self._ef_construction = m, ef_construction
+        self._index = None
+        self._labels: Dict[str, int] = {}
+        self._nodes: Dict[int, DocNode] = {}
+        self._next_label = 0
+        self._pending: Dict[str, DocNode] = {}
+        self._tracked = False
+        self._saving: Optional[threading.Thread] = None
+        self.lock = threading.Lock()
+        self.changed, self.loaded = False, False
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def _init(self, dim: int, capacity: int) -> None:
+        self._index = hnswlib.Index(space="cosine", dim=dim)
+        self._index.init_index(max_elements=max(capacity, 1024), ef_construction=self._ef_construction,
+                               M=self._m, allow_replace_deleted=True)
+
+    def sync(self, nodes: List[DocNode]) -> None:
+        uids = set(map(attrgetter("uid"), nodes))
+        gone = self._labels.keys() - uids
+        if gone: self.remove(gone)
+        if len(self._labels) < len(uids): self.add([node for node in nodes if node.uid not in self._labels])
+
+    def add(self, nodes: List[DocNode]) -> None:
+        if not nodes: return
+        vecs = np.asarray([node.embedding for node in nodes], dtype=np.float32)
+        if self._index is None: self._init(vecs.shape[1], 2 * len(nodes))
+        needed = self._index.get_current_count() + len(nodes)
+        if needed > self._index.get_max_elements(): self._index.resize_index(max(needed, 2 * needed - len(nodes)))
+        labels = np.arange(self._next_label, self._next_label + len(nodes))
+        self._next_label += len(nodes)
+        self._index.add_items(vecs, labels, replace_deleted=True)
+        for label, node in zip(labels.tolist(), nodes):
+            self._labels[node.uid], self._nodes[label] = label, node
+        self.changed = True
+
+    def remove(self, uids) -> None:
+        for uid in uids:
+            label = self._labels.pop(uid)
+            self._index.mark_deleted(label)
+            self._nodes.pop(label)
+        self.changed = True
+
+    def notify_add(self, nodes: List[DocNode]) -> None:
+        with self.lock:
+            if not self._tracked: return
+            for node in nodes:
+                if node.uid in self._labels: self.remove([node.uid])
+                self._pending[node.uid] = node
+
+    def notify_remove(self, nodes: List[DocNode]) -> None:
+        with self.lock:
+            if not self._tracked: return
+            for node in nodes:
+                if self._pending.pop(node.uid, None) is None and node.uid in self._labels: self.remove([node.uid])
+
+    def update(self, nodes: List[DocNode], embed: Callable[[List[DocNode]], Any]) -> None:
+        # called with the lock held; nodes are all nodes of the group, only scanned when the graph is built or
+        # when they do not match what the store reported (e.g. nodes which are not kept in a store)
+        if not self._tracked or len(nodes) != len(self._nodes) + len(self._pending):
+            self._pending.clear()
+            embed(nodes)
+            self.sync(nodes)
+            self._tracked = True
+        elif self._pending:
+            nodes = list(self._pending.values())
+            self._pending.clear()
+            embed(nodes)
+            self.add(nodes)
+
+    def maybe_save(self, path: str) -> None:
+        # called with the lock held; the saving thread waits for the lock, so it runs once the query is answered
+        if not self.changed or self._saving is not None: return
+        self._saving = threading.Thread(target=self._save, args=(path,), daemon=True)
+        self._saving.start()
+
+    def _save(self, path: str) -> None:
+        try:
+            with self.lock: self.save(path)
+        except Exception as e:
+            LOG.error(f"Failed to save the hnsw index: {e}")
+        finally:
+            self._saving = None
+
+    def wait_saved(self) -> None:
+        if (saving := self._saving) is not None: saving.join()
+
+    def search(self, query: np.ndarray, topk: Optional[int], ef: int) -> List[Tuple[DocNode, float]]:
+        k = len(self._nodes) if topk is None else min(topk, len(self._nodes))
+        if k <= 0: return []
+        self._index.set_ef(max(ef, k))
+        labels, distances = self._index.knn_query(query, k=k)
+        return [(self._nodes[label], 1.0 - float(d)) for label, d in zip(labels[0].tolist(), distances[0].tolist())]
+
+    def save(self, path: str) -> None:
+        if self._index is None: return
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._index.save_index(path)
+        np.savez(f"{path}.labels.npz", uids=np.asarray(list(self._labels.keys())),
+                 labels=np.asarray(list(self._labels.values()), dtype=np.int64), dim=self._index.dim)
+        self.changed = False
+
+    def load(self, path: str, nodes: List[DocNode]) -> None:
+        if not (os.path.exists(path) and os.path.exists(f"{path}.labels.npz")): return
+        data = np.load(f"{path}.labels.npz")
+        self._index = hnswlib.Index(space="cosine", dim=int(data["dim"]))
+        self._index.load_index(path, allow_replace_deleted=True)
+        by_uid = {node.uid: node for node in nodes}
+        labels = data["labels"].tolist()
+        for uid, label in zip(data["uids"].tolist(), labels):
+            if uid in by_uid: self._labels[uid], self._nodes[label] = label, by_uid[uid]
+            else: self._index.mark_deleted(label)
+        self._next_label = max(labels) + 1 if labels else 0
+
+
+class _AnnIndex(DefaultIndex):
+    # Embedding similarities are answered by the approximate index of each group, text similarities (e.g. bm25)
+    # fall back to the exhaustive DefaultIndex.
+    _name = ""
+    _query_params = ()
+
+    def query(self, query: str, nodes: List[DocNode], similarity_name: str, similarity_cut_off: float,
+              topk: int, *, with_score: bool = False, candidates: Optional[List[DocNode]] = None, **kwargs) -> List:
+        params = {k: kwargs.pop(k) for k in self._query_params if k in kwargs}
+        if similarity_name != "cosine" or not nodes:
+            return super().query(query, nodes, similarity_name, similarity_cut_off, topk, with_score=with_score,
+                                 candidates=candidates, **kwargs)
+        assert self.embed, "Chosen similarity needs embed model."
+        assert len(query) > 0, "Query should not be empty."
+        query_embedding = np.asarray(self.embed(query), dtype=np.float32)
+        query_embedding = query_embedding / max(float(np.linalg.norm(query_embedding)), 1e-12)
+        if candidates is not None:
+            similarities = self._exact(query_embedding[None], candidates, topk)[0]
+        else:
+            similarities = self._search(query_embedding, nodes, topk, **params)
+        return self._results(query, similarities, similarity_cut_off, with_score)
+
+    def query_batch(self, queries: List[str], nodes: List[DocNode], similarity_name: str,
+                    similarity_cut_off: float, topk: int, *, with_score: bool = False,
+                    candidates: Optional[List[DocNode]] = None, **kwargs) -> List[List]:
+        params = {k: kwargs.pop(k) for k in self._query_params if k in kwargs}
+        if similarity_name != "cosine" or not nodes or not queries:
+            return super().query_batch(queries, nodes, similarity_name, similarity_cut_off, topk,
+                                       with_score=with_score, candidates=candidates, **kwargs)
+        query_embeddings = self._embed_queries(queries)
+        if candidates is not None:
+            similarities = self._exact(query_embeddings, candidates, topk)
+        else:
+            similarities = [self._search(query_embedding, nodes, topk, **params) for query_embedding in query_embeddings]
+        return [self._results(query, sims, similarity_cut_off, with_score) for query, sims in zip(queries, similarities)]
+
+    def _exact(self, query_embeddings: np.ndarray, candidates: List[DocNode],
+               topk: Optional[int]) -> List[List[Tuple[DocNode, float]]]:
+        # filtered queries score their candidates exactly, the approximate index only pays off on the whole group
+        if not candidates: return [[] for _ in query_embeddings]
+        candidates = self._parallel_do_embedding(candidates)
+        matrix = _EmbeddingMatrix()
+        matrix.add(candidates)
+        return [matrix.topk(scores, topk, True) for scores in query_embeddings @ matrix.matrix.T]
+
+
+class IVFIndex(_AnnIndex):
+    """Approximate index which scans only the ``nprobe`` nearest inverted-file cells of the query.
+
+    ``nprobe`` (query time, ``config['rag_ivf_nprobe']`` by default) trades recall for latency, ``nlist``
+    (``config['rag_ivf_nlist']``, sqrt of the group size by default) sets the number of cells. Cells are trained
+    with faiss k-means when faiss is installed and with numpy otherwise.
+    """
+
+    _name = "ivf"
+    _query_params = ("nprobe",)
+
+    def __init__(self, embed: Callable, store: BaseStore, persist_path: Optional[str] = None,
+                 nlist: Optional[int] = None, min_train_size: int = 1024, **kwargs):
+        super().__init__(embed, store, persist_path, **kwargs)
+        self._nlist = config["rag_ivf_nlist"] if nlist is None else nlist
+        self._min_train_size = min_train_size
+
+    def _get_matrix(self, group: Optional[str]) -> _IVFMatrix:
+        with self._lock:
+            if group not in self._matrices:
+                self._matrices[group] = _IVFMatrix(self._nlist, self._min_train_size)
+            return self._matrices[group]
+
+    def _search(self, query: np.ndarray, nodes: List[DocNode], topk: Optional[int],
+                nprobe: Optional[int] = None) -> List[Tuple[DocNode, float]]:
+        group = nodes[0].group
+        matrix, path = self._get_matrix(group), self._path(group, self._name)
+        with matrix.lock:
+            matrix.update(nodes, self._parallel_do_embedding)
+            if not matrix.loaded:
+                if path: matrix.load(path)
+                matrix.loaded = True
+            matrix.maybe_train(path)
+            return matrix.search(query, topk, nprobe or config["rag_ivf_nprobe"])
+
+
+class HNSWIndex(_AnnIndex):
+    """Approximate index backed by an hnswlib graph per node group (``pip install hnswlib``).
+
+    ``ef`` (query time, ``config['rag_hnsw_ef']`` by default) trades recall for latency; ``m`` and
+    ``ef_construction`` (``config['rag_hnsw_m']`` and ``config['rag_hnsw_ef_construction']``) set how densely the
+    graph is connected when it is built.
+    """
+
+    _name = "hnsw"
+    _query_params = ("ef",)
+
+    def __init__(self, embed: Callable, store: BaseStore, persist_path: Optional[str] = None,
+                 m: Optional[int] = None, ef_construction: Optional[int] = None, **kwargs):
+        super().__init__(embed, store, persist_path, **kwargs)
+        self._m = m or config["rag_hnsw_m"]
+        self._ef_construction = ef_construction or config["rag_hnsw_ef_construction"]
+
+    def _get_graph(self, group: Optional[str]) -> _HNSWGraph:
+        with self._lock:
+            if group not in self._matrices:
+                self._matrices[group] = _HNSWGraph(self._m, self._ef_construction)
+            return self._matrices[group]
+
+    def _search(self, query: np.ndarray, nodes: List[DocNode], topk: Optional[int],
+                ef: Optional[int] = None) -> List[Tuple[DocNode, float]]:
+        group = nodes[0].group
+        graph, path = self._get_graph(group), self._path(group, self._name)
+        with graph.lock:
+            if not graph.loaded:
+                if path: graph.load(path, nodes)
+                graph.loaded = True
+            graph.update(nodes, self._parallel_do_embedding)
+            if path: graph.maybe_save(path)
+            return graph.search(query, topk, ef or config["rag_hnsw_ef"])
+
+
+class StoreIndex(_AnnIndex):
+    """Index which delegates the cosine search to the native vector search of the store, e.g. the collections of
+    ChromadbStore, so no embedding matrix is kept in memory and only the top-k nodes are returned by the backend.
+
+    The group is scanned for nodes without embedding on its first query only, the nodes added to the store since are
+    embedded on the next query. Stores without vector search, and chroma collections created by older versions with
+    the l2 distance, are searched in memory with the embedding matrix of DefaultIndex instead.
+    """
+
+    _name = "store"
+
+    def __init__(self, embed: Callable, store: BaseStore, persist_path: Optional[str] = None, **kwargs):
+        super().__init__(embed, store, persist_path, **kwargs)
+        # nodes of the groups queried so far which are not embedded yet, by group and uid
+        self._unembedded: Dict[Optional[str], Dict[str, DocNode]] = {}
+
+    def on_nodes_added(self, nodes: List[DocNode]) -> None:
+        super().on_nodes_added(nodes)
+        with self._lock:
+            for node in nodes:
+                if (pending := self._unembedded.get(node.group)) is not None and not node.has_embedding():
+                    pending[node.uid] = node
+
+    def on_nodes_removed(self, nodes: List[DocNode]) -> None:
+        super().on_nodes_removed(nodes)
+        with self._lock:
+            for node in nodes:
+                if (pending := self._unembedded.get(node.group)) is not None: pending.pop(node.uid, None)
+
+    def _embed_new(self, group: Optional[str], nodes: Sequence[DocNode]) -> None:
+        with self._lock:
+            pending, self._unembedded[group] = self._unembedded.get(group), {}
+        if pending is None:  # a group which the store keeps on disk has no nodes in memory to embed
+            pending = {node.uid: node for node in (nodes.loaded() if isinstance(nodes, _LazyGroupNodes) else nodes)}
+        try:
+            self._parallel_do_embedding(list(pending.values()))
+        except Exception:
+            with self._lock: self._unembedded[group].update(pending)
+            raise
+
+    def _search(self, query: np.ndarray, nodes: Sequence[DocNode],
+                topk: Optional[int]) -> List[Tuple[DocNode, float]]:
+        group = nodes.group if isinstance(nodes, _LazyGroupNodes) else nodes[0].group
+        self._embed_new(group, nodes)
+        if (similarities := self.store.search_vectors(group, query, topk)) is not None: return similarities
+        matrix = self._get_matrix(group)
+        with matrix.lock:
+            matrix.update(nodes, self._parallel_do_embedding)
+            return matrix.topk(matrix.matrix @ query, topk, True)
+
+
+ann_indices = dict(ivf=IVFIndex, hnsw=HNSWIndex, store=StoreIndex)
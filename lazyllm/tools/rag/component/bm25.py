@@ -1,10 +1,243 @@
-from typing import List, Tuple
+import functools
+import hashlib
+import itertools
+import multiprocessing
+import os
+import pickle
+import re
+import threading
+from collections import Counter, OrderedDict
+from itertools import repeat
+from operator import attrgetter
+from typing import Dict, List, Optional, Tuple
 from ..store import DocNode
 import bm25s
 import Stemmer
+import numpy as np
+from lazyllm import LOG, config
 from lazyllm.thirdparty import jieba
 from .stopwords import STOPWORDS_CHINESE
 
+config.add("rag_bm25_token_cache_size", int, 100000, "RAG_BM25_TOKEN_CACHE_SIZE")
+config.add("rag_bm25_tokenize_workers", int, 0, "RAG_BM25_TOKENIZE_WORKERS")  # 0 or 1: in this process
+config.add("rag_bm25_parallel_threshold", int, 8192, "RAG_BM25_PARALLEL_THRESHOLD")
+
+_STOPWORDS_CHINESE = frozenset(STOPWORDS_CHINESE)
+_split_words = re.compile(r"(?u)\b\w\w+\b").findall  # the default token pattern of bm25s
+
+
+@functools.lru_cache(maxsize=None)
+def _english_stemmer() -> Stemmer.Stemmer:
+    return Stemmer.Stemmer("english")
+
+
+def _tokenize_chinese(text: str) -> List[str]:
+    # the same splitting as bm25s.tokenize, which builds a set of the stopwords again for every text
+    return [word for word in _split_words(" ".join(jieba.lcut(text)).lower()) if word not in _STOPWORDS_CHINESE]
+
+
+def _tokenize_texts(language: str, texts: List[str]) -> List[List[str]]:
+    if not texts: return []
+    if language == "zh": return [_tokenize_chinese(text) for text in texts]
+    return bm25s.tokenize(texts, stopwords=language, stemmer=_english_stemmer(),
+                          return_ids=False, show_progress=False)
+
+
+def _tokenize_corpus(language: str, texts: List[str]) -> List[List[str]]:
+    # worker processes are opt-in: a spawned worker imports the __main__ module of the application again
+    workers = config["rag_bm25_tokenize_workers"]
+    if workers <= 1 or len(texts) < max(config["rag_bm25_parallel_threshold"], 2 * workers):
+        return _tokenize_texts(language, texts)
+    size = -(-len(texts) // (workers * 4))
+    chunks = [texts[i:i + size] for i in range(0, len(texts), size)]
+    method = "fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn"
+    try:
+        with multiprocessing.get_context(method).Pool(workers) as p:
+            return list(itertools.chain.from_iterable(p.starmap(_tokenize_texts, zip(repeat(language), chunks))))
+    except Exception as e:
+        LOG.warning(f"Failed to tokenize the corpus in {workers} processes, tokenize it in this one instead: {e}")
+        return _tokenize_texts(language, texts)
+
+
+def _content_key(language: str, text: str) -> str:
+    return hashlib.sha1(f"{language}\0{text}".encode("utf-8")).hexdigest()
+
+
+class _TokenCache(object):
+    # token lists by content, shared by the indices of this process, so that the chunks of a re-parsed file
+    # which did not change are not tokenized again although they come back with new uids
+    def __init__(self):
+        self._data, self._lock = OrderedDict(), threading.Lock()
+
+    def get(self, key: str) -> Optional[List[str]]:
+        with self._lock:
+            tokens = self._data.get(key)
+            if tokens is not None: self._data.move_to_end(key)
+            return tokens
+
+    def put(self, key: str, tokens: List[str]) -> None:
+        max_size = config["rag_bm25_token_cache_size"]
+        if max_size <= 0: return
+        with self._lock:
+            self._data[key] = tokens
+            self._data.move_to_end(key)
+            while len(self._data) > max_size: self._data.popitem(last=False)
+
+
+_token_cache = _TokenCache()
+
+
+class BM25Index:
+    """An incremental BM25 inverted index (the lucene variant used by bm25s).
+
+    Nodes are tokenized once when they are added; ``sync`` only tokenizes the nodes which are new since the last
+    call and drops the postings of the nodes which are gone, so the index of a node group can be kept for the
+    lifetime of the document and shared by the retrievers with the same parameters. Once built, the index follows
+    the changes reported by the store (``notify_add`` and ``notify_remove``), so queries do not scan the group.
+    Token lists are cached by the content of the chunk, so only the chunks whose text changed are tokenized when a
+    file is parsed again, and large batches can be tokenized in worker processes if
+    ``config['rag_bm25_tokenize_workers']`` is set. The token lists can be saved to and loaded from disk, so a
+    persistent store does not need to tokenize its nodes again after a restart.
+    """
+
+    def __init__(self, language: str = "en", k1: float = 1.5, b: float = 0.75) -> None:
+        if language not in ("en", "zh"): raise ValueError(f"Unsupported language '{language}' for BM25")
+        self._language, self._k1, self._b = language, k1, b
+        self._rows: Dict[str, int] = {}
+        self._nodes: List[Optional[DocNode]] = []
+        self._free: List[int] = []
+        self._tokens: Dict[str, List[str]] = {}
+        self._keys: Dict[str, str] = {}
+        self._lengths = np.zeros(0, dtype=np.float32)
+        self._total_length = 0
+        self._postings: Dict[str, Dict[int, int]] = {}
+        self._arrays: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+        self._loaded: Dict[str, List[str]] = {}
+        self._tracked = False
+        self.lock = threading.Lock()
+        self.changed = False
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def _tokenize(self, texts: List[str]) -> List[List[str]]:
+        return _tokenize_corpus(self._language, texts)
+
+    def _cached_tokens(self, key: str) -> Optional[List[str]]:
+        tokens = self._loaded.get(key)
+        return _token_cache.get(key) if tokens is None else tokens
+
+    def add(self, nodes: List[DocNode]) -> None:
+        nodes = list({node.uid: node for node in nodes if node.uid not in self._rows}.values())
+        texts = [node.get_text() for node in nodes]
+        keys = [_content_key(self._language, text) for text in texts]
+        tokens = {key: cached for key in set(keys) if (cached := self._cached_tokens(key)) is not None}
+        todo = {key: text for key, text in zip(keys, texts) if key not in tokens}
+        for key, node_tokens in zip(todo.keys(), self._tokenize(list(todo.values()))):
+            tokens[key] = node_tokens
+            _token_cache.put(key, node_tokens)
+        for node, key in zip(nodes, keys):
+            node_tokens = tokens[key]
+            row = self._free.pop() if self._free else len(self._nodes)
+            if row == len(self._nodes): self._nodes.append(None)
+            if row >= len(self._lengths):
+                self._lengths = np.concatenate([self._lengths, np.zeros(max(16, len(self._lengths)), np.float32)])
+            self._rows[node.uid], self._nodes[row], self._tokens[node.uid] = row, node, node_tokens
+            self._keys[node.uid] = key
+            self._lengths[row] = len(node_tokens)
+            self._total_length += len(node_tokens)
+            for term, tf in Counter(node_tokens).items():
+                self._postings.setdefault(term, {})[row] = tf
+                self._arrays.pop(term, None)
+        self.changed = self.changed or bool(nodes)
+
+    def remove(self, uids) -> None:
+        for uid in uids:
+            row, node_tokens = self._rows.pop(uid), self._tokens.pop(uid)
+            _token_cache.put(self._keys.pop(uid), node_tokens)  # the chunk may come back under another uid
+            for term in set(node_tokens):
+                postings = self._postings[term]
+                postings.pop(row)
+                if not postings: self._postings.pop(term)
+                self._arrays.pop(term, None)
+            self._total_length -= len(node_tokens)
+            self._nodes[row], self._lengths[row] = None, 0
+            self._free.append(row)
+            self.changed = True
+
+    def sync(self, nodes: List[DocNode]) -> None:
+        uids = set(map(attrgetter("uid"), nodes))
+        gone = self._rows.keys() - uids
+        if gone: self.remove(gone)
+        if len(self._rows) < len(uids): self.add([node for node in nodes if node.uid not in self._rows])
+        self._loaded.clear()
+
+    def update(self, nodes: List[DocNode]) -> bool:
+        # called with the lock held; nodes are all nodes of the group, only scanned when the index is built or when
+        # they do not match the nodes reported by the store since. Returns whether the nodes were scanned.
+        if self._tracked and len(nodes) == len(self._rows): return False
+        self.sync(nodes)
+        self._tracked = True
+        return True
+
+    def notify_add(self, nodes: List[DocNode]) -> bool:
+        # called with the lock held, nodes added to the store are tokenized when they are added, not on a query
+        if not self._tracked: return False
+        self.remove([node.uid for node in nodes if node.uid in self._rows])
+        self.add(nodes)
+        return True
+
+    def notify_remove(self, nodes: List[DocNode]) -> bool:
+        if not self._tracked: return False
+        self.remove([node.uid for node in nodes if node.uid in self._rows])
+        return True
+
+    def _term_arrays(self, term: str) -> Tuple[np.ndarray, np.ndarray]:
+        if term not in self._arrays:
+            postings = self._postings[term]
+            self._arrays[term] = (np.fromiter(postings.keys(), dtype=np.int64, count=len(postings)),
+                                  np.fromiter(postings.values(), dtype=np.float32, count=len(postings)))
+        return self._arrays[term]
+
+    def retrieve(self, query: str, topk: Optional[int] = None,
+                 candidates: Optional[List[DocNode]] = None) -> List[Tuple[DocNode, float]]:
+        # only the candidates are ranked if given, the statistics of the corpus still cover all nodes
+        n = len(self._rows)
+        if n == 0 or candidates == []: return []
+        scores = np.zeros(len(self._nodes), dtype=np.float32)
+        length_norm = self._k1 * (1 - self._b + self._b * self._lengths[:len(self._nodes)] * n / self._total_length) \
+            if self._total_length else np.full(len(self._nodes), self._k1, dtype=np.float32)
+        for term in self._tokenize([query])[0]:  # repeated query terms count repeatedly, as in bm25s
+            if term not in self._postings: continue
+            rows, tfs = self._term_arrays(term)
+            idf = np.log(1 + (n - len(rows) + 0.5) / (len(rows) + 0.5))
+            scores[rows] += (idf * tfs / (tfs + length_norm[rows])).astype(np.float32)
+        if candidates is not None:
+            selected = np.fromiter((self._rows[node.uid] for node in candidates), dtype=np.int64, count=len(candidates))
+            scores, n = scores[selected], len(candidates)
+        elif self._free: scores[self._free] = -np.inf
+        k = n if topk is None else min(topk, n)
+        rows = np.argpartition(-scores, k - 1)[:k] if 0 < k < len(scores) else np.arange(len(scores))[:k]
+        rows = rows[np.argsort(-scores[rows], kind="stable")]
+        if candidates is not None: return [(candidates[row], scores[row]) for row in rows]
+        return [(self._nodes[row], scores[row]) for row in rows]
+
+    def save(self, path: str) -> None:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(f"{path}.tmp", "wb") as f:
+            tokens = {self._keys[uid]: node_tokens for uid, node_tokens in self._tokens.items()}
+            pickle.dump(dict(language=self._language, keyed_by="content", tokens=tokens), f)
+        os.replace(f"{path}.tmp", path)
+        self.changed = False
+
+    def load(self, path: str) -> None:
+        # token lists are only kept until the next sync, for the chunks which are still in the store
+        if not os.path.exists(path): return
+        with open(path, "rb") as f:
+            data = pickle.load(f)
+        if data.get("language") == self._language and data.get("keyed_by") == "content":
+            self._loaded = data["tokens"]
+
 
 class BM25:
     """A BM25 retriever that uses the BM25 algorithm to retrieve nodes."""
@@ -16,32 +249,10 @@ class BM25:
         topk: int = 2,
         **kwargs,
     ) -> None:
-        if language == "en":
-            self._stemmer = Stemmer.Stemmer("english")
-            self._stopwords = language
-            self._tokenizer = lambda t: t
-        elif language == "zh":
-            self._stemmer = None
-            # TODO(ywt): after bm25s supports cn stopwards, update this
-            self._stopwords = STOPWORDS_CHINESE
-            self._tokenizer = lambda t: " ".join(jieba.lcut(t))
         self.topk = min(topk, len(nodes))
         self.nodes = nodes
-
-        corpus_tokens = bm25s.tokenize(
-            [self._tokenizer(node.get_text()) for node in nodes],
-            stopwords=self._stopwords,
-            stemmer=self._stemmer,
-        )
-        self.bm25 = bm25s.BM25()
-        self.bm25.index(corpus_tokens)
+        self._index = BM25Index(language)
+        self._index.add(nodes)
 
     def retrieve(self, query: str) -> List[Tuple[DocNode, float]]:
-        tokenized_query = bm25s.tokenize(
-            self._tokenizer(query), stopwords=self._stopwords, stemmer=self._stemmer
-        )
-        indexs, scores = self.bm25.retrieve(tokenized_query, k=self.topk)
-        results = []
-        for idx, score in zip(indexs[0], scores[0]):
-            results.append((self.nodes[idx], score))
-        return results
+        return self._index.retrieve(query, self.topk)
@@ -1,13 +1,14 @@
-import ast
 from collections import defaultdict
-from functools import wraps
-from typing import Callable, Dict, List, Optional, Set, Union
+from typing import Any, Callable, Dict, List, Optional, Union
 from lazyllm import LOG, config, once_wrapper
 from .transform import (NodeTransform, FuncNodeTransform, SentenceSplitter, LLMParser,
                         AdaptiveTransform, make_transform, TransformArgs)
-from .store import MapStore, DocNode, ChromadbStore, LAZY_ROOT_NAME, BaseStore
+from .store import MapStore, DocNode, ChromadbStore, LAZY_ROOT_NAME, BaseStore, _LazyGroupNodes
 from .data_loaders import DirectoryReader
 from .index import DefaultIndex
+from .ann_index import StoreIndex, ann_indices
+from .embed_cache import EmbeddingCache
+from .result_cache import ResultCache
 
 _transmap = dict(function=FuncNodeTransform, sentencesplitter=SentenceSplitter, llm=LLMParser)
 
@@ -15,13 +16,7 @@ _transmap = dict(function=FuncNodeTransform, sentencesplitter=SentenceSplitter,
 def embed_wrapper(func):
     if not func:
         return None
-
-    @wraps(func)
-    def wrapper(*args, **kwargs) -> List[float]:
-        result = func(*args, **kwargs)
-        return ast.literal_eval(result) if isinstance(result, str) else result
-
-    return wrapper
+    return func if isinstance(func, EmbeddingCache) else EmbeddingCache(func)
 
 
 class DocImpl:
@@ -29,12 +24,14 @@ class DocImpl:
     _global_node_groups = {}
 
     def __init__(self, embed, doc_files=Optional[List[str]], local_readers: Optional[Dict] = None,
-                 global_readers: Optional[Dict] = None, **kwargs):
+                 global_readers: Optional[Dict] = None, result_cache_size: Optional[int] = None, **kwargs):
         super().__init__()
         self.directory_reader = DirectoryReader(doc_files, local_readers=local_readers, global_readers=global_readers)
         self.node_groups: Dict[str, Dict] = {LAZY_ROOT_NAME: {}}
         self.embed = embed_wrapper(embed)
         self.store = None
+        self._ann_indices = {}
+        self._result_cache = ResultCache(result_cache_size)
 
     @once_wrapper(reset_on_pickle=True)
     def _lazy_init(self) -> None:
@@ -44,7 +41,7 @@ class DocImpl:
         self.node_groups = node_groups
 
         self.store = self._get_store()
-        self.index = DefaultIndex(self.embed, self.store)
+        self.index = DefaultIndex(self.embed, self.store, persist_path=self._persist_path())
         if not self.store.has_nodes(LAZY_ROOT_NAME):
             root_nodes = self.directory_reader.load_data()
             self.store.add_nodes(root_nodes)
@@ -119,6 +116,7 @@ class DocImpl:
         if len(input_files) == 0:
             return
         self._lazy_init()
+        self._result_cache.bump()
         root_nodes = self.directory_reader.load_data(input_files)
         temp_store = self._get_store()
         temp_store.add_nodes(root_nodes)
@@ -129,6 +127,7 @@ class DocImpl:
             nodes = self._get_nodes(group, temp_store)
             self.store.add_nodes(nodes)
             LOG.debug(f"Merge {group} with {nodes}")
+        self._result_cache.bump()
 
     def delete_files(self, input_files: List[str]) -> None:
         self._lazy_init()
@@ -136,7 +135,9 @@ class DocImpl:
         LOG.info(f"delete_files: removing documents {input_files} and nodes {docs}")
         if len(docs) == 0:
             return
+        self._result_cache.bump()
         self._delete_nodes_recursively(docs)
+        self._result_cache.bump()
 
     def _delete_nodes_recursively(self, root_nodes: List[DocNode]) -> None:
         nodes_to_delete = defaultdict(list)
@@ -171,37 +172,80 @@ class DocImpl:
         store.add_nodes(nodes)
         LOG.debug(f"building {group_name} nodes: {nodes}")
 
-    def _get_nodes(self, group_name: str, store: Optional[BaseStore] = None) -> List[DocNode]:
+    def _get_nodes(self, group_name: str, store: Optional[BaseStore] = None, lazy: bool = False) -> List[DocNode]:
+        # lazy: the nodes are traversed when they are first used, for the indices which search the store itself
         store = store or self.store
         self._dynamic_create_nodes(group_name, store)
-        return store.traverse_nodes(group_name)
+        return _LazyGroupNodes(store, group_name) if lazy else store.traverse_nodes(group_name)
 
     def retrieve(self, query: str, group_name: str, similarity: str, similarity_cut_off: float,
-                 index: str, topk: int, similarity_kws: dict) -> List[DocNode]:
+                 index: str, topk: int, similarity_kws: dict, with_score: bool = False,
+                 filters: Optional[Dict[str, Any]] = None) -> List[DocNode]:
         self._lazy_init()
-        if index:
-            assert index == "default", "we only support default index currently"
-        nodes = self._get_nodes(group_name)
-        return self.index.query(
-            query, nodes, similarity, similarity_cut_off, topk, **similarity_kws
+        cache = self._result_cache
+        if cache.enabled:
+            key = cache.key(query, group_name, similarity, similarity_cut_off, index, topk, with_score, repr(filters),
+                            **similarity_kws)
+            if (result := cache.get(key)) is not None: return result
+        index = self._get_index(index)
+        nodes = self._get_nodes(group_name, lazy=isinstance(index, StoreIndex))
+        result = index.query(
+            query, nodes, similarity, similarity_cut_off, topk, with_score=with_score,
+            candidates=self._filter_nodes(group_name, filters), **similarity_kws
         )
+        if cache.enabled: cache.put(key, result)
+        return result
 
-    def find_parent(self, nodes: List[DocNode], group: str) -> List[DocNode]:
-        def recurse_parents(node: DocNode, visited: Set[DocNode]) -> None:
-            if node.parent:
-                if node.parent.group == group:
-                    visited.add(node.parent)
-                recurse_parents(node.parent, visited)
+    def retrieve_batch(self, queries: List[str], group_name: str, similarity: str, similarity_cut_off: float,
+                       index: str, topk: int, similarity_kws: dict, with_score: bool = False,
+                       filters: Optional[Dict[str, Any]] = None) -> List[List[DocNode]]:
+        self._lazy_init()
+        cache = self._result_cache
+        keys = [cache.key(query, group_name, similarity, similarity_cut_off, index, topk, with_score, repr(filters),
+                          **similarity_kws) for query in queries] if cache.enabled else [None] * len(queries)
+        results = [cache.get(key) for key in keys] if cache.enabled else [None] * len(queries)
+        todo = [i for i, result in enumerate(results) if result is None]
+        if todo:
+            index = self._get_index(index)
+            nodes = self._get_nodes(group_name, lazy=isinstance(index, StoreIndex))
+            computed = index.query_batch(
+                [queries[i] for i in todo], nodes, similarity, similarity_cut_off, topk, with_score=with_score,
+                candidates=self._filter_nodes(group_name, filters), **similarity_kws
+            )
+            for i, result in zip(todo, computed):
+                results[i] = result
+                if cache.enabled: cache.put(keys[i], result)
+        return results
+
+    def _filter_nodes(self, group_name: str, filters: Optional[Dict[str, Any]]) -> Optional[List[DocNode]]:
+        # nodes whose metadata matches the filters, or None to score the whole group
+        return self.store.filter_nodes(group_name, filters) if filters else None
+
+    def result_cache_stats(self) -> Dict[str, Any]:
+        return self._result_cache.stats()
+
+    @staticmethod
+    def _persist_path() -> Optional[str]:
+        return config["rag_persistent_path"] if config["rag_store_type"] == "chroma" else None
 
-        result = set()
+    def _get_index(self, index: Optional[str]) -> DefaultIndex:
+        if not index or index == "default": return self.index
+        assert index in ann_indices, f"Unsupported index {index}, available: {['default'] + list(ann_indices)}"
+        if index not in self._ann_indices:
+            self._ann_indices[index] = ann_indices[index](self.embed, self.store, persist_path=self._persist_path())
+        return self._ann_indices[index]
+
+    def find_parent(self, nodes: List[DocNode], group: str) -> List[DocNode]:
+        # a lookup in the ancestry index of the store, whatever the depth of the group above the nodes
+        result = {}
         for node in nodes:
-            recurse_parents(node, result)
+            if (parent := self.store.find_ancestor(node, group)) is not None: result.setdefault(parent.uid, parent)
         if not result:
             LOG.warning(
                 f"We can not find any nodes for group `{group}`, please check your input"
             )
         LOG.debug(f"Found parent node for {group}: {result}")
-        return list(result)
+        return list(result.values())
 
     def find_children(self, nodes: List[DocNode], group: str) -> List[DocNode]:
         active_groups = self.store.active_groups()
@@ -210,41 +254,9 @@ class DocImpl:
                 f"group {group} not found in active groups {active_groups}, please retrieve the group first."
             )
 
-        def recurse_children(node: DocNode, visited: Set[DocNode]) -> bool:
-            if group in node.children:
-                visited.update(node.children[group])
-                return True
-
-            found_in_any_child = False
-
-            for children_list in node.children.values():
-                for child in children_list:
-                    if recurse_children(child, visited):
-                        found_in_any_child = True
-                    else:
-                        break
-
-            return found_in_any_child
-
-        result = set()
-
+        result = {}
         for node in nodes:
-            if group in node.children:
-                result.update(node.children[group])
-            else:
-                LOG.log_once(
-                    f"Fetching children that are not in direct relationship might be slower. "
-                    f"We recommend first fetching through direct children {list(node.children.keys())}, "
-                    f"then using `find_children()` again for deeper levels.",
-                    level="warning",
-                )
-                # Note: the input nodes are the same type
-                if not recurse_children(node, result):
-                    LOG.warning(
-                        f"Node {node} and its children do not contain any nodes with the group `{group}`. "
-                        "Skipping further search in this branch."
-                    )
-                    break
+            for child in self.store.find_descendants(node, group): result.setdefault(child.uid, child)
 
         if not result:
             LOG.warning(
@@ -252,7 +264,7 @@ class DocImpl:
             )
 
         LOG.debug(f"Found children nodes for {group}: {result}")
-        return list(result)
+        return list(result.values())
 
 
 DocImpl._create_builtin_node_group(name="CoarseChunk", transform=SentenceSplitter, chunk_size=1024, chunk_overlap=100)
@@ -1,6 +1,6 @@
 from functools import partial
 
-from typing import Callable, Optional, Dict
+from typing import Any, Callable, Optional, Dict
 import lazyllm
 from lazyllm import ModuleBase, TrainableModule, DynamicDescriptor
 
@@ -13,7 +13,8 @@ from .doc_polling import DocPolling
 class Document(ModuleBase):
     _registered_file_reader: Dict[str, Callable] = {}
 
-    def __init__(self, doc_name: str, embed: Optional[TrainableModule] = None, clear_cache: bool = False):
+    def __init__(self, doc_name: str, embed: Optional[TrainableModule] = None, clear_cache: bool = False,
+                 result_cache_size: Optional[int] = None):
         super().__init__()
 
         self._local_file_reader: Dict[str, Callable] = {}
@@ -27,7 +28,8 @@ class Document(ModuleBase):
             doc_files=files, 
             embed=embed, 
             local_readers=self._local_file_reader,
-            global_readers=self._registered_file_reader
+            global_readers=self._registered_file_reader,
+            result_cache_size=result_cache_size
         )
         DocPolling.start_polling(kb_name=doc_name, doc_impl=self._impl)
 
@@ -38,6 +40,9 @@ class Document(ModuleBase):
     def forward(self, func_name: str, *args, **kwargs):
         return getattr(self._impl, func_name)(*args, **kwargs)
 
+    def result_cache_stats(self) -> Dict[str, Any]:
+        return self.forward("result_cache_stats")
+
     def find_parent(self, group: str) -> Callable:
         return partial(self.forward, "find_parent", group=group)
 
@@ -0,0 +1,193 @@
+import ast
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Callable, List, Optional
+
+import numpy as np
+from lazyllm import LOG, config
+
+config.add("rag_embed_cache_path", str, os.path.join(config["home"], "rag_embed_cache.db"), "RAG_EMBED_CACHE_PATH")
+config.add("rag_embed_cache_size", int, 4096, "RAG_EMBED_CACHE_SIZE")
+config.add("rag_embed_cache_max_entries", int, 200000, "RAG_EMBED_CACHE_MAX_ENTRIES")  # 0: unlimited
+
+
+def _embed_identity(embed: Callable) -> Optional[str]:
+    # Only embedders whose model can be named are cached on disk; the vectors of an arbitrary callable
+    # may change between runs without its name changing.
+    if getattr(embed, "_embed_model_name", None):
+        return f"{type(embed).__name__}:{embed._embed_model_name}@{getattr(embed, '_embed_url', '')}"
+    base_model = getattr(embed, "base_model", None)
+    if isinstance(base_model, str) and base_model:
+        # a fine-tuned model is told apart by where it is saved, a model served elsewhere by its url
+        impl = getattr(embed, "_impl", None)
+        target = getattr(impl, "_specific_target_path", None) or ""
+        if not target and getattr(impl, "_trainset", None):
+            target = f"{getattr(impl, '_target_path', '')}:{impl._trainset}"
+        url = (getattr(impl, "_deploy_args", None) or {}).get("url") or ""
+        return f"{type(embed).__name__}:{base_model}:{target}@{url}"
+    return None
+
+
+class _DiskCache(object):
+    # The oldest vectors are evicted when the file holds more than max_entries of them; the count is only read
+    # from the file when it is opened and after an eviction.
+    def __init__(self, path: str, max_entries: Optional[int] = None):
+        self._path = path
+        self._max_entries = config["rag_embed_cache_max_entries"] if max_entries is None else max_entries
+        self._conn, self._lock = None, threading.Lock()
+        self._count = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self._path)), exist_ok=True)
+            self._conn = sqlite3.connect(self._path, check_same_thread=False, timeout=30)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vec BLOB NOT NULL)")
+            self._conn.commit()
+            self._count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        return self._conn
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        with self._lock:
+            row = self._connect().execute("SELECT vec FROM embeddings WHERE key = ?", (key,)).fetchone()
+        return np.frombuffer(row[0], dtype=np.float32) if row else None
+
+    def put(self, key: str, vec: np.ndarray) -> None:
+        with self._lock:
+            conn = self._connect()
+            conn.execute("INSERT OR REPLACE INTO embeddings (key, vec) VALUES (?, ?)", (key, vec.tobytes()))
+            self._count += 1  # a replaced key is counted again, the count is exact again after the check below
+            if 0 < self._max_entries < self._count:
+                self._count = conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+                if self._count > self._max_entries:
+                    # rows are replaced with a new rowid, so the smallest rowids are the vectors written longest ago
+                    evict = self._count - max(self._max_entries * 9 // 10, 1)
+                    conn.execute("DELETE FROM embeddings WHERE rowid IN "
+                                 "(SELECT rowid FROM embeddings ORDER BY rowid LIMIT ?)", (evict,))
+                    self._count -= evict
+            conn.commit()
+
+    def __getstate__(self):
+        return dict(_path=self._path, _max_entries=self._max_entries)
+
+    def __setstate__(self, state):
+        self.__init__(state["_path"], state["_max_entries"])
+
+
+class EmbeddingCache(object):
+    """Content-addressed cache in front of an embedding model.
+
+    Vectors are returned as read-only float32 numpy arrays and keyed by a hash of the text together with the
+    identity of the embedder. Queries go through an in-memory LRU cache, while the chunks of the knowledge base
+    (``corpus``) are also kept in an sqlite file, so re-ingesting a mostly unchanged knowledge base only embeds the
+    chunks which changed. The identity is taken from the model name of online embedding modules and from
+    ``base_model`` of TrainableModule; for other callables pass ``identity`` explicitly, otherwise only the
+    in-memory cache is used.
+    """
+
+    def __init__(self, embed: Callable, identity: Optional[str] = None, path: Optional[str] = None,
+                 max_size: Optional[int] = None):
+        self._embed = embed
+        self._identity = identity or _embed_identity(embed)
+        path = config["rag_embed_cache_path"] if path is None else path
+        self._disk = _DiskCache(path) if path and self._identity else None
+        self._max_size = config["rag_embed_cache_size"] if max_size is None else max_size
+        self._lru, self._lock = OrderedDict(), threading.Lock()
+        self.hits = self.misses = 0
+
+    @property
+    def identity(self) -> Optional[str]:
+        return self._identity
+
+    def _key(self, text: str) -> str:
+        return hashlib.sha256(f"{self._identity or id(self._embed)}\0{text}".encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _to_array(result) -> np.ndarray:
+        if isinstance(result, str):
+            # json text is still accepted from online models and from servers of older versions
+            try: result = json.loads(result)
+            except ValueError: result = ast.literal_eval(result)
+        vec = np.asarray(result, dtype=np.float32)
+        vec.flags.writeable = False  # shared by the cache and by every node with the same text
+        return vec
+
+    def _compute(self, text: str) -> np.ndarray:
+        return self._to_array(self._embed(text))
+
+    def _compute_batch(self, texts: List[str]) -> List[np.ndarray]:
+        if len(texts) > 1:
+            # embedding modules take a list of texts, but an arbitrary callable may only take a single one
+            try:
+                vecs = self._to_array(self._embed(texts))
+                if vecs.ndim == 2 and len(vecs) == len(texts): return list(vecs)
+            except Exception as e:
+                LOG.debug(f"Failed to embed {len(texts)} texts in one call, embed them one by one: {e}")
+        return [self._compute(text) for text in texts]
+
+    def _lru_get(self, key: str) -> Optional[np.ndarray]:
+        with self._lock:
+            vec = self._lru.get(key)
+            if vec is not None: self._lru.move_to_end(key)
+            return vec
+
+    def _lru_put(self, key: str, vec: np.ndarray) -> None:
+        if self._max_size <= 0: return
+        with self._lock:
+            self._lru[key] = vec
+            self._lru.move_to_end(key)
+            while len(self._lru) > self._max_size: self._lru.popitem(last=False)
+
+    def __call__(self, text: str) -> np.ndarray:
+        if not isinstance(text, str): return self._compute(text)
+        key = self._key(text)
+        if (vec := self._lru_get(key)) is not None:
+            self.hits += 1
+            return vec
+        self.misses += 1
+        vec = self._compute(text)
+        self._lru_put(key, vec)
+        return vec
+
+    def batch(self, texts: List[str]) -> List[np.ndarray]:
+        """Embed a list of queries, the ones which are not cached are sent to the model in a single call."""
+        keys = [self._key(text) for text in texts]
+        vecs = [self._lru_get(key) for key in keys]
+        todo = {key: text for key, text, vec in zip(keys, texts, vecs) if vec is None}
+        self.hits += len(texts) - len(todo)
+        self.misses += len(todo)
+        computed = dict(zip(todo.keys(), self._compute_batch(list(todo.values()))))
+        for key, vec in computed.items(): self._lru_put(key, vec)
+        return [computed[key] if vec is None else vec for key, vec in zip(keys, vecs)]
+
+    def corpus(self, text: str) -> np.ndarray:
+        if self._disk is None: return self(text)
+        key = self._key(text)
+        try:
+            vec = self._disk.get(key)
+        except sqlite3.Error as e:
+            LOG.warning(f"Failed to read the embedding cache: {e}")
+            vec = None
+        if vec is not None:
+            self.hits += 1
+            return vec
+        self.misses += 1
+        vec = self._compute(text)
+        try:
+            self._disk.put(key, vec)
+        except sqlite3.Error as e:
+            LOG.warning(f"Failed to write the embedding cache: {e}")
+        return vec
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_lru"], state["_lock"] = OrderedDict(), None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
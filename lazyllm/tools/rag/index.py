@@ -1,9 +1,12 @@
 import concurrent
 import os
-from typing import List, Callable, Optional
+import threading
+from operator import attrgetter
+from typing import Any, Dict, List, Callable, Optional, Tuple, Union
 from .store import DocNode, BaseStore
 import numpy as np
-from .component.bm25 import BM25
+from .component.bm25 import BM25Index
+from .embed_cache import EmbeddingCache
 from lazyllm import LOG, config, ThreadPoolExecutor
 
 # min(32, (os.cpu_count() or 1) + 4) is the default number of workers for ThreadPoolExecutor
@@ -15,14 +18,187 @@ config.add(
 )
 
 
+def _top_rows(order: np.ndarray, topk: Optional[int]) -> np.ndarray:
+    # indices of the topk smallest values in ascending order; only the winners are sorted
+    if topk is not None and topk < len(order):
+        rows = np.argpartition(order, topk - 1)[:topk] if topk > 0 else np.zeros(0, dtype=np.int64)
+        return rows[np.argsort(order[rows], kind="stable")]
+    return np.argsort(order, kind="stable")
+
+
+class _EmbeddingMatrix(object):
+    """L2-normalized float32 embeddings of one node group, stored as the rows of a contiguous matrix.
+
+    The matrix is kept in sync with the nodes of the group incrementally: new nodes are appended (the capacity is
+    doubled when needed) and the row of a removed node is filled with the last row. Once the matrix has been built
+    from the nodes of the group, the store tells it about the nodes added and removed since, so a query only embeds
+    and appends the new nodes instead of scanning the group.
+    """
+
+    def __init__(self):
+        self._mat: Optional[np.ndarray] = None
+        self._nodes: List[DocNode] = []
+        self._rows: Dict[str, int] = {}
+        self._pending: Dict[str, DocNode] = {}
+        self._tracked = False
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._nodes)
+
+    @property
+    def matrix(self) -> np.ndarray:
+        return self._mat[:len(self._nodes)] if self._mat is not None else np.zeros((0, 0), dtype=np.float32)
+
+    @property
+    def nodes(self) -> List[DocNode]:
+        return self._nodes
+
+    def sync(self, nodes: List[DocNode]) -> None:
+        uids = set(map(attrgetter("uid"), nodes))
+        gone = self._rows.keys() - uids
+        if gone: self.remove(gone)
+        if len(self._rows) < len(uids): self.add([node for node in nodes if node.uid not in self._rows])
+
+    def add(self, nodes: List[DocNode]) -> None:
+        vecs = np.asarray([node.embedding for node in nodes], dtype=np.float32)
+        norms = np.linalg.norm(vecs, axis=1, keepdims=True)
+        vecs = vecs / np.where(norms == 0, 1, norms)
+        size = len(self._nodes)
+        if self._mat is None or self._mat.shape[1] != vecs.shape[1]:
+            assert size == 0, "All embeddings of a node group should have the same dimension"
+            self._mat = np.empty((max(len(nodes), 16), vecs.shape[1]), dtype=np.float32)
+        elif size + len(nodes) > self._mat.shape[0]:
+            mat = np.empty((max(size + len(nodes), 2 * self._mat.shape[0]), self._mat.shape[1]), dtype=np.float32)
+            mat[:size] = self._mat[:size]
+            self._mat = mat
+        self._mat[size:size + len(nodes)] = vecs
+        for i, node in enumerate(nodes, size): self._rows[node.uid] = i
+        self._nodes.extend(nodes)
+        self._on_add(size, vecs)
+
+    def remove(self, uids) -> None:
+        for uid in uids:
+            row, last = self._rows.pop(uid), len(self._nodes) - 1
+            self._on_remove(row)
+            if row != last:
+                self._mat[row] = self._mat[last]
+                self._nodes[row] = self._nodes[last]
+                self._rows[self._nodes[row].uid] = row
+                self._on_move(last, row)
+            self._nodes.pop()
+
+    def notify_add(self, nodes: List[DocNode]) -> None:
+        with self.lock:
+            if not self._tracked: return
+            for node in nodes:
+                if node.uid in self._rows: self.remove([node.uid])
+                self._pending[node.uid] = node
+
+    def notify_remove(self, nodes: List[DocNode]) -> None:
+        with self.lock:
+            if not self._tracked: return
+            for node in nodes:
+                if self._pending.pop(node.uid, None) is None and node.uid in self._rows: self.remove([node.uid])
+
+    def update(self, nodes: List[DocNode], embed: Callable[[List[DocNode]], Any]) -> None:
+        # called with the lock held; nodes are all nodes of the group, only scanned when the matrix is built or
+        # when they do not match what the store reported (e.g. nodes which are not kept in a store)
+        if not self._tracked or len(nodes) != len(self._nodes) + len(self._pending):
+            self._pending.clear()
+            embed(nodes)
+            self.sync(nodes)
+            self._tracked = True
+        elif self._pending:
+            nodes = list(self._pending.values())
+            self._pending.clear()
+            embed(nodes)
+            self.add(nodes)
+
+    # hooks for subclasses which keep extra data per row
+    def _on_add(self, start: int, vecs: np.ndarray) -> None: pass
+    def _on_remove(self, row: int) -> None: pass
+    def _on_move(self, src: int, dst: int) -> None: pass
+
+    def rows(self, nodes: List[DocNode]) -> np.ndarray:
+        return np.fromiter((self._rows[node.uid] for node in nodes), dtype=np.int64, count=len(nodes))
+
+    def topk(self, scores: np.ndarray, topk: Optional[int], descend: bool,
+             rows: Optional[np.ndarray] = None) -> List[Tuple[DocNode, float]]:
+        # scores are given for the selected rows only, if rows is given
+        top = _top_rows(-scores if descend else scores, topk)
+        return [(self._nodes[i if rows is None else rows[i]], float(scores[i])) for i in top]
+
+
+def _by_group(nodes: List[DocNode]) -> List[Tuple[str, List[DocNode]]]:
+    groups: Dict[str, List[DocNode]] = {}
+    for node in nodes: groups.setdefault(node.group, []).append(node)
+    return list(groups.items())
+
+
 class DefaultIndex:
     """Default Index, registered for similarity functions"""
 
     registered_similarity = dict()
 
-    def __init__(self, embed: Callable, store: BaseStore, **kwargs):
+    def __init__(self, embed: Callable, store: BaseStore, persist_path: Optional[str] = None, **kwargs):
         self.embed = embed
         self.store = store
+        self._persist_path = persist_path
+        self._matrices: Dict[Optional[str], _EmbeddingMatrix] = {}
+        self._keyword_indices: Dict[Tuple[str, Optional[str], str], Any] = {}
+        self._lock = threading.Lock()
+        store.add_observer(self)
+
+    def on_nodes_added(self, nodes: List[DocNode]) -> None:
+        for group, group_nodes in _by_group(nodes):
+            if (matrix := self._matrices.get(group)) is not None: matrix.notify_add(group_nodes)
+            for (name, _), index in self._group_keyword_indices(group):
+                with index.lock:
+                    if index.notify_add(group_nodes): self._save_keyword_index(index, name, group)
+
+    def on_nodes_removed(self, nodes: List[DocNode]) -> None:
+        for group, group_nodes in _by_group(nodes):
+            if (matrix := self._matrices.get(group)) is not None: matrix.notify_remove(group_nodes)
+            for (name, _), index in self._group_keyword_indices(group):
+                with index.lock:
+                    if index.notify_remove(group_nodes): self._save_keyword_index(index, name, group)
+
+    def _group_keyword_indices(self, group: Optional[str]) -> List[Tuple[Tuple[str, str], Any]]:
+        with self._lock:
+            return [((name, kw), index) for (name, g, kw), index in self._keyword_indices.items() if g == group]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_matrices"], state["_keyword_indices"], state["_lock"] = {}, {}, None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _get_matrix(self, group: Optional[str]) -> _EmbeddingMatrix:
+        with self._lock:
+            if group not in self._matrices: self._matrices[group] = _EmbeddingMatrix()
+            return self._matrices[group]
+
+    def _path(self, group: Optional[str], suffix: str) -> Optional[str]:
+        # indices are persisted next to the store, if the store itself is persistent
+        return os.path.join(self._persist_path, f"{group}.{suffix}") if self._persist_path and group else None
+
+    def _get_keyword_index(self, name: str, group: Optional[str], factory: Callable, **kwargs):
+        # retrievers with different parameters (e.g. k1 and b of bm25) get indices of their own
+        key = (name, group, repr(sorted(kwargs.items())))
+        with self._lock:
+            if key not in self._keyword_indices:
+                index = factory(**kwargs)
+                if (path := self._path(group, name)): index.load(path)
+                self._keyword_indices[key] = index
+            return self._keyword_indices[key]
+
+    def _save_keyword_index(self, index, name: str, group: Optional[str]) -> None:
+        # called with the lock of the index held, when the index was built or changed by the store
+        if index.changed and (path := self._path(group, name)): index.save(path)
 
     @classmethod
     def register_similarity(
@@ -33,8 +209,13 @@ class DefaultIndex:
         batch: bool = False,
     ) -> Callable:
         def decorator(f):
+            if mode == "keyword":
+                # f creates the inverted index of a node group, which DefaultIndex keeps in sync with the group
+                cls.registered_similarity[f.__name__] = (f, mode, descend)
+                return f
+
             def wrapper(query, nodes, **kwargs):
-                if batch:
+                if batch or mode == "matrix":
                     return f(query, nodes, **kwargs)
                 else:
                     return [(node, f(query, node, **kwargs)) for node in nodes]
@@ -45,16 +226,38 @@ class DefaultIndex:
         return decorator(func) if func else decorator
 
     def _parallel_do_embedding(self, nodes: List[DocNode]) -> List[DocNode]:
+        # chunks of the knowledge base are cached on disk, unlike queries
+        embed = self.embed.corpus if isinstance(self.embed, EmbeddingCache) else self.embed
         with ThreadPoolExecutor(config["max_embedding_workers"]) as executor:
             futures = {
-                executor.submit(node.do_embedding, self.embed): node
+                executor.submit(node.do_embedding, embed): node
                 for node in nodes
                 if not node.has_embedding()
             }
             for future in concurrent.futures.as_completed(futures):
                 future.result()
+        # only the nodes embedded now are saved, by the background writer of a persistent store
+        if futures: self.store.try_save_nodes(list(futures.values()))
         return nodes
 
+    def _get_similarity(self, similarity_name: str) -> Tuple[Callable, str, bool]:
+        if similarity_name not in self.registered_similarity:
+            raise ValueError(
+                f"{similarity_name} not registered, please check your input."
+                f"Available options now: {self.registered_similarity.keys()}"
+            )
+        return self.registered_similarity[similarity_name]
+
+    def _embed_queries(self, queries: List[str]) -> np.ndarray:
+        # one row per query, L2-normalized; uncached queries are embedded in a single call of the model
+        assert self.embed, "Chosen similarity needs embed model."
+        assert all(len(query) > 0 for query in queries), "Query should not be empty."
+        vecs = self.embed.batch(queries) if isinstance(self.embed, EmbeddingCache) else \
+            [self.embed(query) for query in queries]
+        vecs = np.asarray(vecs, dtype=np.float32).reshape(len(queries), -1)
+        norms = np.linalg.norm(vecs, axis=1, keepdims=True)
+        return vecs / np.where(norms == 0, 1, norms)
+
     def query(
         self,
         query: str,
@@ -62,53 +265,105 @@ class DefaultIndex:
         similarity_name: str,
         similarity_cut_off: float,
         topk: int,
+        *,
+        with_score: bool = False,
+        candidates: Optional[List[DocNode]] = None,
         **kwargs,
-    ) -> List[DocNode]:
-        if similarity_name not in self.registered_similarity:
-            raise ValueError(
-                f"{similarity_name} not registered, please check your input."
-                f"Available options now: {self.registered_similarity.keys()}"
-            )
-        similarity_func, mode, descend = self.registered_similarity[similarity_name]
+    ) -> Union[List[DocNode], List[Tuple[DocNode, float]]]:
+        # candidates (e.g. the nodes matching a metadata filter) are the only nodes scored; nodes is still the
+        # whole group, which the per-group matrices and keyword indices are kept in sync with
+        similarity_func, mode, descend = self._get_similarity(similarity_name)
+        if candidates is not None and mode not in ("matrix", "keyword"): nodes, candidates = candidates, None
 
-        if mode == "embedding":
+        if mode in ("embedding", "matrix"):
             assert self.embed, "Chosen similarity needs embed model."
             assert len(query) > 0, "Query should not be empty."
             query_embedding = self.embed(query)
+            if mode == "matrix":
+                return self._query_matrix(query, query_embedding, nodes, similarity_func, descend,
+                                          similarity_cut_off, topk, with_score, candidates, **kwargs)
             nodes = self._parallel_do_embedding(nodes)
-            self.store.try_save_nodes(nodes)
             similarities = similarity_func(query_embedding, nodes, topk=topk, **kwargs)
         elif mode == "text":
             similarities = similarity_func(query, nodes, topk=topk, **kwargs)
+        elif mode == "keyword":
+            if not nodes: return []
+            group = nodes[0].group
+            index = self._get_keyword_index(similarity_name, group, similarity_func, **kwargs)
+            with index.lock:
+                if index.update(nodes): self._save_keyword_index(index, similarity_name, group)
+                similarities = index.retrieve(query, topk, candidates)
         else:
             raise NotImplementedError(f"Mode {mode} is not supported.")
 
         similarities.sort(key=lambda x: x[1], reverse=descend)
         if topk is not None:
             similarities = similarities[:topk]
+        return self._results(query, similarities, similarity_cut_off, with_score)
+
+    @staticmethod
+    def _results(query: str, similarities: List[Tuple[DocNode, float]], similarity_cut_off: float,
+                 with_score: bool) -> Union[List[DocNode], List[Tuple[DocNode, float]]]:
+        results = [(node, score) for node, score in similarities if score > similarity_cut_off]
+        LOG.debug(f"Retrieving query `{query}` and get results: {[node for node, _ in results]}")
+        return results if with_score else [node for node, _ in results]
+
+    def query_batch(self, queries: List[str], nodes: List[DocNode], similarity_name: str,
+                    similarity_cut_off: float, topk: int, *, with_score: bool = False,
+                    candidates: Optional[List[DocNode]] = None, **kwargs) -> List[List]:
+        """Retrieve the nodes of every query; returns one list of nodes per query, in the order of the queries.
+
+        For similarities of the matrix mode (e.g. cosine) all queries are embedded together and scored against
+        the node group with a single matrix-matrix product; other similarities are queried one by one.
+        """
+        similarity_func, mode, descend = self._get_similarity(similarity_name)
+        if mode != "matrix" or not nodes or not queries:
+            if mode == "embedding" and isinstance(self.embed, EmbeddingCache): self.embed.batch(queries)
+            return [self.query(query, nodes, similarity_name, similarity_cut_off, topk, with_score=with_score,
+                               candidates=candidates, **kwargs) for query in queries]
+        query_embeddings = self._embed_queries(queries)
+        matrix = self._get_matrix(nodes[0].group)
+        with matrix.lock:
+            matrix.update(nodes, self._parallel_do_embedding)
+            rows = None if candidates is None else matrix.rows(candidates)
+            scores = np.asarray(similarity_func(query_embeddings, matrix.matrix if rows is None else
+                                                matrix.matrix[rows], topk=topk, **kwargs))
+            similarities = [matrix.topk(column, topk, descend, rows) for column in scores.T]
+        return [self._results(query, sims, similarity_cut_off, with_score) for query, sims in zip(queries, similarities)]
 
-        results = [node for node, score in similarities if score > similarity_cut_off]
-        LOG.debug(f"Retrieving query `{query}` and get results: {results}")
-        return results
+    def _query_matrix(self, query: str, query_embedding, nodes: List[DocNode], similarity_func: Callable,
+                      descend: bool, similarity_cut_off: float, topk: int, with_score: bool = False,
+                      candidates: Optional[List[DocNode]] = None, **kwargs):
+        if not nodes: return []
+        query_embedding = np.asarray(query_embedding, dtype=np.float32)
+        norm = np.linalg.norm(query_embedding)
+        if norm > 0: query_embedding = query_embedding / norm
+        matrix = self._get_matrix(nodes[0].group)
+        with matrix.lock:
+            matrix.update(nodes, self._parallel_do_embedding)
+            rows = None if candidates is None else matrix.rows(candidates)
+            scores = np.asarray(similarity_func(query_embedding, matrix.matrix if rows is None else
+                                                matrix.matrix[rows], topk=topk, **kwargs))
+            similarities = matrix.topk(scores, topk, descend, rows)
+        return self._results(query, similarities, similarity_cut_off, with_score)
 
 
-@DefaultIndex.register_similarity(mode="text", batch=True)
-def bm25(query: str, nodes: List[DocNode], **kwargs) -> List:
-    bm25_retriever = BM25(nodes, language="en", **kwargs)
-    return bm25_retriever.retrieve(query)
+@DefaultIndex.register_similarity(mode="keyword")
+def bm25(k1: float = 1.5, b: float = 0.75, **kwargs) -> BM25Index:
+    return BM25Index(language="en", k1=k1, b=b)
 
 
-@DefaultIndex.register_similarity(mode="text", batch=True)
-def bm25_chinese(query: str, nodes: List[DocNode], **kwargs) -> List:
-    bm25_retriever = BM25(nodes, language="zh", **kwargs)
-    return bm25_retriever.retrieve(query)
+@DefaultIndex.register_similarity(mode="keyword")
+def bm25_chinese(k1: float = 1.5, b: float = 0.75, **kwargs) -> BM25Index:
+    return BM25Index(language="zh", k1=k1, b=b)
 
 
-@DefaultIndex.register_similarity(mode="embedding")
-def cosine(query: List[float], node: DocNode, **kwargs) -> float:
-    product = np.dot(query, node.embedding)
-    norm = np.linalg.norm(query) * np.linalg.norm(node.embedding)
-    return product / norm
+# Similarities of the matrix mode score the L2-normalized query against the L2-normalized embeddings of all nodes
+# of the group at once, and return one score per row. In batch retrieval the queries are the rows of a 2-D array
+# and the scores are expected as a (rows, queries) array.
+@DefaultIndex.register_similarity(mode="matrix")
+def cosine(query: np.ndarray, matrix: np.ndarray, **kwargs) -> np.ndarray:
+    return matrix @ query.T
 
 
 # User-defined similarity decorator
@@ -0,0 +1,65 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+
+from lazyllm import config
+
+config.add("rag_result_cache_size", int, 0, "RAG_RESULT_CACHE_SIZE")
+
+
+class ResultCache(object):
+    """LRU cache of retrieval results, invalidated by the version of the document.
+
+    The version is part of every key and is bumped (and the cache emptied) whenever files are added or deleted,
+    so a result computed before the change is never returned after it, even if it is stored after the change.
+    A size of 0 disables the cache.
+    """
+
+    def __init__(self, max_size: Optional[int] = None):
+        self._max_size = config["rag_result_cache_size"] if max_size is None else max_size
+        self._data, self._lock = OrderedDict(), threading.Lock()
+        self.version = 0
+        self.hits = self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self._max_size > 0
+
+    def bump(self) -> None:
+        with self._lock:
+            self.version += 1
+            self._data.clear()
+
+    def key(self, *args, **kwargs) -> Hashable:
+        # kwargs of similarities may be unhashable, their repr is stable enough for a cache key
+        return (self.version, args, repr(sorted(kwargs.items())))
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            if key[0] == self.version and key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return list(self._data[key])
+            self.misses += 1
+            return None
+
+    def put(self, key: Hashable, result: Any) -> None:
+        with self._lock:
+            if key[0] != self.version: return
+            self._data[key] = list(result)
+            while len(self._data) > self._max_size: self._data.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return dict(hits=self.hits, misses=self.misses, hit_rate=self.hits / total if total else 0.0,
+                        size=len(self._data), version=self.version)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_data"], state["_lock"] = OrderedDict(), None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
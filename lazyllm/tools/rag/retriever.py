@@ -1,7 +1,13 @@
-from lazyllm import ModuleBase, pipeline, once_wrapper
+import concurrent.futures
+import heapq
+import itertools
+from lazyllm import ModuleBase, pipeline, once_wrapper, config, LOG, ThreadPoolExecutor
 from .store import DocNode
 from .document import Document, DocImpl
-from typing import List, Optional, Union
+from .index import DefaultIndex
+from typing import Any, Callable, Dict, List, Optional, Union
+
+config.add("rag_retriever_timeout", float, 0.0, "RAG_RETRIEVER_TIMEOUT")
 
 class _PostProcess(object):
     def __init__(self, target: Optional[str] = None,
@@ -18,7 +24,8 @@ class _PostProcess(object):
     def _post_process(self, nodes):
         if self._target:
             # TODO(wangzhihong): search relationship and add find_child
-            nodes = self._doc.find_parent(self._target)(nodes)
+            # nodes of the other documents are not in the store of the first one and are walked up instead
+            nodes = self._docs[0].find_parent(self._target)(nodes)
         if self._output_format == 'content':
             nodes = [node.get_content() for node in nodes]
             if isinstance(self._join, str): nodes = self._join.join(nodes)
@@ -40,6 +47,8 @@ class Retriever(ModuleBase, _PostProcess):
         target: Optional[str] = None,
         output_format: Optional[str] = None,
         join: Union[bool, str] = False,
+        timeout: Optional[float] = None,
+        filters: Optional[Dict[str, Any]] = None,
         **kwargs,
     ):
         super().__init__()
@@ -55,6 +64,9 @@ class Retriever(ModuleBase, _PostProcess):
         self._index = index
         self._topk = topk
         self._similarity_kw = kwargs  # kw parameters
+        self._filters = filters  # metadata key -> accepted value(s), only the matching nodes are scored
+        # seconds to wait for each document when retrieving from several of them, the slow ones are dropped
+        self._timeout = (config["rag_retriever_timeout"] or None) if timeout is None else timeout
         _PostProcess.__init__(self, target, output_format, join)
 
     @once_wrapper
@@ -67,11 +79,41 @@ class Retriever(ModuleBase, _PostProcess):
     def _get_post_process_tasks(self):
         return pipeline(lambda *a: self('Test Query'))
 
-    def forward(self, query: str) -> Union[List[DocNode], str]:
+    def _retrieve(self, func_name: str, filters: Optional[Dict[str, Any]] = None, **kw) -> List[Any]:
+        kw.update(group_name=self._group_name, similarity=self._similarity, index=self._index, topk=self._topk,
+                  similarity_cut_off=self._similarity_cut_off, similarity_kws=self._similarity_kw)
+        if (filters := self._filters if filters is None else filters): kw["filters"] = filters
+        if len(self._docs) == 1: return [self._docs[0].forward(func_name=func_name, **kw)]
+        # documents are searched concurrently and return scores, so that their results can be merged
+        executor = ThreadPoolExecutor(max_workers=len(self._docs))
+        futures = [executor.submit(doc.forward, func_name=func_name, with_score=True, **kw) for doc in self._docs]
+        done, _ = concurrent.futures.wait(futures, timeout=self._timeout)
+        executor.shutdown(wait=False)
+        for doc, future in zip(self._docs, futures):
+            if future not in done:
+                LOG.warning(f"Retrieving from document {doc.doc_name} timed out after {self._timeout}s, "
+                            "its results are dropped")
+        return [future.result() for future in futures if future in done]
+
+    def _merge(self, results: List[List[Any]]) -> List[DocNode]:
+        # global topk of the scored results of several documents
+        if len(self._docs) == 1: return results[0] if results else []
+        descend = DefaultIndex.registered_similarity.get(self._similarity, (None, None, True))[2]
+        scored = itertools.chain.from_iterable(results)
+        if self._topk is None:
+            merged = sorted(scored, key=lambda x: x[1], reverse=descend)
+        else:
+            select: Callable = heapq.nlargest if descend else heapq.nsmallest
+            merged = select(self._topk, scored, key=lambda x: x[1])
+        return [node for node, _ in merged]
+
+    def forward(self, query: str, filters: Optional[Dict[str, Any]] = None) -> Union[List[DocNode], str]:
         self._lazy_init()
-        nodes = []
-        for doc in self._docs:
-            nodes.extend(doc.forward(func_name="retrieve", query=query, group_name=self._group_name,
-                                     similarity=self._similarity, similarity_cut_off=self._similarity_cut_off,
-                                     index=self._index, topk=self._topk, similarity_kws=self._similarity_kw))
-        return self._post_process(nodes)
+        return self._post_process(self._merge(self._retrieve("retrieve", filters, query=query)))
+
+    def batch_forward(self, queries: List[str],
+                      filters: Optional[Dict[str, Any]] = None) -> List[Union[List[DocNode], str]]:
+        self._lazy_init()
+        doc_results = self._retrieve("retrieve_batch", filters, queries=queries)
+        if not doc_results: return [self._post_process([]) for _ in queries]
+        return [self._post_process(self._merge(list(results))) for results in zip(*doc_results)]
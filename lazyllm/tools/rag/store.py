@@ -1,9 +1,15 @@
 from abc import ABC, abstractmethod
+import atexit
+import functools
 from collections import defaultdict
 from enum import Enum, auto
+import itertools
+import threading
 import uuid
-from typing import Any, Callable, Dict, List, Optional
+import weakref
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
 import chromadb
+import numpy as np
 from lazyllm import LOG, config
 from chromadb.api.models.Collection import Collection
 
@@ -11,6 +17,8 @@ from chromadb.api.models.Collection import Collection
 LAZY_ROOT_NAME = "lazyllm_root"
 config.add("rag_store_type", str, "map", "RAG_STORE_TYPE")  # "map", "chroma"
 config.add("rag_persistent_path", str, "./lazyllm_chroma", "RAG_PERSISTENT_PATH")
+config.add("rag_chroma_load_batch_size", int, 1000, "RAG_CHROMA_LOAD_BATCH_SIZE")
+config.add("rag_store_write_batch_size", int, 1000, "RAG_STORE_WRITE_BATCH_SIZE")
 
 
 class MetadataMode(str, Enum):
@@ -20,60 +28,157 @@ class MetadataMode(str, Enum):
     NONE = auto()
 
 
+def _count_changes(cls):
+    # wraps the methods of the base container which change it in place, so that they bump the version
+    def wrap(method):
+        @functools.wraps(method)
+        def change(self, *args, **kwargs):
+            self.version += 1
+            return method(self, *args, **kwargs)
+        return change
+    for name in cls._changes: setattr(cls, name, wrap(getattr(cls.__bases__[0], name)))
+    return cls
+
+
+@_count_changes
+class _TrackedDict(dict):
+    """Metadata of a node, with a version which changes whenever the dict is changed in place.
+
+    Values which can be changed in place themselves (e.g. a list of tags) bump the version when they are read, so
+    the metadata strings built from the dict are rebuilt even if it is changed through a reference kept by the caller.
+    """
+
+    version = 0
+    _changes = ("__setitem__", "__delitem__", "__ior__", "clear", "pop", "popitem", "setdefault", "update")
+    _immutable = (str, int, float, bytes, tuple, frozenset, type(None))
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        if not isinstance(value, self._immutable): self.version += 1
+        return value
+
+    def get(self, key, default=None):
+        value = super().get(key, default)
+        if not isinstance(value, self._immutable): self.version += 1
+        return value
+
+
+@_count_changes
+class _TrackedList(list):
+    """Exclusion list of metadata keys, with a version which changes whenever the list is changed in place."""
+
+    version = 0
+    _changes = ("__setitem__", "__delitem__", "__iadd__", "__imul__", "append", "extend", "insert", "pop", "remove",
+                "clear", "sort", "reverse")
+
+
+def _tracked(value, cls):
+    # containers which are already tracked are kept, so nodes given the same metadata keep sharing it
+    return value if value is None or isinstance(value, cls) else cls(value)
+
+
+def _version(value) -> int:
+    return value.version if value is not None else 0
+
+
 class DocNode:
+    # Millions of chunks may be kept in memory, so nodes have no __dict__, and the containers which most chunks
+    # never use (children, and the metadata and exclusion lists which chunks read from their root) are only
+    # created when they are first accessed.
+    __slots__ = ("uid", "text", "group", "embedding", "_parent", "_root", "is_saved", "_metadata", "_children",
+                 "_excluded_embed_metadata_keys", "_excluded_llm_metadata_keys", "_docpath", "_metadata_strs",
+                 "_texts")
+
     def __init__(
         self,
         uid: Optional[str] = None,
         text: Optional[str] = None,
         group: Optional[str] = None,
-        embedding: Optional[List[float]] = None,
+        embedding: Optional[Union[List[float], np.ndarray]] = None,
         parent: Optional["DocNode"] = None,
         metadata: Optional[Dict[str, Any]] = None
     ) -> None:
         self.uid: str = uid if uid else str(uuid.uuid4())
         self.text: Optional[str] = text
         self.group: Optional[str] = group
-        self.embedding: Optional[List[float]] = embedding or None
-        self._metadata: Dict[str, Any] = metadata or {}
+        self.embedding: Optional[Union[List[float], np.ndarray]] = (
+            embedding if embedding is not None and len(embedding) > 0 else None)
+        self._metadata: Optional[Dict[str, Any]] = _tracked(metadata, _TrackedDict) if metadata else None
         # Metadata keys that are excluded from text for the embed model.
-        self._excluded_embed_metadata_keys: List[str] = []
+        self._excluded_embed_metadata_keys: Optional[List[str]] = None
         # Metadata keys that are excluded from text for the LLM.
-        self._excluded_llm_metadata_keys: List[str] = []
+        self._excluded_llm_metadata_keys: Optional[List[str]] = None
+        self._root: Optional["DocNode"] = None
         self.parent: Optional["DocNode"] = parent
-        self.children: Dict[str, List["DocNode"]] = defaultdict(list)
+        self._children: Optional[Dict[str, List["DocNode"]]] = None
         self.is_saved: bool = False
         self._docpath = None
+        # derived strings: the metadata strings by mode (kept on the root with the versions of the metadata and the
+        # exclusion lists they were built from) and the texts by mode (with the text and metadata string used)
+        self._metadata_strs: Optional[Tuple[Tuple[int, int, int], Dict[MetadataMode, str]]] = None
+        self._texts: Optional[Dict[MetadataMode, Tuple[Optional[str], str, str]]] = None
+
+    @property
+    def parent(self) -> Optional["DocNode"]:
+        return self._parent
+
+    @parent.setter
+    def parent(self, parent: Optional["DocNode"]) -> None:
+        self._parent = parent
+        self._root = None
+        if isinstance(parent, DocNode): self._root = parent.root_node
 
     @property
     def root_node(self) -> Optional["DocNode"]:
-        root = self.parent
-        while root and root.parent:
-            root = root.parent
-        return root or self
+        # the root is resolved when the parent is set, and again if it has been given a parent since then
+        root = self._root
+        if root is None or root._parent is not None:
+            root = self
+            while isinstance(root._parent, DocNode): root = root._parent
+            self._root = root if root is not self else None
+        return root
+
+    @property
+    def children(self) -> Dict[str, List["DocNode"]]:
+        if self._children is None: self._children = defaultdict(list)
+        return self._children
+
+    @children.setter
+    def children(self, children: Dict[str, List["DocNode"]]) -> None:
+        self._children = children
 
     @property
     def metadata(self) -> Dict:
-        return self.root_node._metadata
+        root = self.root_node
+        if root._metadata is None: root._metadata = _TrackedDict()
+        return root._metadata
 
     @metadata.setter
     def metadata(self, metadata: Dict) -> None:
-        self._metadata = metadata
+        self._metadata_strs = None
+        self._metadata = _tracked(metadata, _TrackedDict)
 
     @property
     def excluded_embed_metadata_keys(self) -> List:
-        return self.root_node._excluded_embed_metadata_keys
+        root = self.root_node
+        if root._excluded_embed_metadata_keys is None: root._excluded_embed_metadata_keys = _TrackedList()
+        return root._excluded_embed_metadata_keys
 
     @excluded_embed_metadata_keys.setter
     def excluded_embed_metadata_keys(self, excluded_embed_metadata_keys: List) -> None:
-        self._excluded_embed_metadata_keys = excluded_embed_metadata_keys
+        self._metadata_strs = None
+        self._excluded_embed_metadata_keys = _tracked(excluded_embed_metadata_keys, _TrackedList)
 
     @property
     def excluded_llm_metadata_keys(self) -> List:
-        return self.root_node._excluded_llm_metadata_keys
+        root = self.root_node
+        if root._excluded_llm_metadata_keys is None: root._excluded_llm_metadata_keys = _TrackedList()
+        return root._excluded_llm_metadata_keys
 
     @excluded_llm_metadata_keys.setter
     def excluded_llm_metadata_keys(self, excluded_llm_metadata_keys: List) -> None:
-        self._excluded_llm_metadata_keys = excluded_llm_metadata_keys
+        self._metadata_strs = None
+        self._excluded_llm_metadata_keys = _tracked(excluded_llm_metadata_keys, _TrackedList)
 
     @property
     def docpath(self) -> str:
@@ -86,7 +191,7 @@ class DocNode:
 
     def get_children_str(self) -> str:
         return str(
-            {key: [node.uid for node in nodes] for key, nodes in self.children.items()}
+            {key: [node.uid for node in nodes] for key, nodes in (self._children or {}).items()}
         )
 
     def __str__(self) -> str:
@@ -100,7 +205,7 @@ class DocNode:
         return str(self) if config["debug"] else f'<Node id={self.uid}>'
 
     def has_embedding(self) -> bool:
-        return self.embedding and self.embedding[0] != -1  # placeholder
+        return self.embedding is not None and len(self.embedding) > 0 and bool(self.embedding[0] != -1)  # placeholder
 
     def do_embedding(self, embed: Callable) -> None:
         self.embedding = embed(self.get_text(MetadataMode.EMBED))
@@ -114,26 +219,122 @@ class DocNode:
         if mode == MetadataMode.NONE:
             return ""
 
-        metadata_keys = set(self.metadata.keys())
-        if mode == MetadataMode.LLM:
-            for key in self.excluded_llm_metadata_keys:
-                if key in metadata_keys:
-                    metadata_keys.remove(key)
-        elif mode == MetadataMode.EMBED:
-            for key in self.excluded_embed_metadata_keys:
-                if key in metadata_keys:
-                    metadata_keys.remove(key)
-
-        return "\n".join([f"{key}: {self.metadata[key]}" for key in metadata_keys])
+        root = self.root_node
+        versions = (_version(root._metadata), _version(root._excluded_llm_metadata_keys),
+                    _version(root._excluded_embed_metadata_keys))
+        if root._metadata_strs is None or root._metadata_strs[0] != versions: root._metadata_strs = (versions, {})
+        strs = root._metadata_strs[1]
+        if mode not in strs:
+            excluded = set((root._excluded_llm_metadata_keys if mode == MetadataMode.LLM else
+                            root._excluded_embed_metadata_keys if mode == MetadataMode.EMBED else None) or ())
+            strs[mode] = "\n".join([f"{key}: {value}" for key, value in (root._metadata or {}).items()
+                                    if key not in excluded])
+        return strs[mode]
 
     def get_text(self, metadata_mode: MetadataMode = MetadataMode.NONE) -> str:
-        metadata_str = self.get_metadata_str(metadata_mode).strip()
-        if not metadata_str:
+        if metadata_mode == MetadataMode.NONE:
             return self.text if self.text else ""
-        return f"{metadata_str}\n\n{self.text}".strip()
+        metadata_str = self.get_metadata_str(metadata_mode)
+        cached = self._texts.get(metadata_mode) if self._texts else None
+        if cached and cached[0] is self.text and cached[1] is metadata_str: return cached[2]
+        stripped = metadata_str.strip()
+        text = f"{stripped}\n\n{self.text}".strip() if stripped else (self.text if self.text else "")
+        if self._texts is None: self._texts = {}
+        self._texts[metadata_mode] = (self.text, metadata_str, text)
+        return text
 
     def to_dict(self) -> Dict:
-        return dict(text=self.text, embedding=self.embedding, metadata=self.metadata)
+        embedding = self.embedding.tolist() if isinstance(self.embedding, np.ndarray) else self.embedding
+        return dict(text=self.text, embedding=embedding, metadata=self.metadata)
+
+
+class _MetadataIndex(object):
+    """Inverted index of the metadata of the nodes of a group: key -> value -> uids.
+
+    The uids of a value are kept in a dict rather than a set, so that matches come out in a stable order. Every
+    element of a list value is indexed; values which cannot be hashed are not indexed and never match.
+    """
+
+    def __init__(self):
+        self._postings: Dict[str, Dict[Any, Dict[str, None]]] = defaultdict(dict)
+        self._entries: Dict[str, List[Tuple[str, Any]]] = {}
+
+    @staticmethod
+    def _values(value: Any) -> List[Any]:
+        return list(value) if isinstance(value, (list, tuple, set, frozenset)) else [value]
+
+    def add(self, nodes: List[DocNode]) -> None:
+        for node in nodes:
+            if node.uid in self._entries: self.remove([node.uid])
+            entries = []
+            for key, value in node.metadata.items():
+                for v in self._values(value):
+                    try: self._postings[key].setdefault(v, {})[node.uid] = None
+                    except TypeError: continue
+                    entries.append((key, v))
+            self._entries[node.uid] = entries
+
+    def remove(self, uids: List[str]) -> None:
+        for uid in uids:
+            for key, v in self._entries.pop(uid, []):
+                uids_of_value = self._postings[key][v]
+                uids_of_value.pop(uid, None)
+                if not uids_of_value: self._postings[key].pop(v)
+
+    def match(self, filters: Dict[str, Any]) -> List[str]:
+        # keys are AND-ed, the values accepted for one key (a list, tuple or set) are OR-ed
+        candidates = []
+        for key, accepted in filters.items():
+            postings, uids = self._postings.get(key, {}), {}
+            for v in self._values(accepted): uids.update(postings.get(v, {}))
+            if not uids: return []
+            candidates.append(uids)
+        if not candidates: return list(self._entries)
+        first, *rest = sorted(candidates, key=len)
+        return [uid for uid in first if all(uid in uids for uids in rest)]
+
+
+class _AncestryIndex(object):
+    """The ancestor of every node in each group above it, and the descendants of every node in each group below.
+
+    Both are updated when a node is added or removed, so moving between groups does not depend on the depth of
+    the tree.
+    """
+
+    def __init__(self):
+        self._ancestors: Dict[str, Dict[str, DocNode]] = {}
+        self._descendants: Dict[str, Dict[str, Dict[str, DocNode]]] = {}
+
+    def add(self, node: DocNode) -> None:
+        self._unlink(node)  # a node indexed as the parent of an earlier one keeps its descendants
+        parent, ancestors = node.parent, {}
+        if isinstance(parent, DocNode):
+            if parent.uid not in self._ancestors: self.add(parent)
+            ancestors = dict(self._ancestors[parent.uid])
+            ancestors[parent.group] = parent
+        self._ancestors[node.uid] = ancestors
+        for ancestor in ancestors.values():
+            self._descendants.setdefault(ancestor.uid, {}).setdefault(node.group, {})[node.uid] = node
+
+    def _unlink(self, node: DocNode) -> None:
+        for ancestor in self._ancestors.pop(node.uid, {}).values():
+            descendants = self._descendants[ancestor.uid][node.group]
+            descendants.pop(node.uid, None)
+            if not descendants: self._descendants[ancestor.uid].pop(node.group)
+
+    def remove(self, node: DocNode) -> None:
+        self._unlink(node)
+        self._descendants.pop(node.uid, None)
+
+    def ancestor(self, node: DocNode, group: str) -> Optional[DocNode]:
+        if node.uid not in self._ancestors: return None
+        return self._ancestors[node.uid].get(group)
+
+    def descendants(self, node: DocNode, group: str) -> List[DocNode]:
+        return list(self._descendants.get(node.uid, {}).get(group, {}).values())
+
+    def __contains__(self, node: DocNode) -> bool:
+        return node.uid in self._ancestors
 
 
 class BaseStore(ABC):
@@ -142,24 +343,48 @@ class BaseStore(ABC):
             group: {} for group in node_groups
         }
         self._file_node_map = {}
+        # built for a group on its first filtered query, then kept up to date as nodes are added and removed
+        self._metadata_indices: Dict[str, _MetadataIndex] = {}
+        # built on the first lookup of a parent or children, then kept up to date like the metadata indices
+        self._ancestry: Optional[_AncestryIndex] = None
+        # the indices of the documents on the store, which are told about the nodes added and removed
+        self._observers: List[Any] = []
+
+    def add_observer(self, observer: Any) -> None:
+        # observer.on_nodes_added(nodes) and observer.on_nodes_removed(nodes) are called after every change
+        if observer not in self._observers: self._observers.append(observer)
 
     def _add_nodes(self, nodes: List[DocNode]) -> None:
         for node in nodes:
             if node.group == LAZY_ROOT_NAME and "file_name" in node.metadata:
                 self._file_node_map[node.metadata["file_name"]] = node
             self._store[node.group][node.uid] = node
+            if (index := self._metadata_indices.get(node.group)): index.add([node])
+            if self._ancestry is not None: self._ancestry.add(node)
+        for observer in self._observers: observer.on_nodes_added(nodes)
 
     def add_nodes(self, nodes: List[DocNode]) -> None:
         self._add_nodes(nodes)
         self.try_save_nodes(nodes)
 
+    def _ensure_loaded(self, groups: List[str]) -> None:
+        # stores which load the persisted nodes of a group when it is first accessed do it here
+        pass
+
     def has_nodes(self, group: str) -> bool:
+        self._ensure_loaded([group])
         return len(self._store[group]) > 0
 
     def get_node(self, group: str, node_id: str) -> Optional[DocNode]:
+        self._ensure_loaded([group])
         return self._store.get(group, {}).get(node_id)
 
     def traverse_nodes(self, group: str) -> List[DocNode]:
+        self._ensure_loaded([group])
+        return list(self._store.get(group, {}).values())
+
+    def loaded_nodes(self, group: str) -> List[DocNode]:
+        # the nodes of the group which are in memory, a group which is not loaded yet is not loaded for this
         return list(self._store.get(group, {}).values())
 
     @abstractmethod
@@ -177,6 +402,18 @@ class BaseStore(ABC):
         # try remove nodes in persistent source
         raise NotImplementedError("Not implemented yet.")
 
+    def flush(self) -> None:
+        # wait until the nodes saved so far are in the persistent source
+        pass
+
+    def search_vectors(self, group: str, embedding: np.ndarray,
+                       topk: Optional[int]) -> Optional[List[Tuple[DocNode, float]]]:
+        # the nodes most similar by cosine, searched by the backend; None if the store cannot search vectors
+        return None
+
+    def close(self) -> None:
+        self.flush()
+
     def active_groups(self) -> List:
         return [group for group, nodes in self._store.items() if nodes]
 
@@ -184,12 +421,50 @@ class BaseStore(ABC):
         for node in nodes:
             assert node.group in self._store, f"Unexpected node group {node.group}"
             self._store[node.group].pop(node.uid, None)
+            if (index := self._metadata_indices.get(node.group)): index.remove([node.uid])
+            if self._ancestry is not None: self._ancestry.remove(node)
+        for observer in self._observers: observer.on_nodes_removed(nodes)
 
     def remove_nodes(self, nodes: List[DocNode]) -> None:
         self._remove_nodes(nodes)
         self.try_remove_nodes(nodes)
 
+    def filter_nodes(self, group: str, filters: Dict[str, Any]) -> List[DocNode]:
+        """Nodes of the group whose metadata matches the filters, looked up in an inverted index.
+
+        ``filters`` maps a metadata key to the accepted value, or to a list of accepted values.
+        """
+        if group not in self._metadata_indices:
+            index = _MetadataIndex()
+            index.add(self.traverse_nodes(group))
+            self._metadata_indices[group] = index
+        nodes = self._store.get(group, {})
+        return [nodes[uid] for uid in self._metadata_indices[group].match(filters)]
+
+    def _get_ancestry(self) -> _AncestryIndex:
+        if self._ancestry is None:
+            self._ensure_loaded(list(self._store.keys()))
+            ancestry = _AncestryIndex()
+            for nodes in self._store.values():
+                for node in nodes.values(): ancestry.add(node)
+            self._ancestry = ancestry
+        return self._ancestry
+
+    def find_ancestor(self, node: DocNode, group: str) -> Optional[DocNode]:
+        """The ancestor of the node in the group, or None; nodes which are not in the store are walked up."""
+        ancestry = self._get_ancestry()
+        if node in ancestry: return ancestry.ancestor(node, group)
+        parent = node.parent
+        while isinstance(parent, DocNode) and parent.group != group: parent = parent.parent
+        return parent if isinstance(parent, DocNode) else None
+
+    def find_descendants(self, node: DocNode, group: str) -> List[DocNode]:
+        """The descendants of the node in the group, at any depth below it."""
+        return self._get_ancestry().descendants(node, group)
+
     def get_nodes_by_files(self, files: List[str]) -> List[DocNode]:
+        # the nodes of the files are deleted with all their children, which must be loaded to be found
+        self._ensure_loaded(list(self._store.keys()))
         nodes = []
         for file in files:
             if file in self._file_node_map:
@@ -197,6 +472,37 @@ class BaseStore(ABC):
         return nodes
 
 
+class _LazyGroupNodes(Sequence):
+    """The nodes of a group of a store, traversed when they are first used.
+
+    Indices which search the store itself (see StoreIndex) get the group this way, so that a group which the store
+    keeps on disk is not loaded for a query which never looks at its nodes.
+    """
+
+    def __init__(self, store: BaseStore, group: str):
+        self.store, self.group = store, group
+        self._nodes: Optional[List[DocNode]] = None
+
+    def _get(self) -> List[DocNode]:
+        if self._nodes is None: self._nodes = self.store.traverse_nodes(self.group)
+        return self._nodes
+
+    def __len__(self) -> int:
+        return len(self._get())
+
+    def __getitem__(self, i):
+        return self._get()[i]
+
+    def __iter__(self):
+        return iter(self._get())
+
+    def __bool__(self) -> bool:
+        return self.store.has_nodes(self.group) if self._nodes is None else bool(self._nodes)
+
+    def loaded(self) -> List[DocNode]:
+        return self._nodes if self._nodes is not None else self.store.loaded_nodes(self.group)
+
+
 class MapStore(BaseStore):
     def __init__(self, node_groups: List[str], *args, **kwargs):
         super().__init__(node_groups, *args, **kwargs)
@@ -211,6 +517,18 @@ class MapStore(BaseStore):
         pass
 
 
+_open_stores = weakref.WeakSet()
+
+
+@atexit.register
+def _flush_open_stores() -> None:
+    for store in list(_open_stores):
+        try:
+            store.flush()
+        except Exception as e:
+            LOG.error(f"Failed to flush {store} on exit: {e}")
+
+
 class ChromadbStore(BaseStore):
     def __init__(
         self, node_groups: List[str], embed: Callable, *args, **kwargs
@@ -219,94 +537,229 @@ class ChromadbStore(BaseStore):
         self._db_client = chromadb.PersistentClient(path=config["rag_persistent_path"])
         LOG.success(f"Initialzed chromadb in path: {config['rag_persistent_path']}")
         self._collections: Dict[str, Collection] = {
-            group: self._db_client.get_or_create_collection(group)
+            # new collections are searched by cosine, see search_vectors
+            group: self._db_client.get_or_create_collection(group, metadata={"hnsw:space": "cosine"})
             for group in node_groups
         }
         self._placeholder = [-1] * len(embed("a")) if embed else []
+        self._uid_map: Dict[str, DocNode] = {}
+        self._pending = set()
+        # nodes of groups which are not loaded yet, built from the collection for the results of search_vectors
+        self._materialized: Dict[str, Dict[str, DocNode]] = defaultdict(dict)
+        # nodes waiting for the background writer, by group and uid, and the batch which is being written
+        self._dirty: Dict[str, Dict[str, DocNode]] = defaultdict(dict)
+        self._writing: Dict[str, DocNode] = {}
+        self._dirty_lock, self._write_lock = threading.Lock(), threading.Lock()
+        self._writer: Optional[threading.Thread] = None
+        _open_stores.add(self)
 
     def try_load_store(self) -> None:
+        self.flush()
         if not self._collections[LAZY_ROOT_NAME].peek(1)["ids"]:
             LOG.info("No persistent data found, skip the rebuilding phrase.")
             return
 
-        # Restore all nodes
-        for group in self._collections.keys():
-            results = self._peek_all_documents(group)
-            nodes = self._build_nodes_from_chroma(results)
-            self._add_nodes(nodes)
-
-        # Rebuild relationships
-        for group, nodes_dict in self._store.items():
-            for node in nodes_dict.values():
-                if node.parent:
-                    parent_uid = node.parent
-                    parent_node = self._find_node_by_uid(parent_uid)
-                    node.parent = parent_node
-                    parent_node.children[node.group].append(node)
-            LOG.debug(f"build {group} nodes from chromadb: {nodes_dict.values()}")
+        # Only the root nodes are restored now, the nodes of other groups when the group is first accessed
+        self._uid_map = {uid: node for nodes in self._store.values() for uid, node in nodes.items()}
+        self._pending = {group for group in self._collections if group in self._store and not self._store[group]
+                         and self._collections[group].count() > 0}
+        self._ensure_loaded([LAZY_ROOT_NAME])
         LOG.success("Successfully Built nodes from chromadb.")
 
+    def _ensure_loaded(self, groups: List[str]) -> None:
+        for group in groups:
+            if group in self._pending: self._load_group(group)
+
+    def _load_group(self, group: str) -> None:
+        self._pending.discard(group)
+        collection, batch_size = self._collections[group], max(config["rag_chroma_load_batch_size"], 1)
+        total, nodes, parents = collection.count(), {}, {}
+        materialized = self._materialized.pop(group, {})
+        for offset in range(0, total, batch_size):
+            results = collection.get(limit=batch_size, offset=offset,
+                                     include=["embeddings", "metadatas", "documents"])
+            for node, parent_group in self._build_nodes_from_chroma(results):
+                # nodes already returned by a search are kept, so that the results handed out stay in the tree
+                nodes[node.uid] = materialized.get(node.uid, node)
+                if node.parent: parents[node.uid] = (node.parent, parent_group)
+            LOG.info(f"Loaded {len(nodes)}/{total} nodes of group {group} from chromadb.")
+
+        # Rebuild relationships, the groups of the parents are loaded first
+        for uid, (parent_uid, parent_group) in parents.items():
+            node = nodes[uid]
+            if parent_group in (group, "") and parent_uid in nodes: parent_node = nodes[parent_uid]
+            else: parent_node = self._find_node_by_uid(parent_uid, parent_group)
+            node.parent = parent_node
+            parent_node.children[node.group].append(node)
+        self._add_nodes(list(nodes.values()))
+        LOG.debug(f"build {group} nodes from chromadb: {nodes.values()}")
+
+    def _add_nodes(self, nodes: List[DocNode]) -> None:
+        self._ensure_loaded({node.group for node in nodes})
+        super()._add_nodes(nodes)
+        for node in nodes: self._uid_map[node.uid] = node
+
+    def _remove_nodes(self, nodes: List[DocNode]) -> None:
+        self._ensure_loaded({node.group for node in nodes})
+        super()._remove_nodes(nodes)
+        for node in nodes: self._uid_map.pop(node.uid, None)
+
+    def has_nodes(self, group: str) -> bool:
+        # a group which is not loaded yet has persisted nodes, there is no need to load them to know
+        return group in self._pending or super().has_nodes(group)
+
+    def active_groups(self) -> List:
+        # a group which is not loaded yet has persisted nodes
+        return [group for group, nodes in self._store.items() if nodes or group in self._pending]
+
     def try_save_nodes(self, nodes: List[DocNode]) -> None:
-        if not nodes:
-            return
-        # Note: It's caller's duty to make sure this batch of nodes has the same group.
-        group = nodes[0].group
-        ids, embeddings, metadatas, documents = [], [], [], []
-        collection = self._collections.get(group)
-        assert (
-            collection
-        ), f"Group {group} is not found in collections {self._collections}"
-        for node in nodes:
-            if node.is_saved:
-                continue
-            if not node.has_embedding():
-                node.embedding = self._placeholder
-            ids.append(node.uid)
-            embeddings.append(node.embedding)
-            metadatas.append(self._make_chroma_metadata(node))
-            documents.append(node.get_text())
-            node.is_saved = True
-        if ids:
-            collection.upsert(
-                embeddings=embeddings,
-                ids=ids,
-                metadatas=metadatas,
-                documents=documents,
+        # nodes are only marked dirty here and written by a background thread, see flush
+        nodes = [node for node in nodes if not node.is_saved]
+        if not nodes: return
+        with self._dirty_lock:
+            for node in nodes:
+                assert node.group in self._collections, \
+                    f"Group {node.group} is not found in collections {self._collections}"
+                self._dirty[node.group][node.uid] = node
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_behind, daemon=True)
+                self._writer.start()
+
+    def _take_batch(self) -> Optional[Tuple[str, List[DocNode]]]:
+        with self._dirty_lock:
+            if not self._dirty: return None
+            group, dirty = next(iter(self._dirty.items()))
+            uids = list(itertools.islice(dirty, max(config["rag_store_write_batch_size"], 1)))
+            nodes = [dirty.pop(uid) for uid in uids]
+            if not dirty: self._dirty.pop(group)
+            self._writing = {node.uid: node for node in nodes}
+            return group, nodes
+
+    def _write_batch(self, group: str, nodes: List[DocNode]) -> None:
+        # nodes embedded again while they are written are marked dirty again and written by a later batch
+        for node in nodes: node.is_saved = True
+        try:
+            self._collections[group].upsert(
+                embeddings=[np.asarray(node.embedding if node.has_embedding() else self._placeholder,
+                                       dtype=np.float32) for node in nodes],
+                ids=[node.uid for node in nodes],
+                metadatas=[self._make_chroma_metadata(node) for node in nodes],
+                documents=[node.get_text() for node in nodes],
             )
-            LOG.debug(f"Saved {group} nodes {ids} to chromadb.")
+        except Exception:
+            with self._dirty_lock:
+                for node in nodes:
+                    node.is_saved = False
+                    self._dirty[group].setdefault(node.uid, node)
+            raise
+        finally:
+            with self._dirty_lock: self._writing = {}
+        LOG.debug(f"Saved {len(nodes)} {group} nodes to chromadb.")
+
+    def _write_behind(self) -> None:
+        while True:
+            with self._dirty_lock:
+                if not self._dirty:
+                    self._writer = None
+                    return
+            try:
+                with self._write_lock:
+                    if (batch := self._take_batch()): self._write_batch(*batch)
+            except Exception as e:
+                LOG.error(f"Failed to write nodes to chromadb, they are written again on the next save or flush: {e}")
+                with self._dirty_lock: self._writer = None
+                return
+
+    def flush(self) -> None:
+        """Write the dirty nodes in batches and wait for the background writer, the nodes are persisted on return."""
+        with self._write_lock:
+            while (batch := self._take_batch()): self._write_batch(*batch)
+
+    def close(self) -> None:
+        self.flush()
+        _open_stores.discard(self)
+
+    def search_vectors(self, group: str, embedding: np.ndarray,
+                       topk: Optional[int]) -> Optional[List[Tuple[DocNode, float]]]:
+        collection = self._collections.get(group)
+        if collection is None or (collection.metadata or {}).get("hnsw:space") != "cosine":
+            LOG.log_once(f"Collection {group} of chromadb is not searched by cosine, it is searched in memory.")
+            return None
+        query = np.asarray(embedding, dtype=np.float32)
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+        # nodes waiting for the writer are scored here, their rows in the collection are missing or outdated
+        with self._dirty_lock:
+            unsaved = {uid: node for uid, node in itertools.chain(self._writing.items(),
+                       self._dirty.get(group, {}).items()) if node.group == group}
+        hits, nodes = [], self._store[group]
+        if (embedded := [node for uid, node in unsaved.items() if nodes.get(uid) is node and node.has_embedding()]):
+            vecs = np.asarray([node.embedding for node in embedded], dtype=np.float32)
+            scores = vecs @ query / np.maximum(np.linalg.norm(vecs, axis=1), 1e-12)
+            hits = [(node, float(score)) for node, score in zip(embedded, scores.tolist())]
+
+        loaded, count = group not in self._pending, collection.count()
+        n, found = (count if topk is None else min(topk + len(unsaved), count)), []
+        while n > 0:
+            results = collection.query(query_embeddings=[query.tolist()], n_results=n, include=["distances"])
+            # nodes which were removed from the store are still in the collection and are skipped
+            found = [(uid, 1.0 - float(distance)) for uid, distance in zip(results["ids"][0], results["distances"][0])
+                     if uid not in unsaved and (not loaded or uid in nodes)]
+            if topk is None or len(found) >= topk or n >= count: break
+            n = min(2 * n, count)
+        found = found[:topk]
+        nodes = nodes if loaded else self._materialize(group, [uid for uid, _ in found])
+        # nodes persisted before they were embedded are skipped until their group is loaded and embedded
+        hits.extend((nodes[uid], score) for uid, score in found if uid in nodes and nodes[uid].has_embedding())
+        hits.sort(key=lambda hit: hit[1], reverse=True)
+        return hits[:topk]
+
+    def _materialize(self, group: str, uids: List[str]) -> Dict[str, DocNode]:
+        # builds only the given nodes of a group which is not loaded, with their ancestors; they are kept and
+        # reused when the group is loaded
+        materialized = self._materialized[group]
+        if (todo := [uid for uid in uids if uid not in materialized]):
+            results = self._collections[group].get(ids=todo, include=["embeddings", "metadatas", "documents"])
+            for node, parent_group in self._build_nodes_from_chroma(results):
+                if (parent_uid := node.parent):
+                    node.parent = self._materialize(parent_group, [parent_uid]).get(parent_uid) \
+                        if parent_group in self._pending else self._find_node_by_uid(parent_uid, parent_group)
+                materialized[node.uid] = node
+        return {uid: materialized[uid] for uid in uids if uid in materialized}
 
     def try_remove_nodes(self, nodes: List[DocNode]) -> None:
-        pass
-
-    def _find_node_by_uid(self, uid: str) -> Optional[DocNode]:
-        for nodes_by_category in self._store.values():
-            if uid in nodes_by_category:
-                return nodes_by_category[uid]
+        with self._dirty_lock:
+            for node in nodes:
+                if (dirty := self._dirty.get(node.group)) is not None: dirty.pop(node.uid, None)
+
+    def _find_node_by_uid(self, uid: str, group: str = "") -> DocNode:
+        if group:
+            self._ensure_loaded([group])
+            if (node := self._store.get(group, {}).get(uid)) is not None: return node
+        elif uid not in self._uid_map:
+            # nodes saved by older versions do not record the group of their parent
+            self._ensure_loaded(list(self._pending))
+        if uid in self._uid_map: return self._uid_map[uid]
         raise ValueError(f"UID {uid} not found in store.")
 
-    def _build_nodes_from_chroma(self, results: Dict[str, List]) -> List[DocNode]:
-        nodes: List[DocNode] = []
+    def _build_nodes_from_chroma(self, results: Dict[str, List]) -> List[Tuple[DocNode, str]]:
+        nodes: List[Tuple[DocNode, str]] = []
         for i, uid in enumerate(results["ids"]):
             chroma_metadata = results["metadatas"][i]
             node = DocNode(
                 uid=uid,
                 text=results["documents"][i],
                 group=chroma_metadata["group"],
-                embedding=results["embeddings"][i],
+                embedding=np.asarray(results["embeddings"][i], dtype=np.float32),
                 parent=chroma_metadata["parent"],
             )
             node.is_saved = True
-            nodes.append(node)
+            nodes.append((node, chroma_metadata.get("parent_group", "")))
         return nodes
 
     def _make_chroma_metadata(self, node: DocNode) -> Dict[str, Any]:
         metadata = {
             "group": node.group,
             "parent": node.parent.uid if node.parent else "",
+            "parent_group": node.parent.group if node.parent else "",
         }
         return metadata
-
-    def _peek_all_documents(self, group: str) -> Dict[str, List]:
-        assert group in self._collections, f"group {group} not found."
-        collection = self._collections[group]
-        return collection.peek(collection.count())
@@ -73,6 +73,14 @@ class TestDeploy(object):
         res = m(['你好', '世界'])
         assert len(json.loads(res)) == 2
 
+    def test_embedding_numpy(self):
+        m = lazyllm.TrainableModule('bge-large-zh-v1.5').deploy_method(deploy.AutoDeploy, output_format='numpy')
+        m.update_server()
+        res = m('你好')
+        assert res.shape == (1024,)
+        res = m(['你好', '世界'])
+        assert res.shape == (2, 1024)
+
     def test_sd3(self):
         m = lazyllm.TrainableModule('stable-diffusion-3-medium')
         m.update_server()
@@ -1,6 +1,9 @@
 import unittest
-from lazyllm.tools.rag.component.bm25 import BM25
-from lazyllm.tools.rag.store import DocNode
+from unittest.mock import MagicMock, patch
+import lazyllm
+from lazyllm.tools.rag.component.bm25 import BM25, BM25Index, _tokenize_corpus, _tokenize_texts
+from lazyllm.tools.rag.index import DefaultIndex, bm25
+from lazyllm.tools.rag.store import DocNode, MapStore
 import numpy as np
 
 
@@ -62,5 +65,89 @@ class TestBM25Chinese(unittest.TestCase):
         self.assertIn(self.nodes[3], [result[0] for result in results])
 
 
+class TestBM25Index(unittest.TestCase):
+    def test_shared_incremental_index(self):
+        nodes = [DocNode(text=t, group="g") for t in ("apple banana", "banana cherry", "cherry durian")]
+        store = MapStore(["g"])
+        store.add_nodes(nodes)
+        index = DefaultIndex(embed=None, store=store)
+        self.assertEqual(index.query("banana", nodes, "bm25", 0.0, 1), [nodes[0]])
+        bm25_index = index._get_keyword_index("bm25", "g", bm25)
+
+        # the index of the group is reused and only the changed nodes are tokenized
+        bm25_index._tokenize = MagicMock(side_effect=bm25_index._tokenize)
+        store.remove_nodes(nodes[:1])
+        store.add_nodes([DocNode(text="apple apple", group="g")])
+        nodes = nodes[1:] + store.traverse_nodes("g")[2:]
+        self.assertEqual(index.query("apple", nodes, "bm25", 0.0, 2), [nodes[2]])
+        self.assertEqual(len(bm25_index), 3)
+        self.assertEqual([len(c.args[0]) for c in bm25_index._tokenize.call_args_list], [1, 1])
+
+    def test_content_cache(self):
+        index = BM25Index("zh")
+        index.add([DocNode(text=t) for t in ("检索系统的排序函数", "中文文档的测试内容")])
+        index._tokenize = MagicMock(side_effect=index._tokenize)
+        # a re-parsed file comes back with new uids, only the chunk whose text changed is tokenized
+        nodes = [DocNode(text=t) for t in ("检索系统的排序函数", "中文文档的新内容")]
+        index.sync(nodes)
+        self.assertEqual([c.args[0] for c in index._tokenize.call_args_list], [["中文文档的新内容"]])
+        self.assertEqual(index.retrieve("排序", 1)[0][0], nodes[0])
+
+    def test_candidates(self):
+        nodes = [DocNode(text=t, group="g") for t in ("pear plum", "pear pear", "plum fig")]
+        index = DefaultIndex(embed=None, store=MagicMock())
+        self.assertEqual(index.query("pear", nodes, "bm25", 0.0, 2, candidates=nodes[::2]), [nodes[0]])
+        self.assertEqual(len(index._get_keyword_index("bm25", "g", bm25)), 3)
+
+    def test_persist(self):
+        import tempfile
+        with tempfile.TemporaryDirectory() as path:
+            nodes = [DocNode(text=t, group="g") for t in ("apple banana", "banana cherry")]
+            DefaultIndex(embed=None, store=MagicMock(), persist_path=path).query("banana", nodes, "bm25", 0.0, 2)
+            index = DefaultIndex(embed=None, store=MagicMock(), persist_path=path)
+            bm25_index = index._get_keyword_index("bm25", "g", DefaultIndex.registered_similarity["bm25"][0])
+            bm25_index._tokenize = MagicMock(side_effect=bm25_index._tokenize)
+            self.assertEqual(index.query("cherry", nodes, "bm25", 0.0, 2), [nodes[1]])
+            # only the query is tokenized, the nodes reuse the persisted tokens
+            self.assertEqual(sum(len(c.args[0]) for c in bm25_index._tokenize.call_args_list), 1)
+
+    def test_tokenize_workers(self):
+        texts = [f"running dogs {i} jumped" for i in range(64)]
+        serial = _tokenize_texts("en", texts)
+        # worker processes are only started when asked for
+        with patch("multiprocessing.get_context", side_effect=AssertionError("started workers")):
+            self.assertEqual(_tokenize_corpus("en", texts), serial)
+        with patch.dict(lazyllm.config.impl, {"rag_bm25_tokenize_workers": 2, "rag_bm25_parallel_threshold": 16}):
+            self.assertEqual(_tokenize_corpus("en", texts), serial)
+
+    def test_parameters(self):
+        nodes = [DocNode(text=t, group="g") for t in ("apple banana", "apple " * 20 + "banana")]
+        index = DefaultIndex(embed=None, store=MagicMock())
+        default = index.query("banana", nodes, "bm25", float("-inf"), 2, with_score=True)
+        no_norm = index.query("banana", nodes, "bm25", float("-inf"), 2, with_score=True, b=0.0)
+        # without length normalization both nodes score the same, so the index of the default b is not reused
+        self.assertGreater(default[0][1], default[1][1])
+        self.assertAlmostEqual(no_norm[0][1], no_norm[1][1])
+        self.assertEqual(len(index._keyword_indices), 2)
+
+    def test_store_updates(self):
+        import tempfile
+        with tempfile.TemporaryDirectory() as path:
+            store = MapStore(["g"])
+            store.add_nodes([DocNode(uid=str(i), text=t, group="g") for i, t in enumerate(("apple pie", "fig jam"))])
+            index = DefaultIndex(embed=None, store=store, persist_path=path)
+            self.assertEqual(index.query("apple", store.traverse_nodes("g"), "bm25", 0.0, 1)[0].uid, "0")
+            bm25_index = index._get_keyword_index("bm25", "g", bm25)
+            # the index is updated and saved when the store changes, queries neither scan the group nor save
+            with patch.object(BM25Index, "save", autospec=True, side_effect=BM25Index.save) as save:
+                store.add_nodes([DocNode(uid="2", text="apple apple", group="g")])
+                store.remove_nodes([store.get_node("g", "0")])
+                self.assertEqual(save.call_count, 2)
+                with patch.object(BM25Index, "sync", side_effect=AssertionError("scanned the group")):
+                    self.assertEqual(index.query("apple", store.traverse_nodes("g"), "bm25", 0.0, 2)[0].uid, "2")
+                self.assertEqual(save.call_count, 2)
+            self.assertEqual(len(bm25_index), 2)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -75,6 +75,40 @@ class TestCommon(object):
         assert square(3) == 9
         assert square(18) == 324
 
+    def test_rate_limit(self):
+        from lazyllm.common.ratelimit import RateLimiter, limited_request, backoff_delay
+
+        class Response(object):
+            def __init__(self, status_code, headers=None):
+                self.status_code, self.headers, self.closed = status_code, headers or {}, False
+
+            def close(self): self.closed = True
+
+        responses = [Response(429, {'Retry-After': '0'}), Response(503), Response(200)]
+        limiter = RateLimiter(max_concurrency=8)
+        with limited_request(limiter, lambda: responses.pop(0), max_retries=3, base_delay=0.01) as r:
+            assert r.status_code == 200 and not r.closed
+        assert r.closed and not responses and limiter.throttled == 1 and limiter.concurrency_limit == 4
+
+        with limited_request(RateLimiter(), lambda: Response(500), max_retries=1, base_delay=0.01) as r:
+            assert r.status_code == 500
+        assert 0.5 <= backoff_delay(0, '0.5', base=0.01) < 0.51 and backoff_delay(3, None, base=1, cap=2) <= 2
+
+        limiter, active, peak = RateLimiter(rpm=600, max_concurrency=2), [0], [0]
+
+        def request():
+            with limiter.slot():
+                active[0] += 1
+                peak[0] = max(peak[0], active[0])
+                time.sleep(0.01)
+                active[0] -= 1
+
+        threads = [threading.Thread(target=request) for _ in range(14)]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+        # 14 tokens were taken, the bucket refills 10 tokens per second meanwhile
+        assert peak[0] == 2 and 586 <= limiter._rpm.available <= 600
+
 
 class TestCommonGlobals(object):
 
@@ -1,4 +1,10 @@
+import json
+import numpy as np
+import torch
+from unittest.mock import patch
 import lazyllm
+from lazyllm.components.embedding.embed import LazyHuggingFaceEmbedding, EmbeddingDeploy
+from lazyllm.components.utils.downloader import ModelManager
 
 
 class TestComponent(object):
@@ -35,3 +41,58 @@ class TestComponent(object):
             "Input:\ninp\n\n### Response:\n"
         )
         assert result == expected_result, f"Expected '{expected_result}', but got '{result}'"
+
+
+class _FakeTokenizer(object):
+    # every word of text i becomes the token i + 1, so the embedding of a row tells which text it came from
+    def __init__(self, texts):
+        self._ids = {text: i + 1 for i, text in enumerate(texts)}
+        self.padded = []
+
+    def __call__(self, texts, truncation, max_length, add_special_tokens):
+        input_ids = [[self._ids[text]] * min(len(text.split()), max_length) for text in texts]
+        return dict(input_ids=input_ids, attention_mask=[[1] * len(ids) for ids in input_ids])
+
+    def pad(self, features, padding, return_tensors):
+        length = max(len(f["input_ids"]) for f in features)
+        self.padded.append([len(f["input_ids"]) for f in features])
+        return _Batch({k: torch.tensor([f[k] + [0] * (length - len(f[k])) for f in features]) for k in features[0]})
+
+
+class _Batch(dict):
+    def to(self, device):
+        return self
+
+
+class _FakeModel(torch.nn.Module):
+    def forward(self, input_ids, attention_mask):
+        first = input_ids[:, :1].float()
+        return (torch.cat([first, torch.ones_like(first)], dim=1)[:, None, :],)
+
+
+class TestLazyHuggingFaceEmbedding(object):
+    def test_length_buckets(self):
+        texts = ["w " * n for n in (9, 1, 5, 3, 7, 2, 8)]
+        tokenizer = _FakeTokenizer(texts)
+
+        def load(self):
+            self.tokenizer, self.embed = tokenizer, _FakeModel()
+
+        with patch.object(ModelManager, "download", side_effect=lambda name: name), \
+                patch.object(LazyHuggingFaceEmbedding, "load_embed", load):
+            embed = LazyHuggingFaceEmbedding("fake", batch_size=3, output_format='numpy')
+            vecs = embed(texts)
+            # micro-batches of at most 3 texts of similar length, each padded to its own longest member
+            assert tokenizer.padded == [[1, 2, 3], [5, 7, 8], [9]]
+            # json text stays the default output
+            legacy = LazyHuggingFaceEmbedding("fake", batch_size=3)
+            assert np.allclose(json.loads(legacy(texts[0])), vecs[0], atol=1e-6)
+        expected = np.array([[i + 1, 1.0] for i in range(len(texts))])
+        assert np.allclose(vecs, expected / np.linalg.norm(expected, axis=1, keepdims=True))
+        assert vecs.dtype == np.float32
+
+    def test_deploy_options(self):
+        with patch.object(ModelManager, "download", side_effect=lambda name: name):
+            deploy = lazyllm.deploy.AutoDeploy("bge-large-zh-v1.5", type="embed",
+                                               launcher=lazyllm.launchers.empty(), batch_size=8, quantize=True)
+        assert isinstance(deploy, EmbeddingDeploy) and deploy.embed_kw == dict(batch_size=8, quantize=True)
@@ -1,4 +1,6 @@
 from unittest.mock import MagicMock
+import pickle
+import numpy as np
 from lazyllm.tools.rag.store import DocNode, MetadataMode
 
 
@@ -67,3 +69,65 @@ class TestDocNode:
         new_metadata = {"editor": "Jane Doe"}
         self.node.metadata = new_metadata
         assert self.node.metadata == new_metadata
+
+    def test_numpy_embedding(self):
+        """Test that float32 embeddings are kept as arrays and exported as lists."""
+        node = DocNode(text=self.text, embedding=np.array([0.5, 0.25], dtype=np.float32))
+        assert node.has_embedding()
+        assert node.to_dict()["embedding"] == [0.5, 0.25]
+        assert not DocNode(text=self.text, embedding=np.array([-1, -1], dtype=np.float32)).has_embedding()
+        assert not DocNode(text=self.text, embedding=np.array([], dtype=np.float32)).has_embedding()
+
+    def test_compact_node(self):
+        """Test that nodes have no __dict__ and survive pickling with their tree."""
+        child = DocNode(text="Child node", group="chunk", parent=self.node)
+        self.node.children["chunk"].append(child)
+        assert not hasattr(child, "__dict__") and child._children is None
+        assert child.metadata is self.node.metadata and child.get_children_str() == "{}"
+        restored = pickle.loads(pickle.dumps(child))
+        assert restored.metadata == self.node.metadata
+        assert restored.parent.children["chunk"] == [restored]
+
+    def test_cached_text(self):
+        """Test that derived texts are cached and rebuilt when their inputs change."""
+        child = DocNode(text="Child node", parent=DocNode(text="Middle", parent=self.node))
+        assert child.root_node is self.node and child.get_content() is child.get_content()
+        self.node.metadata["date"] = "2024-01-01"
+        assert "date: 2024-01-01" in child.get_text(MetadataMode.ALL)
+        self.node.excluded_llm_metadata_keys.append("author")
+        assert child.get_content() == "Child node"
+        child.text = "New text"
+        assert child.get_content() == "New text"
+        new_root = DocNode(text="New root", metadata={"editor": "Jane Doe"})
+        self.node.parent = new_root
+        assert child.root_node is new_root and child.get_content() == "editor: Jane Doe\n\nNew text"
+
+    def test_metadata_changed_in_place(self):
+        """Test that changes made in place to the metadata are not hidden by the cached strings."""
+        node = DocNode(text="Child node", parent=DocNode(text="Root", metadata={"tags": ["a"]}))
+        assert node.get_metadata_str() == "tags: ['a']" and node.get_metadata_str() is node.get_metadata_str()
+        node.metadata["tags"].append("b")
+        assert node.get_metadata_str() == "tags: ['a', 'b']"
+        node.excluded_llm_metadata_keys.append("tags")
+        assert node.get_content() == "Child node"
+        node.parent.excluded_llm_metadata_keys = []
+        assert node.get_content() == "tags: ['a', 'b']\n\nChild node"
+
+    def test_metadata_changed_through_kept_reference(self):
+        """Test that changes made through kept references to the metadata are not hidden by the cached strings."""
+        node = DocNode(text="Child node", parent=DocNode(text="Root", metadata={"a": 1, "tags": ["x"]}))
+        md, excluded = node.metadata, node.excluded_llm_metadata_keys
+        assert node.get_text(MetadataMode.ALL) == "a: 1\ntags: ['x']\n\nChild node"
+        md["b"] = 2
+        assert node.get_text(MetadataMode.ALL) == "a: 1\ntags: ['x']\nb: 2\n\nChild node"
+        excluded.append("a")
+        assert node.get_content() == "tags: ['x']\nb: 2\n\nChild node"
+        md["tags"].append("y")
+        assert node.get_content() == "tags: ['x', 'y']\nb: 2\n\nChild node"
+        del md["tags"]
+        excluded.remove("a")
+        assert node.get_content() == "a: 1\nb: 2\n\nChild node"
+        assert node.get_content() is node.get_content()
+        restored = pickle.loads(pickle.dumps(node))
+        restored.metadata["c"] = 3
+        assert restored.get_content() == "a: 1\nb: 2\nc: 3\n\nChild node"
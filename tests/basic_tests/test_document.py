@@ -5,6 +5,7 @@ from lazyllm.tools.rag.store import DocNode, LAZY_ROOT_NAME
 from lazyllm.tools.rag import Document, Retriever, TransformArgs, AdaptiveTransform
 from unittest.mock import MagicMock
 import unittest
+import time
 
 
 class TestDocImpl(unittest.TestCase):
@@ -69,6 +70,37 @@ class TestDocImpl(unittest.TestCase):
         self.doc_impl.delete_files(["dummy_file.txt"])
         assert len(self.doc_impl.store.traverse_nodes(LAZY_ROOT_NAME)) == 0
 
+    def test_retrieve_with_filters(self):
+        new_doc = DocNode(text="new dummy text", group=LAZY_ROOT_NAME)
+        new_doc.metadata = {"file_name": "new_file.txt"}
+        self.doc_impl._lazy_init()
+        self.mock_directory_reader.load_data.return_value = [new_doc]
+        self.doc_impl.add_files(["new_file.txt"])
+        kw = dict(group_name=LAZY_ROOT_NAME, similarity="bm25", similarity_cut_off=0, index=None, topk=2,
+                  similarity_kws={})
+        assert len(self.doc_impl.retrieve(query="dummy text", **kw)) == 2
+        result = self.doc_impl.retrieve(query="dummy text", filters={"file_name": "new_file.txt"}, **kw)
+        assert result == [new_doc]
+
+    def test_result_cache(self):
+        doc_impl = DocImpl(embed=self.mock_embed, doc_files=["dummy_file.txt"], result_cache_size=8)
+        doc_impl.directory_reader = self.mock_directory_reader
+        kw = dict(group_name=LAZY_ROOT_NAME, similarity="bm25", similarity_cut_off=0, index=None, topk=2,
+                  similarity_kws={})
+        assert [n.text for n in doc_impl.retrieve(query="dummy text", **kw)] == ["dummy text"]
+        assert [n.text for n in doc_impl.retrieve(query="dummy text", **kw)] == ["dummy text"]
+        assert doc_impl.result_cache_stats()["hits"] == 1
+
+        # adding files bumps the version, the cached result is not returned any more
+        new_doc = DocNode(text="new dummy text", group=LAZY_ROOT_NAME)
+        new_doc.metadata = {"file_name": "new_file.txt"}
+        self.mock_directory_reader.load_data.return_value = [new_doc]
+        doc_impl.add_files(["new_file.txt"])
+        assert len(doc_impl.retrieve(query="dummy text", **kw)) == 2
+        assert [len(r) for r in doc_impl.retrieve_batch(queries=["dummy text", "new"], **kw)] == [2, 1]
+        stats = doc_impl.result_cache_stats()
+        assert (stats["hits"], stats["misses"], stats["version"]) == (2, 3, 2)
+
 
 class TestDocument(unittest.TestCase):
     def test_register_global_and_local(self):
@@ -93,7 +125,7 @@ class TestDocument(unittest.TestCase):
         retriever = Retriever([doc1, doc2], 'Chunk2', similarity='bm25', topk=2)
         r = retriever('什么是道')
         assert isinstance(r, list)
-        assert len(r) == 4
+        assert len(r) == 2  # global topk of both documents
         assert isinstance(r[0], DocNode)
 
         retriever2 = Retriever([doc1, doc2], 'Chunk3', similarity='bm25', topk=2)
@@ -121,5 +153,33 @@ class TestDocument(unittest.TestCase):
         retriever('什么是道')
 
 
+class TestRetrieverFanOut(unittest.TestCase):
+    def _doc(self, name, scored, delay=0):
+        def retrieve(func_name, with_score=False, **kw):
+            time.sleep(delay)
+            return scored if func_name == "retrieve" else [scored for _ in kw["queries"]]
+        doc = MagicMock(spec=Document)
+        doc.doc_name, doc._impl = name, MagicMock()
+        doc._impl._impl.node_groups = {"FanOutChunk": {}}
+        doc.forward.side_effect = retrieve
+        return doc
+
+    def test_merge_topk(self):
+        a, b, c, d = (DocNode(text=t) for t in "abcd")
+        docs = [self._doc("doc1", [(a, 0.9), (c, 0.3)]), self._doc("doc2", [(b, 0.5), (d, 0.1)])]
+        retriever = Retriever(docs, "FanOutChunk", similarity="cosine", topk=3)
+        self.assertEqual(retriever("query"), [a, b, c])
+        self.assertEqual(retriever.batch_forward(["q1", "q2"]), [[a, b, c], [a, b, c]])
+        self.assertTrue(all(call.kwargs["with_score"] for doc in docs for call in doc.forward.call_args_list))
+
+    def test_timeout(self):
+        a, b = DocNode(text="a"), DocNode(text="b")
+        docs = [self._doc("fast", [(a, 0.2)]), self._doc("slow", [(b, 0.9)], delay=2)]
+        retriever = Retriever(docs, "FanOutChunk", similarity="cosine", topk=2, timeout=0.5)
+        start = time.time()
+        self.assertEqual(retriever("query"), [a])
+        self.assertLess(time.time() - start, 1.5)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -1,8 +1,13 @@
 import time
 import unittest
-from unittest.mock import MagicMock
-from lazyllm.tools.rag.store import DocNode, MapStore
+import numpy as np
+import pytest
+from unittest.mock import MagicMock, patch
+import lazyllm
+from lazyllm.tools.rag.store import DocNode, MapStore, ChromadbStore, LAZY_ROOT_NAME, _LazyGroupNodes
 from lazyllm.tools.rag.index import DefaultIndex, register_similarity
+from lazyllm.tools.rag.embed_cache import EmbeddingCache, _DiskCache, _embed_identity
+from lazyllm.tools.rag.ann_index import IVFIndex, HNSWIndex, StoreIndex
 
 
 class TestDefaultIndex(unittest.TestCase):
@@ -61,11 +66,269 @@ class TestDefaultIndex(unittest.TestCase):
 
     def test_parallel_do_embedding(self):
         for node in self.nodes:
-            node.has_embedding = MagicMock(return_value=False)
+            node.embedding = None  # nodes have no __dict__, so has_embedding cannot be patched per instance
         start_time = time.time()
         self.index._parallel_do_embedding(self.nodes)
         assert time.time() - start_time < 4, "Parallel not used!"
 
 
+class TestEmbeddingMatrix(object):
+    def _query(self, index, query, nodes, topk):
+        index.embed = MagicMock(return_value=np.asarray(query, dtype=np.float32))
+        return index.query(query="q", nodes=nodes, similarity_name="cosine", similarity_cut_off=float("-inf"),
+                           topk=topk)
+
+    def _brute_force(self, query, nodes, topk):
+        def cos(v): return np.dot(query, v) / np.linalg.norm(query) / np.linalg.norm(v)
+        return [n.uid for n in sorted(nodes, key=lambda n: cos(n.embedding), reverse=True)[:topk]]
+
+    def test_incremental_updates(self):
+        rng = np.random.default_rng(0)
+        nodes = [DocNode(uid=str(i), text=str(i), group="g", embedding=rng.normal(size=8).astype(np.float32))
+                 for i in range(100)]
+        index = DefaultIndex(embed=None, store=MagicMock(spec=MapStore))
+        query = rng.normal(size=8)
+        assert [n.uid for n in self._query(index, query, nodes[:40], 5)] == self._brute_force(query, nodes[:40], 5)
+
+        current = nodes[10:90]  # rows of removed nodes are refilled, new nodes are appended
+        assert [n.uid for n in self._query(index, query, current, 7)] == self._brute_force(query, current, 7)
+        matrix = index._get_matrix("g")
+        assert len(matrix) == 80 and matrix.matrix.dtype == np.float32
+        assert np.allclose(np.linalg.norm(matrix.matrix, axis=1), 1, atol=1e-5)
+        assert len(self._query(index, query, current, None)) == 80
+
+    def test_store_updates(self):
+        rng = np.random.default_rng(2)
+        store = MapStore(["g"])
+        store.add_nodes([DocNode(uid=str(i), text=str(i), group="g", embedding=rng.normal(size=8).astype(np.float32))
+                         for i in range(50)])
+        index, query = DefaultIndex(embed=None, store=store), rng.normal(size=8)
+        self._query(index, query, store.traverse_nodes("g"), 3)
+
+        # later changes of the store reach the matrix without scanning the group on the next query
+        new = [DocNode(uid=f"n{i}", text=f"n{i}", group="g") for i in range(3)]
+        store.add_nodes(new)
+        store.remove_nodes([store.get_node("g", "0")])
+        embed_nodes = MagicMock(side_effect=lambda nodes: [setattr(n, "embedding", rng.normal(size=8)) for n in nodes])
+        with patch.object(index, "_parallel_do_embedding", embed_nodes):
+            result = self._query(index, query, store.traverse_nodes("g"), 5)
+        assert [n.uid for n in embed_nodes.call_args[0][0]] == ["n0", "n1", "n2"]
+        assert len(index._get_matrix("g")) == 52
+        assert [n.uid for n in result] == self._brute_force(query, store.traverse_nodes("g"), 5)
+
+    def test_query_batch(self):
+        rng = np.random.default_rng(1)
+        nodes = [DocNode(uid=str(i), text=str(i), group="g", embedding=rng.normal(size=8).astype(np.float32))
+                 for i in range(50)]
+        queries = {f"q{i}": rng.normal(size=8).astype(np.float32) for i in range(6)}
+        embed = MagicMock(side_effect=lambda texts: [queries[t] for t in texts])
+        index = DefaultIndex(embed=EmbeddingCache(embed), store=MagicMock(spec=MapStore))
+        results = index.query_batch(list(queries), nodes, "cosine", float("-inf"), 4)
+        # all queries are embedded in one call and each gets its own topk
+        assert embed.call_count == 1 and len(results) == len(queries)
+        for result, query in zip(results, queries.values()):
+            assert [n.uid for n in result] == self._brute_force(query, nodes, 4)
+        assert index.query_batch(["q0"], nodes, "cosine", float("-inf"), 4) == results[:1]
+        assert embed.call_count == 1
+
+    def test_candidates(self):
+        rng = np.random.default_rng(2)
+        nodes = [DocNode(uid=str(i), text=str(i), group="g", embedding=rng.normal(size=8).astype(np.float32))
+                 for i in range(30)]
+        candidates, query = nodes[5:15], rng.normal(size=8)
+        index = DefaultIndex(embed=MagicMock(return_value=query), store=MagicMock(spec=MapStore))
+        result = index.query("q", nodes, "cosine", float("-inf"), 3, candidates=candidates)
+        assert [n.uid for n in result] == self._brute_force(query, candidates, 3)
+        assert len(index._get_matrix("g")) == 30  # the matrix still covers the whole group
+        assert index.query_batch(["q"], nodes, "cosine", float("-inf"), 3, candidates=candidates) == [result]
+        assert index.query("q", nodes, "cosine", float("-inf"), 3, candidates=[]) == []
+        ivf = IVFIndex(embed=index.embed, store=index.store)
+        assert ivf.query("q", nodes, "cosine", float("-inf"), 3, candidates=candidates) == result
+
+
+class TestIVFIndex(object):
+    def _nodes(self, rng, n, start=0):
+        centers = rng.normal(size=(20, 16))
+        return [DocNode(uid=str(i), text=str(i), group="g",
+                        embedding=(centers[i % 20] + 0.1 * rng.normal(size=16)).astype(np.float32))
+                for i in range(start, start + n)]
+
+    def test_recall_and_persist(self, tmp_path):
+        rng = np.random.default_rng(0)
+        nodes = self._nodes(rng, 2000)
+        index = IVFIndex(embed=MagicMock(), store=MagicMock(spec=MapStore), persist_path=str(tmp_path), nlist=20)
+        exact = DefaultIndex(embed=index.embed, store=index.store)
+        # the first query is an exact scan and starts training the cells in the background
+        index.embed.return_value = np.ones(16)
+        truth = exact.query("q", nodes, "cosine", float("-inf"), 10)
+        assert index.query("q", nodes, "cosine", float("-inf"), 10) == truth
+        index._get_matrix("g").wait_trained()
+        assert index._get_matrix("g")._centroids is not None
+        hits = 0
+        for q in rng.normal(size=(10, 16)):
+            index.embed.return_value = q
+            truth = exact.query("q", nodes, "cosine", float("-inf"), 10)
+            hits += len(set(truth) & set(index.query("q", nodes, "cosine", float("-inf"), 10, nprobe=4)))
+        assert hits >= 90
+        assert (tmp_path / "g.ivf").exists()
+
+        # incremental update, then reload the persisted cells in a new index
+        nodes = nodes[100:] + self._nodes(rng, 50, start=2000)
+        assert len(index.query("q", nodes, "cosine", float("-inf"), None, nprobe=20)) == len(nodes)
+        reloaded = IVFIndex(embed=index.embed, store=index.store, persist_path=str(tmp_path), nlist=20)
+        result = reloaded.query("q", nodes, "cosine", float("-inf"), 5, nprobe=20)
+        assert result == exact.query("q", nodes, "cosine", float("-inf"), 5)
+        assert np.array_equal(reloaded._get_matrix("g")._centroids, index._get_matrix("g")._centroids)
+
+
+class TestHNSWIndex(object):
+    def _nodes(self, rng, n, start=0):
+        return [DocNode(uid=str(i), text=str(i), group="g", embedding=rng.normal(size=16).astype(np.float32))
+                for i in range(start, start + n)]
+
+    def test_recall_and_persist(self, tmp_path):
+        hnswlib = pytest.importorskip("hnswlib")
+        rng = np.random.default_rng(0)
+        store = MapStore(["g"])
+        store.add_nodes(self._nodes(rng, 500))
+        index = HNSWIndex(embed=MagicMock(), store=store, persist_path=str(tmp_path))
+        exact = DefaultIndex(embed=index.embed, store=MagicMock(spec=MapStore))
+        hits = 0
+        for q in rng.normal(size=(10, 16)):
+            index.embed.return_value = q
+            truth = exact.query("q", store.traverse_nodes("g"), "cosine", float("-inf"), 10)
+            hits += len(set(truth) & set(index.query("q", store.traverse_nodes("g"), "cosine", float("-inf"), 10)))
+        assert hits >= 95
+        # ef is raised to topk, so a query for every node finds all of them
+        assert len(index.query("q", store.traverse_nodes("g"), "cosine", float("-inf"), None, ef=1)) == 500
+        index._get_graph("g").wait_saved()
+        assert (tmp_path / "g.hnsw").exists()
+
+        # changes of the store reach the graph without scanning the group on the next query
+        new = self._nodes(rng, 3, start=500)
+        store.add_nodes([DocNode(uid=n.uid, text=n.text, group="g") for n in new])
+        store.remove_nodes([store.get_node("g", str(i)) for i in range(10)])
+        vecs = {n.uid: n.embedding for n in new}
+        embed_nodes = MagicMock(side_effect=lambda nodes: [setattr(n, "embedding", vecs[n.uid]) for n in nodes])
+        index.embed.return_value = vecs["501"]
+        with patch.object(index, "_parallel_do_embedding", embed_nodes):
+            result = index.query("q", store.traverse_nodes("g"), "cosine", float("-inf"), 1)
+        assert [n.uid for n in embed_nodes.call_args[0][0]] == ["500", "501", "502"]
+        assert [n.uid for n in result] == ["501"] and len(index._get_graph("g")) == 493
+
+        # the saved graph is reloaded by a new index, nodes removed meanwhile are skipped
+        index._get_graph("g").wait_saved()
+        store.remove_nodes([store.get_node("g", "501")])
+        reloaded = HNSWIndex(embed=index.embed, store=store, persist_path=str(tmp_path))
+        with patch.object(hnswlib.Index, "add_items", side_effect=AssertionError("rebuilt the graph")):
+            result = reloaded.query("q", store.traverse_nodes("g"), "cosine", float("-inf"), 5, ef=100)
+        assert "501" not in [n.uid for n in result] and len(reloaded._get_graph("g")) == 492
+        assert result == exact.query("q", store.traverse_nodes("g"), "cosine", float("-inf"), 5)
+
+
+class TestStoreIndex(object):
+    def test_pushdown(self, tmp_path, monkeypatch):
+        monkeypatch.setitem(lazyllm.config.impl, "rag_persistent_path", str(tmp_path))
+        rng = np.random.default_rng(0)
+        nodes = [DocNode(uid=f"s{i}", text=str(i), group="pushdown", embedding=rng.normal(size=8).astype(np.float32))
+                 for i in range(50)]
+        embed = MagicMock(return_value=rng.normal(size=8))
+        exact = DefaultIndex(embed=embed, store=MagicMock(spec=MapStore))
+        truth = exact.query("q", nodes, "cosine", float("-inf"), 5)
+
+        store = ChromadbStore(["pushdown"], embed)
+        store.add_nodes(nodes)
+        index = StoreIndex(embed=embed, store=store)
+        with patch.object(index, "_get_matrix", side_effect=AssertionError("searched in memory")):
+            assert index.query("q", nodes, "cosine", float("-inf"), 5) == truth
+            # nodes removed from the store are still in the collection and are skipped
+            store.remove_nodes(truth[:2])
+            assert index.query("q", nodes, "cosine", float("-inf"), 3) == truth[2:]
+        store.close()
+
+        # stores without vector search are searched in memory
+        index = StoreIndex(embed=embed, store=MagicMock(spec=MapStore, search_vectors=MagicMock(return_value=None)))
+        assert index.query("q", nodes, "cosine", float("-inf"), 5) == truth
+
+    def test_lazy_group(self, tmp_path, monkeypatch):
+        monkeypatch.setitem(lazyllm.config.impl, "rag_persistent_path", str(tmp_path))
+        rng = np.random.default_rng(1)
+        root = DocNode(uid="lazy_root", text="root", group=LAZY_ROOT_NAME)
+        nodes = [DocNode(uid=f"l{i}", text=str(i), group="lazygroup", parent=root,
+                         embedding=rng.normal(size=8).astype(np.float32)) for i in range(50)]
+        embed = MagicMock(return_value=rng.normal(size=8))
+        truth = DefaultIndex(embed=embed, store=MagicMock(spec=MapStore)).query("q", nodes, "cosine", float("-inf"), 5)
+        store = ChromadbStore([LAZY_ROOT_NAME, "lazygroup"], embed)
+        store.add_nodes([root])
+        store.add_nodes(nodes)
+        store.close()
+
+        store = ChromadbStore([LAZY_ROOT_NAME, "lazygroup"], embed)
+        store.try_load_store()
+        index = StoreIndex(embed=embed, store=store)
+        # only the nodes found are built from the collection, the group is neither loaded nor flushed
+        with patch.object(store, "_load_group", side_effect=AssertionError("loaded the group")), \
+                patch.object(store, "flush", side_effect=AssertionError("flushed")):
+            result = index.query("q", _LazyGroupNodes(store, "lazygroup"), "cosine", float("-inf"), 5)
+        assert [node.uid for node in result] == [node.uid for node in truth]
+        assert result[0].parent is store.get_node(LAZY_ROOT_NAME, "lazy_root")
+        assert any(node is result[0] for node in store.traverse_nodes("lazygroup"))
+
+        # a new node is embedded by the next query and found before it is written
+        new = DocNode(uid="lazy_new", text="new", group="lazygroup", parent=root)
+        with patch.object(store, "_write_batch"):
+            store.add_nodes([new])
+            assert index.query("q", _LazyGroupNodes(store, "lazygroup"), "cosine", float("-inf"), 1) == [new]
+            if (writer := store._writer) is not None: writer.join()
+
+
+class TestEmbeddingCache(object):
+    def test_query_lru(self):
+        embed = MagicMock(side_effect=lambda text: [float(len(text)), 1.0])
+        cache = EmbeddingCache(embed, max_size=2)
+        vec = cache("ab")
+        assert vec.dtype == np.float32 and vec.tolist() == [2.0, 1.0] and cache("ab") is vec
+        assert embed.call_count == 1 and cache.hits == 1
+        cache("abc"), cache("abcd"), cache("ab")
+        assert embed.call_count == 4
+
+    def test_corpus_persist(self, tmp_path):
+        path = str(tmp_path / "embed.db")
+        embed = MagicMock(side_effect=lambda text: str([float(len(text)), 0.5]))
+        cache = EmbeddingCache(embed, identity="fake-v1", path=path)
+        nodes = [DocNode(text=t) for t in ("a", "bb", "ccc")]
+        DefaultIndex(cache, MagicMock(spec=MapStore))._parallel_do_embedding(nodes)
+        assert [n.embedding.tolist() for n in nodes] == [[1.0, 0.5], [2.0, 0.5], [3.0, 0.5]]
+        assert embed.call_count == 3
+
+        # re-ingest with one changed chunk: only that one is embedded again
+        cache = EmbeddingCache(embed, identity="fake-v1", path=path)
+        nodes = [DocNode(text=t) for t in ("a", "bb", "dddd")]
+        DefaultIndex(cache, MagicMock(spec=MapStore))._parallel_do_embedding(nodes)
+        assert nodes[2].embedding.tolist() == [4.0, 0.5] and embed.call_count == 4
+        assert all(n.embedding.dtype == np.float32 for n in nodes)
+
+        # another embedder never sees the vectors of the first one
+        EmbeddingCache(embed, identity="fake-v2", path=path).corpus("a")
+        assert embed.call_count == 5
+
+    def test_disk_eviction(self, tmp_path):
+        disk = _DiskCache(str(tmp_path / "embed.db"), max_entries=10)
+        for i in range(25): disk.put(str(i), np.full(2, i, dtype=np.float32))
+        kept = [str(i) for i in range(25) if disk.get(str(i)) is not None]
+        assert len(kept) <= 10 and "24" in kept and "0" not in kept
+
+    def test_identity(self):
+        online = MagicMock(spec=["_embed_model_name", "_embed_url"], _embed_model_name="m", _embed_url="http://a")
+        other = MagicMock(spec=["_embed_model_name", "_embed_url"], _embed_model_name="m", _embed_url="http://b")
+        assert _embed_identity(online) != _embed_identity(other)
+        base = MagicMock(spec=["base_model", "_impl"], base_model="bge")
+        base._impl = MagicMock(spec=[], _specific_target_path=None, _trainset=None, _deploy_args={})
+        tuned = MagicMock(spec=["base_model", "_impl"], base_model="bge")
+        tuned._impl = MagicMock(spec=[], _specific_target_path="/ckpt/merge", _trainset=None, _deploy_args={})
+        assert _embed_identity(base) != _embed_identity(tuned)
+        assert _embed_identity(MagicMock(spec=[])) is None
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -24,6 +24,30 @@ class TestModule:
         assert action_module(1) == 2
         assert action_module(10) == 11
 
+    def test_batch(self, tmp_path):
+        failed = set()
+
+        def func(x):
+            if x % 7 == 3 and x not in failed:
+                failed.add(x)
+                raise RuntimeError('flaky')
+            time.sleep(0.01)
+            return x * 2
+
+        m = lazyllm.ActionModule(func)
+        checkpoint = str(tmp_path / 'ckpt.jsonl')
+        assert m.batch(range(50), concurrency=8, retries=1, retry_delay=0, checkpoint=checkpoint) == \
+            [x * 2 for x in range(50)]
+        assert m.batch_stats.succeeded == 50 and m.batch_stats.retried == 7
+
+        m2 = lazyllm.ActionModule(lambda x: x * 3)
+        assert m2.batch(range(60), checkpoint=checkpoint) == [x * 2 for x in range(50)] + [x * 3 for x in range(50, 60)]
+        assert m2.batch_stats.resumed == 50 and m2.batch_stats.succeeded == 10
+
+        with pytest.raises(RuntimeError):
+            lazyllm.ActionModule(lambda x: 1 / x).batch([1, 0, 2])
+        assert lazyllm.ActionModule(lambda x: 1 / x).batch([1, 0, 2], on_error='skip') == [1, None, 0.5]
+
     def test_UrlModule(self):
         def func(x):
             return str(x) + ' after'
@@ -45,6 +69,52 @@ class TestModule:
         server_module.eval()
         assert server_module.eval_result == ['INPUT1', 'INPUT2']
 
+    def test_ServerModule_metrics(self):
+        server_module = lazyllm.ServerModule(lambda x: x.upper())
+        server_module.start()
+        assert server_module('hello') == 'HELLO'
+        base_url = server_module._url.rsplit('/', 1)[0]
+        assert requests.get(f'{base_url}/health').json()['status'] == 'ok'
+        metrics = requests.get(f'{base_url}/metrics').text
+        assert 'lazyllm_requests_total{path="/generate",status="200"} 1' in metrics
+        assert 'lazyllm_requests_in_flight 0' in metrics
+
+    def test_TrialModule(self):
+        class M(lazyllm.ModuleBase):
+            def __init__(self, a: lazyllm.Option, b: lazyllm.Option):
+                super().__init__()
+                self.a, self.b = a, b
+
+            def forward(self, x): return self.a * x + self.b
+
+        m = M(lazyllm.Option([1, 2, 3]), lazyllm.Option([0, 10]))
+        m.evalset(list(range(8)))
+        t = lazyllm.TrialModule(m, max_workers=2, score_f=sum).update()
+        assert len(t.results) == 6 and t.best['options'] == [3, 10]
+        assert t.results[0] == dict(options=[1, 0], eval_result=list(range(8)), score=28)
+
+        t = lazyllm.TrialModule(m, max_workers=2, sampler='random', n_trials=4, score_f=sum, seed=0).update()
+        assert len(t.results) == 4 and len(set(tuple(r['options']) for r in t.results)) == 4
+
+        t = lazyllm.TrialModule(m, max_workers=3, score_f=sum, early_stop='halving', min_eval=2).update()
+        assert t.best['options'] == [3, 10] and all(len(r['eval_result']) == 8 for r in t.results)
+        assert len(t.results) < 6
+
+        # options left with a single value are never mutated
+        def single(value):
+            o = lazyllm.Option([value, value])
+            o._objs = [value]
+            return o
+
+        m = M(single(1), lazyllm.Option([0, 10]))
+        m.evalset(list(range(8)))
+        t = lazyllm.TrialModule(m, max_workers=1, sampler='adaptive', n_trials=2, score_f=sum, seed=0).update()
+        assert sorted(r['options'] for r in t.results) == [[1, 0], [1, 10]]
+        m = M(single(1), single(0))
+        m.evalset(list(range(8)))
+        t = lazyllm.TrialModule(m, max_workers=1, sampler='adaptive', n_trials=3, score_f=sum, seed=0).update()
+        assert [r['options'] for r in t.results] == [[1, 0]]
+
     def test_ServerModule_with_global(self):
         lazyllm.globals['a'] = '1'
         server_module = lazyllm.ServerModule(lambda x: x.upper() + lazyllm.globals['a'])
@@ -130,6 +200,119 @@ class TestModule:
         re = ''.join(lazyllm.FileSystemQueue().dequeue())
         assert re == "reply for input, and parameters is {'do_sample': False, 'temperature': 0.1}"
 
+    def test_ToolCallParser(self):
+        from lazyllm.module.toolcall import ToolCallParser
+        calls = []
+        p = ToolCallParser('<|action_start|>', '<|args|>', '<|action_end|>', on_tool_call=calls.append)
+        chunks = ['Let me ', 'check.<|act', 'ion_start|>get_weather<|ar', 'gs|>{"city": "}"', '}', '<|action_end|>']
+        assert [p.feed(c)[0] for c in chunks] == ['Let me ', 'check.', '', '', '', '']
+        assert calls == [{'name': 'get_weather', 'arguments': {'city': '}'}}]
+        assert p.close() == ('', []) and p.content == 'Let me check.'
+
+        p = ToolCallParser(tools=['search'])
+        assert p.feed('Sea')[0] == 'Sea' and p.feed('rching\nsea')[0] == 'rching'
+        assert p.feed('rch\n{"q":\n') == ('', []) and p.feed(' 1}\ntail') == ('', [{'name': 'search', 'arguments':
+                                                                                    '{"q":\n 1}'}])
+        assert p.parse('') == ('Searching', [{'name': 'search', 'arguments': '{"q":\n 1}'}])
+
+        content, tool_calls = ToolCallParser(tools=['search']).parse('ok\n[{"name": "search", "arguments": {"q": 1}}]')
+        assert content == 'ok' and tool_calls == [{'name': 'search', 'arguments': {'q': 1}}]
+
+    def test_StreamAccumulator(self):
+        from lazyllm.module.onlineChatModule.streamAccumulator import StreamAccumulator
+
+        def chunk(delta, finish_reason=None):
+            return {'id': 'c1', 'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}]}
+
+        acc = StreamAccumulator()
+        acc.add(chunk({'role': 'assistant', 'content': 'Hel', 'tool_calls': [
+            {'index': 0, 'id': 'call_0', 'function': {'name': 'search', 'arguments': '{"q"'}}]}))
+        assert acc.message['choices'][0]['delta']['content'] == 'Hel'
+        acc.add(chunk({'content': 'lo', 'tool_calls': [{'index': 0, 'function': {'arguments': ': 1}'}}]}))
+        acc.add(chunk({'tool_calls': [{'index': 1, 'id': 'call_1', 'function': {'name': 'get', 'arguments': '{}'}}]}))
+        acc.add(chunk({}, 'tool_calls'))
+        assert acc.message == {'id': 'c1', 'choices': [{'index': 0, 'finish_reason': 'tool_calls', 'delta': {
+            'role': 'assistant', 'content': 'Hello', 'tool_calls': [
+                {'index': 0, 'id': 'call_0', 'function': {'name': 'search', 'arguments': '{"q": 1}'}},
+                {'index': 1, 'id': 'call_1', 'function': {'name': 'get', 'arguments': '{}'}}]}}]}
+
+        acc = StreamAccumulator(cumulative=True)
+        for text in ['He', 'Hello', 'Hello!']: acc.add(chunk({'content': text}))
+        assert acc.message['choices'][0]['delta']['content'] == 'Hello!'
+
+        # reading the message mid-stream does not change how later deltas are merged
+        acc = StreamAccumulator()
+        for text in ['x', 'x']: acc.add(chunk({'content': text}))
+        assert acc.message['choices'][0]['delta']['content'] == 'x'
+        acc.add(chunk({'content': 'y'}))
+        assert acc.message['choices'][0]['delta']['content'] == 'xxy' and acc.message['id'] == 'c1'
+        acc.add(chunk({'content': 'z'}))
+        assert acc.message['choices'][0]['delta']['content'] == 'xxyz'
+
+    def test_OnlineChatRouter(self):
+        from lazyllm.module.onlineChatModule.onlineChatModuleBase import _stream_observer
+
+        class Backend(lazyllm.ModuleBase):
+            def __init__(self, name, delay=0, fail=False, chunks=()):
+                super().__init__()
+                self.n, self.delay, self.fail, self.chunks, self.calls = name, delay, fail, chunks, 0
+
+            def forward(self, x):
+                self.calls += 1
+                time.sleep(self.delay)
+                if self.fail: raise ValueError(self.n)
+                for c in self.chunks:
+                    if (observer := _stream_observer.get()).cancelled: return ''
+                    observer.on_chunk()
+                    observer.on_content(c)
+                return f'{self.n}:{x}'
+
+        slow, fast = Backend('slow', delay=2, chunks=['a', 'b']), Backend('fast', chunks=['1', '2'])
+        lazyllm.FileSystemQueue().clear()
+        r = lazyllm.OnlineChatRouter([slow, fast], weights=[1e6, 1e-6], hedge_delay=0.1)
+        start = time.time()
+        assert r('q') == 'fast:q' and time.time() - start < 1.5
+        assert ''.join(lazyllm.FileSystemQueue().dequeue()) == '12'
+        assert slow.calls == 1 and fast.calls == 1 and r.status()[0]['hedged'] == 1
+
+        bad, good = Backend('bad', fail=True), Backend('good')
+        r = lazyllm.OnlineChatRouter([bad, good], weights=[1e6, 1e-6], max_failures=1)
+        assert r('q') == 'good:q' and r('q') == 'good:q'
+        assert bad.calls == 1 and good.calls == 2 and not r.status()[0]['healthy']
+        with pytest.raises(RuntimeError):
+            lazyllm.OnlineChatRouter([Backend('a', fail=True), Backend('b', fail=True)])('q')
+
+    def test_OnlineEmbeddingModule_batch(self, monkeypatch):
+        import json
+        import random
+        import threading
+        import http.server
+        batches = []
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                texts = json.loads(self.rfile.read(int(self.headers['Content-Length'])))['input']
+                batches.append(texts)
+                data = [dict(index=i, embedding=[float(t)]) for i, t in enumerate(texts)]
+                random.shuffle(data)
+                body = json.dumps(dict(data=data)).encode()
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args): pass
+
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        monkeypatch.setitem(lazyllm.config.impl, 'openai_api_key', 'sk-test')
+        m = lazyllm.OnlineEmbeddingModule(source='openai', embed_url=f'http://127.0.0.1:{server.server_port}/',
+                                          batch_size=3, num_workers=2)
+        assert m([str(i) for i in range(10)]) == [[float(i)] for i in range(10)]
+        assert sorted(len(b) for b in batches) == [1, 3, 3, 3]
+        assert m('7') == [7.0] and batches[-1] == '7'
+        server.shutdown()
+
     def test_WebModule(self):
         def func(x):
             return 'reply ' + x
@@ -1,11 +1,21 @@
+import contextlib
+import os
+import shutil
+import tempfile
 import unittest
-from unittest.mock import MagicMock
-from lazyllm.tools.rag.store import DocNode, ChromadbStore, LAZY_ROOT_NAME
+from unittest.mock import MagicMock, patch
+import lazyllm
+from lazyllm.tools.rag.index import DefaultIndex
+from lazyllm.tools.rag.store import DocNode, ChromadbStore, MapStore, LAZY_ROOT_NAME
 
 
 # Test class for ChromadbStore
 class TestChromadbStore(unittest.TestCase):
     def setUp(self):
+        # every test persists to a directory of its own, so that runs do not see the nodes of earlier ones
+        self.persist_path = tempfile.mkdtemp()
+        self.config = patch.dict(lazyllm.config.impl, {"rag_persistent_path": self.persist_path})
+        self.config.start()
         self.node_groups = [LAZY_ROOT_NAME, "group1", "group2"]
         self.embed = MagicMock(side_effect=lambda text: [0.1, 0.2, 0.3])
         self.store = ChromadbStore(self.node_groups, self.embed)
@@ -13,6 +23,11 @@ class TestChromadbStore(unittest.TestCase):
             [DocNode(uid="1", text="text1", group=LAZY_ROOT_NAME, parent=None)],
         )
 
+    def tearDown(self):
+        self.store.close()
+        self.config.stop()
+        shutil.rmtree(self.persist_path, ignore_errors=True)
+
     def test_initialization(self):
         self.assertEqual(set(self.store._collections.keys()), set(self.node_groups))
 
@@ -27,8 +42,11 @@ class TestChromadbStore(unittest.TestCase):
         node1 = DocNode(uid="1", text="text1", group="group1")
         node2 = DocNode(uid="2", text="text2", group="group2")
         self.store.add_nodes([node1, node2])
+        self.store.flush()
         collection = self.store._collections["group1"]
-        self.assertEqual(collection.peek(collection.count())["ids"], ["1", "2"])
+        self.assertEqual(collection.peek(collection.count())["ids"], ["1"])
+        collection = self.store._collections["group2"]
+        self.assertEqual(collection.peek(collection.count())["ids"], ["2"])
 
     def test_try_load_store(self):
         # Set up initial data to be loaded
@@ -46,6 +64,122 @@ class TestChromadbStore(unittest.TestCase):
         self.assertEqual(nodes[1].uid, "2")
         self.assertEqual(nodes[1].parent.uid, "1")
 
+    def test_lazy_load(self):
+        groups = [LAZY_ROOT_NAME, "lazy1", "lazy2"]
+        store = ChromadbStore(groups, self.embed)
+        root = DocNode(uid="lazy_root", text="root", group=LAZY_ROOT_NAME)
+        chunks = [DocNode(uid=f"lazy1_{i}", text=f"chunk{i}", group="lazy1", parent=root) for i in range(3)]
+        store.add_nodes([root])
+        store.add_nodes(chunks)
+        store.add_nodes([DocNode(uid="lazy2_0", text="fine", group="lazy2", parent=chunks[2])])
+        store.close()
+
+        with patch.dict(os.environ, {"LAZYLLM_RAG_CHROMA_LOAD_BATCH_SIZE": "2"}):
+            lazyllm.config.refresh("rag_chroma_load_batch_size")
+            store = ChromadbStore(groups, self.embed)
+            store.try_load_store()
+            # only the root nodes are loaded, the other groups on first access
+            self.assertEqual(store._pending, {"lazy1", "lazy2"})
+            self.assertEqual(store.active_groups(), groups)
+            node = store.traverse_nodes("lazy2")[0]
+        lazyllm.config.refresh("rag_chroma_load_batch_size")
+
+        self.assertFalse(store._pending)
+        self.assertEqual(node.parent.uid, "lazy1_2")
+        self.assertIs(node.parent.parent, store.get_node(LAZY_ROOT_NAME, "lazy_root"))
+        self.assertEqual(len(store.traverse_nodes("lazy1")), 3)
+        self.assertEqual(len(store.get_node(LAZY_ROOT_NAME, "lazy_root").children["lazy1"]), 3)
+
+    def test_write_behind(self):
+        store = ChromadbStore([LAZY_ROOT_NAME, "behind"], self.embed)
+        nodes = [DocNode(uid=f"behind_{i}", text=f"text{i}", group="behind") for i in range(5)]
+        collection = store._collections["behind"]
+        with patch.object(collection, "upsert", side_effect=RuntimeError("down")):
+            store.add_nodes(nodes)
+            with contextlib.suppress(RuntimeError): store.flush()
+            if (writer := store._writer) is not None: writer.join()
+        # a failed batch stays dirty and is written by the next flush, in batches of the configured size
+        with patch.dict(os.environ, {"LAZYLLM_RAG_STORE_WRITE_BATCH_SIZE": "2"}):
+            lazyllm.config.refresh("rag_store_write_batch_size")
+            with patch.object(collection, "upsert", wraps=collection.upsert) as upsert:
+                store.flush()
+        lazyllm.config.refresh("rag_store_write_batch_size")
+        self.assertEqual([len(call.kwargs["ids"]) for call in upsert.call_args_list], [2, 2, 1])
+        self.assertTrue(all(node.is_saved for node in nodes))
+        self.assertFalse(store._dirty)
+        self.assertEqual(len(collection.get(ids=[node.uid for node in nodes])["ids"]), 5)
+
+    def test_query_saves_embedded_only(self):
+        nodes = [DocNode(uid=f"query_{i}", text=f"text{i}", group="group1") for i in range(4)]
+        self.store.add_nodes(nodes)
+        index = DefaultIndex(self.embed, self.store)
+        with patch.object(self.store, "try_save_nodes", wraps=self.store.try_save_nodes) as save:
+            index.query("text", self.store.traverse_nodes("group1"), "cosine", float("-inf"), 2)
+            # the nodes embedded by the first query are saved, later queries do not hand nodes to the store
+            self.assertEqual([len(call.args[0]) for call in save.call_args_list], [4])
+            index.query("text", self.store.traverse_nodes("group1"), "cosine", float("-inf"), 2)
+            self.assertEqual(save.call_count, 1)
+        self.store.flush()
+        self.assertTrue(all(node.is_saved for node in nodes))
+
+
+class TestMetadataFilter(unittest.TestCase):
+    def setUp(self):
+        self.store = MapStore([LAZY_ROOT_NAME, "chunk"])
+        self.roots = [DocNode(uid=f"r{i}", group=LAZY_ROOT_NAME, metadata=dict(file_name=f"{i}.txt", kb=kb, tags=tags))
+                      for i, (kb, tags) in enumerate([("a", ["x", "y"]), ("b", ["y"]), ("a", [])])]
+        self.store.add_nodes(self.roots)
+        self.chunks = [DocNode(uid=f"c{i}", group="chunk", parent=root) for i, root in enumerate(self.roots)]
+        self.store.add_nodes(self.chunks)
+
+    def _uids(self, filters, group="chunk"):
+        return [node.uid for node in self.store.filter_nodes(group, filters)]
+
+    def test_filter(self):
+        # chunks are matched by the metadata of their root node
+        self.assertEqual(self._uids(dict(kb="a")), ["c0", "c2"])
+        self.assertEqual(self._uids(dict(kb="a", tags="y")), ["c0"])
+        self.assertEqual(self._uids(dict(file_name=["1.txt", "2.txt"])), ["c1", "c2"])
+        self.assertEqual(self._uids(dict(kb="c")), [])
+        self.assertEqual(self._uids(dict(missing=1)), [])
+
+    def test_incremental(self):
+        self.assertEqual(self._uids(dict(kb="b")), ["c1"])
+        root = DocNode(uid="r3", group=LAZY_ROOT_NAME, metadata=dict(kb="b"))
+        self.store.add_nodes([root, DocNode(uid="c3", group="chunk", parent=root)])
+        self.store.add_nodes([DocNode(uid="c4", group="chunk", parent=root)])
+        self.store.remove_nodes([self.chunks[1]])
+        self.assertEqual(self._uids(dict(kb="b")), ["c3", "c4"])
+
+
+class TestAncestry(unittest.TestCase):
+    def setUp(self):
+        self.store = MapStore([LAZY_ROOT_NAME, "coarse", "fine"])
+        self.root = DocNode(uid="r", group=LAZY_ROOT_NAME)
+        self.coarse = [DocNode(uid=f"c{i}", group="coarse", parent=self.root) for i in range(2)]
+        self.fine = [DocNode(uid=f"f{i}", group="fine", parent=self.coarse[i // 2]) for i in range(4)]
+        self.store.add_nodes([self.root] + self.coarse + self.fine)
+
+    def _uids(self, nodes):
+        return [node.uid for node in nodes]
+
+    def test_lookup(self):
+        self.assertIs(self.store.find_ancestor(self.fine[3], LAZY_ROOT_NAME), self.root)
+        self.assertIs(self.store.find_ancestor(self.fine[3], "coarse"), self.coarse[1])
+        self.assertIsNone(self.store.find_ancestor(self.root, "coarse"))
+        self.assertEqual(self._uids(self.store.find_descendants(self.root, "fine")), ["f0", "f1", "f2", "f3"])
+        self.assertEqual(self._uids(self.store.find_descendants(self.coarse[0], "fine")), ["f0", "f1"])
+        self.assertEqual(self.store.find_descendants(self.fine[0], "coarse"), [])
+        # a node which is not in the store is walked up
+        self.assertIs(self.store.find_ancestor(DocNode(group="fine", parent=self.coarse[0]), LAZY_ROOT_NAME), self.root)
+
+    def test_incremental(self):
+        self.assertEqual(len(self.store.find_descendants(self.root, "fine")), 4)
+        self.store.add_nodes([DocNode(uid="f4", group="fine", parent=self.coarse[1])])
+        self.store.remove_nodes([self.fine[0]])
+        self.assertEqual(self._uids(self.store.find_descendants(self.root, "fine")), ["f1", "f2", "f3", "f4"])
+        self.assertEqual(self._uids(self.store.find_descendants(self.coarse[1], "fine")), ["f2", "f3", "f4"])
+
 
 if __name__ == "__main__":
     unittest.main()